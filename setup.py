@@ -23,6 +23,12 @@ setup(
         'mock == 1.0.1',
         'twisted == 15.2.1',
     ],
+    entry_points={
+        'console_scripts': [
+            'thinserve-bench = thinserve.api.bench:main',
+            'thinserve-shard = thinserve.api.shard:main',
+        ],
+    },
     package_data={
         PACKAGENAME: [
             'web/static/*',
@@ -1,18 +1,28 @@
 import os
-import json
-from functable import FunctionTableProperty
 from twisted.internet import defer
 from twisted.web import resource, server
-from thinserve.proto import session, error
+from thinserve.api import compression
+from thinserve.proto import codec as protocodec
+from thinserve.proto import error, scheduler, session, sessiondb, sessiontable
 from thinserve.proto.lazyparser import LazyParser
+from thinserve.proto.metrics import Metrics
+from thinserve.util import FunctionTableProperty
+
+
+DefaultMaxBodySize = 2 ** 20
+
+CodecSeconds = Metrics.histogram(
+    'thinserve_codec_seconds',
+    'Time spent encoding responses and decoding request bodies.',
+    labels=['codec', 'operation'])
 
 
 class ThinAPIResource (resource.Resource):
     """ThinAPIResource is an RPC mechanism:
 
-    HTTP POST bodies and all response bodies are JSON. HTTP errors
-    represent protocol errors (such as malformed JSON), but not
-    application errors.
+    HTTP POST bodies and all response bodies are JSON, or MessagePack
+    (see below). HTTP errors represent protocol errors (such as
+    malformed JSON), but not application errors.
 
     POST ./
     Body: ["create_session", {}]
@@ -24,7 +34,7 @@ class ThinAPIResource (resource.Resource):
     POST ./${sessionid}
     Body: < ["call",
              {"id": callid,
-              "target": sid or null,
+              "target": handle or null,
               "method": methodname,
               "params": {...params...}}]
           | ["reply",
@@ -33,82 +43,373 @@ class ThinAPIResource (resource.Resource):
                         | ["error",
                            {"template": errortemplate,
                             "params": {...params...}}]
-                        >}]>
+                        >}]
+          | ["release", {"target": handle}]>
     Reply: "ok"
-    Synopsis: Deliver a call or reply.
+    Synopsis: Deliver a call or reply, or release a reference.
+
+    A call with a null target calls the session's root object. An
+    @Referenceable object in a returned value (or in the params of a
+    call to the client) is sent as ["@SREF", handle]; the handle may be
+    used as a call target until the client releases it or the session
+    closes. At most max_refs references may be held at once; a reply
+    which would exceed that is an error instead.
+
+    Calls from the server to the client are cancelled after
+    call_timeout seconds without a reply, and at most max_pending_calls
+    of them may await replies per session.
+
+    Calls from clients to the application's methods may be limited to
+    max_running_calls at once over all sessions, and max_session_calls
+    at once per session. Excess calls wait, up to max_queued_calls of
+    them, beyond which calls fail with a "too many calls" error.
+    call_order is 'fair' (sessions take turns) or 'fifo'. See
+    thinserve.proto.scheduler.CallScheduler.
+
+    POST ./${sessionid}
+    Body: ["@LIST", message...]
+    Reply: "ok" | {"errors": [[index, {"template": errortemplate,
+                                       "params": {...params...}}],
+                              ...]}
+    Synopsis: Deliver a batch of calls or replies, in order. A malformed
+              message is reported by its index in the batch and does not
+              prevent delivery of the others.
 
     GET ./${sessionid}
     Reply: [messages...]
-    Synopsis: Return pending messages (calls or replies as above). This
+    Synopsis: Return pending messages (calls or replies as above, or
+              ["cancel", {"id": callid}] when the server abandons a call
+              it made, after which any reply to it is ignored). This
               request blocks until there are messages ready, or it times
               out, or an identical concurrent GET is received by the
               server.
+
+    GET ./${sessionid}/events
+    Reply: A text/event-stream of Server-Sent Events.
+    Synopsis: Stream pending messages over one long-lived response. Each
+              batch of messages is one event whose data is the same JSON
+              list a GET ./${sessionid} would return. A comment line is
+              sent whenever poll_timeout passes with no messages. If the
+              session closes, an "error" event carries the error and the
+              stream ends. As with GET, a newer GET or event stream for
+              the session takes over delivery.
+
+    Responses are encoded compactly unless pretty is set for debugging.
+    codec may name a JSON backend from thinserve.proto.codec; by default
+    the fastest installed backend is used.
+
+    A client which sends POST bodies with Content-Type
+    application/msgpack, or asks for it with Accept, gets MessagePack in
+    place of JSON, with the same messages; it picks this when it creates
+    its session and keeps sending the same headers. Each request is
+    negotiated from its own headers, so a session moved between
+    processes by session_db or shard keeps its encoding. A binary body
+    whose codec is not installed is rejected with HTTP 415. Event
+    streams are always JSON.
+
+    Messages are parsed with
+    parser, which is LazyParser or thinserve.proto.eagerparser's
+    EagerParser. POST bodies larger than max_body_size bytes are rejected
+    with HTTP 413. call_hooks are thinserve.proto.callhooks.CallHooks,
+    notified around every call to the application's methods.
+
+    Responses of at least compress_min_size bytes are compressed with
+    gzip or deflate, whichever the request's Accept-Encoding prefers, at
+    zlib compress_level; compress_level=None disables this. POST bodies
+    may likewise be sent with Content-Encoding gzip or deflate; their
+    decompressed size is held to max_body_size.
+
+    A blocked GET is answered with [] after poll_timeout seconds, and is
+    abandoned if its client disconnects first. When batch_delay is set,
+    the first message for a blocked GET waits up to batch_delay seconds
+    (or until batch_size messages or batch_bytes bytes accumulate) so
+    that one response carries a burst of messages. batch_size and
+    batch_bytes require batch_delay.
+
+    Messages queued for a session with no blocked GET may be bounded by
+    max_queued and max_queued_bytes; queue_overflow selects the Shuttle
+    overflow policy ('drop_oldest', 'reject' or 'wait').
+
+    Sessions idle for session_timeout seconds are closed, and when
+    max_sessions is set the least recently used session is closed to
+    make room for a new one. Closing a session fails its blocked GET
+    with a "session closed" error.
+
+    With session_db, the path of a SQLite file, each session's queued
+    messages and pending call ids are stored there, so a restarted
+    process (or another sharing the file) resumes the session when its
+    client next makes a request. The root object is recreated by calling
+    app_create_session again with the session's original params; it
+    must then return the object directly rather than a Deferred.
+
+    When one site is served by several processes, shard is this process'
+    thinserve.api.shard.Shard: new session ids name this process, and
+    requests for a sibling's sessions are proxied to that sibling, once
+    their bodies pass max_body_size.
     """
-    def __init__(self, app_create_session):
+    isLeaf = True
+
+    def __init__(self,
+                 app_create_session,
+                 clock=None,
+                 session_timeout=300,
+                 max_sessions=None,
+                 poll_timeout=30,
+                 batch_delay=None,
+                 batch_size=None,
+                 batch_bytes=None,
+                 max_queued=None,
+                 max_queued_bytes=None,
+                 queue_overflow='drop_oldest',
+                 pretty=False,
+                 codec=None,
+                 max_body_size=DefaultMaxBodySize,
+                 compress_level=6,
+                 compress_min_size=1024,
+                 parser=LazyParser,
+                 call_hooks=(),
+                 max_refs=None,
+                 call_timeout=None,
+                 max_pending_calls=None,
+                 max_running_calls=None,
+                 max_session_calls=None,
+                 max_queued_calls=None,
+                 call_order='fair',
+                 shard=None,
+                 session_db=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        if not isinstance(codec, protocodec.Codec):
+            codec = protocodec.get_codec(codec)
+
         self._app_create_session = app_create_session
-        self._sessions = {}
+        self._pretty = pretty
+        self._max_body_size = max_body_size
+        self._compresslevel = compress_level
+        self._compressminsize = compress_min_size
+        self._codec = codec
+        self._binarycodecs = dict(
+            (mediatype, protocodec.get_binary_codec(mediatype))
+            for mediatype in protocodec.MediaTypes)
+        self._parser = parser
+        self._callhooks = tuple(call_hooks)
+        self._maxrefs = max_refs
+        self._calltimeout = call_timeout
+        self._maxpendingcalls = max_pending_calls
+        if (max_running_calls, max_session_calls) == (None, None):
+            self._scheduler = None
+        else:
+            self._scheduler = scheduler.CallScheduler(
+                maxrunning=max_running_calls,
+                maxpersession=max_session_calls,
+                maxqueued=max_queued_calls,
+                order=call_order)
+        self._shard = shard
+        if batch_delay is None:
+            # Otherwise every create_session would fail:
+            assert batch_size is None and batch_bytes is None, \
+                'batch_size and batch_bytes require batch_delay.'
+        self._clock = clock
+        self._shuttleopts = dict(
+            polltimeout=poll_timeout,
+            batchdelay=batch_delay,
+            batchsize=batch_size,
+            batchbytes=batch_bytes,
+            maxqueued=max_queued,
+            maxqueuedbytes=max_queued_bytes,
+            overflow=queue_overflow)
+        if session_db is None:
+            self._sessions = sessiontable.SessionTable(
+                clock,
+                timeout=session_timeout,
+                maxsessions=max_sessions)
+        else:
+            self._sessions = sessiondb.SQLiteSessionTable(
+                session_db,
+                clock,
+                self._restore_session,
+                timeout=session_timeout,
+                maxsessions=max_sessions)
 
     def render(self, req):
+        proxy = None if self._shard is None else self._shard.route(req)
+        (incodec, outcodec) = self._negotiate_codecs(req)
+
         d = defer.Deferred()
         d.callback(None)
 
         @d.addCallback
         def process_method(_):
+            if proxy is not None:
+                return self._proxy(req, proxy)
+
             try:
                 handler = self._method_handlers[req.method]
             except KeyError:
                 raise error.UnsupportedHTTPMethod(method=req.method)
             else:
-                return handler(req)
+                return handler(req, incodec)
 
         @d.addCallback
         def response_ok(response):
-            req.setResponseCode(200)
+            if response is not _Streamed:
+                req.setResponseCode(200)
             return response
 
+        @d.addErrback
+        def client_disconnected(failure):
+            failure.trap(defer.CancelledError)
+            return _ClientDisconnected
+
         d.addErrback(error.InternalError.coerce_unexpected_failure)
 
         @d.addErrback
         def response_protocol_error(failure):
             failure.trap(error.ProtocolError)
-            req.setResponseCode(400)
+            error.ProtocolErrors.inc(failure.type.__name__)
+            req.setResponseCode(failure.value.HTTPStatus)
             return {'template': failure.type.Template,
                     'params': failure.value.params}
 
         @d.addCallback
         def send_response(response):
-            req.setHeader('Content-Type', 'application/json')
-            req.write(json.dumps(response, indent=2))
+            if response in (_ClientDisconnected, _Streamed):
+                return
+
+            req.setHeader('Content-Type', outcodec.ContentType)
+            out = self._response_writer(req)
+            with CodecSeconds.timer(outcodec.name, 'encode'):
+                if outcodec.Binary:
+                    out.write(outcodec.encode(response))
+                else:
+                    self._write_json(out, response)
+            out.close()
             req.finish()
 
+        @d.addErrback
+        def response_unencodable(failure):
+            # Such as a result with NaN; the request must still end:
+            failure.printTraceback()
+            error.ProtocolErrors.inc(error.InternalError.__name__)
+            if not req.startedWriting:
+                req.setResponseCode(error.InternalError.HTTPStatus)
+                req.responseHeaders.removeHeader('content-encoding')
+                req.write(outcodec.encode(
+                    error.InternalError().as_proto_object()))
+            if not req.finished:
+                req.finish()
+
         return server.NOT_DONE_YET
 
     _SessionIdBytes = 16  # 128 bits of entropy.
+    _WriteChunkBytes = 64 * 1024
     _method_handlers = FunctionTableProperty('_handle_')
 
     @_method_handlers.register
-    def _handle_GET(self, req):
-        # BUG: What if the client sends a giant body?
-        if req.content.read() != '':
+    def _handle_GET(self, req, codec):
+        if req.content.read(1) != '':
             raise error.UnexpectedHTTPBody()
+        elif len(req.postpath) == 2 and req.postpath[1] == 'events':
+            sid = req.postpath[0]
+            self._lookup_session(sid)
+            return _EventStream(self._sessions, sid, req, self._codec).start()
         else:
             s = self._get_session(req)
             if s is None:
                 raise error.UnsupportedHTTPMethod(method='GET')
             else:
-                return s.gather_outgoing_messages()
+                d = s.gather_outgoing_messages()
+                req.notifyFinish().addErrback(lambda _: d.cancel())
+                return d
 
     @_method_handlers.register
-    def _handle_POST(self, req):
-        mp = self._make_message_parser(req.content.read())
+    def _handle_POST(self, req, codec):
+        if codec is None:
+            raise error.UnsupportedMediaType(
+                mediatype=_media_type(req.getHeader('content-type')))
+
+        mp = self._make_message_parser(self._read_body(req), codec)
 
         s = self._get_session(req)
         if s is None:
             return mp.apply_variant(create_session=self._create_session)
+        elif mp.is_list():
+            errors = s.receive_messages(mp)
+            return {'errors': errors} if errors else "ok"
         else:
             s.receive_message(mp)
             return "ok"
 
+    def _write_json(self, req, obj):
+        if self._pretty:
+            req.write(self._codec.encode_pretty(obj))
+        elif isinstance(obj, list):
+            # Message batches are encoded and written a chunk at a time:
+            chunks = _iter_list_chunks(
+                obj,
+                self._codec.encode,
+                self._WriteChunkBytes)
+            for chunk in chunks:
+                req.write(chunk)
+        else:
+            req.write(self._codec.encode(obj))
+
+    def _proxy(self, req, proxy):
+        '''Forward req to the sibling which owns its session.
+
+        My body limit applies first: the sibling would otherwise wait for
+        the bytes ThinRequest dropped.
+        '''
+        body = self._read_raw_body(req)
+        # The proxy sends the body as read, so describe it that way:
+        req.requestHeaders.removeHeader('transfer-encoding')
+        req.requestHeaders.setRawHeaders('content-length', [str(len(body))])
+        proxy.render(req)
+        return _Streamed
+
+    def _read_body(self, req):
+        return compression.decompress(
+            self._read_raw_body(req),
+            req.getHeader('content-encoding'),
+            self._max_body_size)
+
+    def _read_raw_body(self, req):
+        limit = self._max_body_size
+
+        length = req.getHeader('content-length')
+        if length is not None:
+            try:
+                size = int(length)
+            except ValueError:
+                size = -1
+            if size < 0:
+                raise error.InvalidContentLength(length=length)
+            elif size > limit:
+                raise error.RequestBodyTooLarge(limit=limit)
+
+        # Content-Length may be absent (chunked) or wrong, so read at
+        # most one byte past the limit to detect an oversized body:
+        body = req.content.read(limit + 1)
+        if len(body) > limit:
+            raise error.RequestBodyTooLarge(limit=limit)
+        else:
+            return body
+
+    def _response_writer(self, req):
+        if self._compresslevel is None:
+            encoding = None
+        else:
+            req.setHeader('Vary', 'Accept-Encoding')
+            encoding = compression.choose_encoding(
+                req.getHeader('accept-encoding'))
+
+        return compression.ResponseWriter(
+            req,
+            encoding,
+            level=self._compresslevel,
+            minsize=self._compressminsize)
+
     def _get_session(self, req):
         if req.postpath == []:
             return None
@@ -118,6 +419,9 @@ class ThinAPIResource (resource.Resource):
         except ValueError:
             raise error.InvalidParameter(name='session')
 
+        return self._lookup_session(sessid)
+
+    def _lookup_session(self, sessid):
         try:
             return self._sessions[sessid]
         except KeyError:
@@ -129,16 +433,183 @@ class ThinAPIResource (resource.Resource):
         @d.addCallback
         def handle_app_instance(obj):
             sid = os.urandom(self._SessionIdBytes).encode("hex")
-            self._sessions[sid] = session.Session(obj)
+            if self._shard is not None:
+                sid = self._shard.qualify(sid)
+            self._sessions.add(sid, self._new_session(sid, obj), mp.raw())
             return {'session': sid}
 
         return d
 
-    @staticmethod
-    def _make_message_parser(text):
+    def _restore_session(self, sid, createparams):
+        obj = self._parser(createparams).apply_struct(
+            self._app_create_session)
+
+        if isinstance(obj, defer.Deferred):
+            return None
+        else:
+            return self._new_session(sid, obj)
+
+    def _new_session(self, sid, obj):
+        return session.Session(
+            obj,
+            clock=self._clock,
+            sid=sid,
+            callhooks=self._callhooks,
+            maxrefs=self._maxrefs,
+            calltimeout=self._calltimeout,
+            maxpendingcalls=self._maxpendingcalls,
+            scheduler=self._scheduler,
+            **self._shuttleopts)
+
+    def _negotiate_codecs(self, req):
+        '''Return the codecs of req's body and of its response.
+
+        The body's codec is None if it is a binary codec which is not
+        installed.
+        '''
+        incodec = self._codec
+        mediatype = _media_type(req.getHeader('content-type'))
+        if mediatype in self._binarycodecs:
+            incodec = self._binarycodecs[mediatype]
+
+        outcodec = incodec or self._codec
+        for mediatype in _accepted_media_types(req.getHeader('accept')):
+            if mediatype == self._codec.ContentType:
+                outcodec = self._codec
+                break
+            elif self._binarycodecs.get(mediatype) is not None:
+                outcodec = self._binarycodecs[mediatype]
+                break
+            elif mediatype == '*/*':
+                break
+
+        return (incodec, outcodec)
+
+    def _make_message_parser(self, text, codec):
+        with CodecSeconds.timer(codec.name, 'decode'):
+            return self._parser(codec.decode(text))
+
+
+class _EventStream (object):
+    '''I relay a session's outgoing messages to a Server-Sent Events stream.
+
+    Each batch is written as it is gathered, then I gather again. Looking
+    the session up for each gather keeps it from idling out while its
+    client is connected.
+
+    A newer gather for the session, such as a plain GET, takes over: I
+    finish the stream rather than gather back from it.
+    '''
+    def __init__(self, sessions, sid, req, codec):
+        self._sessions = sessions
+        self._sid = sid
+        self._req = req
+        self._codec = codec
+        self._gather = None
+        self._gathers = None
+        self._done = defer.Deferred()
+
+    def start(self):
+        '''Return a Deferred which fires with _Streamed when I end.'''
+        req = self._req
+        req.setResponseCode(200)
+        req.setHeader('Content-Type', 'text/event-stream')
+        req.setHeader('Cache-Control', 'no-cache')
+        # Send the headers now, so the client sees the stream open:
+        req.write(':\n\n')
+
+        req.notifyFinish().addErrback(self._disconnected)
+        self._next()
+        return self._done
+
+    # Private:
+    def _next(self):
         try:
-            jdoc = json.loads(text)
-        except ValueError:
-            raise error.MalformedJSON()
+            s = self._sessions[self._sid]
+        except KeyError:
+            self._end(error.InvalidParameter(name='session'))
+        else:
+            d = self._gather = s.gather_outgoing_messages()
+            self._gathers = s.gathers
+            d.addCallback(self._deliver, s)
+            d.addErrback(self._failed)
+
+    def _deliver(self, msgs, s):
+        self._gather = None
+        if msgs:
+            self._write_event(None, msgs)
+        elif s.gathers != self._gathers:
+            # Released by a newer gather:
+            self._req.finish()
+            self._done.callback(_Streamed)
+            return
         else:
-            return LazyParser(jdoc)
+            # Keep intermediaries from timing out the idle connection:
+            self._req.write(':\n\n')
+        self._next()
+
+    def _failed(self, f):
+        self._gather = None
+        if f.check(defer.CancelledError):
+            self._done.callback(_Streamed)
+        elif f.check(error.ProtocolError):
+            self._end(f.value)
+        else:
+            f.printTraceback()
+            self._end(error.InternalError())
+
+    def _disconnected(self, _):
+        if self._gather is not None:
+            self._gather.cancel()
+
+    def _end(self, e):
+        self._write_event('error', {'template': e.Template,
+                                    'params': e.params})
+        self._req.finish()
+        self._done.callback(_Streamed)
+
+    def _write_event(self, event, obj):
+        lines = [] if event is None else ['event: ' + event]
+        lines.extend(
+            'data: ' + line
+            for line in self._codec.encode(obj).split('\n'))
+        self._req.write('\n'.join(lines) + '\n\n')
+
+
+_ClientDisconnected = object()
+_Streamed = object()
+
+
+def _media_type(header):
+    return (header or '').split(';')[0].strip().lower()
+
+
+def _accepted_media_types(header):
+    '''Return the media types an Accept header allows, best first.'''
+    ranked = [
+        (-q, i, mediatype)
+        for (i, (mediatype, q)) in enumerate(compression.qvalues(header))
+        if q > 0]
+    return [mediatype for (_, _, mediatype) in sorted(ranked)]
+
+
+def _iter_list_chunks(items, encode, chunkbytes):
+    '''Yield the JSON encoding of items in chunks.'''
+    parts = []
+    size = 0
+    sep = '['
+    for item in items:
+        text = encode(item)
+        parts.append(sep)
+        parts.append(text)
+        size += len(text) + 1
+        sep = ','
+        if size >= chunkbytes:
+            yield ''.join(parts)
+            parts = []
+            size = 0
+
+    if sep == '[':
+        parts.append(sep)
+    parts.append(']')
+    yield ''.join(parts)
@@ -0,0 +1,417 @@
+"""
+Load-test a ThinSite over HTTP, as the thinserve-bench command.
+
+The server runs in its own process, so that its memory and CPU time are
+its own. Each simulated client creates a session, keeps one blocking GET
+open on it, and POSTs calls to the session's root object, pipeline at a
+time. A call's latency runs from sending its POST until its reply
+arrives on a GET, which is the delay an application sees.
+
+Calls sent during the warmup are not measured. Results are printed as
+one JSON object, so that runs against different releases compare
+mechanically.
+"""
+
+__all__ = ['EchoApp', 'main', 'percentile', 'run', 'summarize']
+
+
+import sys
+import json
+import time
+import signal
+import shutil
+import argparse
+import tempfile
+import subprocess
+from itertools import count
+from StringIO import StringIO
+from thinserve.api.referenceable import Referenceable
+from thinserve.util import import_object
+
+
+@Referenceable
+class EchoApp (object):
+    '''I am the default benchmark root: one method, doing nothing.'''
+    def __init__(self):
+        pass
+
+    @Referenceable.Method
+    def echo(self, value=None):
+        return None if value is None else value.unwrap()
+
+
+def run(app, clients=10, duration=10.0, warmup=1.0, method='echo',
+        params=None, pipeline=1, siteparams=None):
+    '''Benchmark a ThinSite of app; return the results as a dict.
+
+    app is a 'module:callable' session factory. siteparams are passed on
+    to ThinSite in the server process. I run the reactor, so I may be
+    called only once per process.
+    '''
+    from twisted.internet import reactor
+    from twisted.web.client import Agent, HTTPConnectionPool
+
+    server = _start_server(app, siteparams or {})
+    try:
+        pool = HTTPConnectionPool(reactor)
+        # A blocked GET and pipeline POSTs per client:
+        pool.maxPersistentPerHost = clients * (1 + pipeline)
+        agent = Agent(reactor, pool=pool)
+
+        stats = _Stats()
+        url = 'http://127.0.0.1:{}/api'.format(server.port)
+        sessions = [
+            _Client(agent, url, method, params or {}, pipeline, stats)
+            for _ in range(clients)]
+        rssstart = _memory(server.pid)
+
+        for client in sessions:
+            client.start()
+
+        reactor.callLater(warmup, stats.start)
+
+        def finish():
+            stats.stop()
+            for client in sessions:
+                client.stop()
+            reactor.stop()
+
+        reactor.callLater(warmup + duration, finish)
+        reactor.run()
+
+        results = stats.summarize()
+        results.update(
+            app=app,
+            clients=clients,
+            pipeline=pipeline,
+            method=method,
+            warmup=warmup,
+            server=dict(start=rssstart, end=_memory(server.pid)),
+            python=sys.version.split()[0])
+        return results
+    finally:
+        server.stop()
+
+
+def summarize(samples):
+    '''Return the count, mean, p50, p99, p999 and max of samples.'''
+    samples = sorted(samples)
+    summary = {'count': len(samples)}
+    if samples:
+        summary.update(
+            mean=sum(samples) / len(samples),
+            p50=percentile(samples, 50),
+            p99=percentile(samples, 99),
+            p999=percentile(samples, 99.9),
+            max=samples[-1])
+    return summary
+
+
+def percentile(ordered, p):
+    '''Return the nearest-rank p-th percentile of ordered samples.'''
+    assert ordered and 0 < p <= 100, (ordered, p)
+    rank = -(-len(ordered) * p // 100)  # Ceiling division.
+    return ordered[int(rank) - 1]
+
+
+def main(args=sys.argv[1:]):
+    opts = _parse_args(args)
+
+    if opts.serve is not None:
+        _run_server(opts.app, json.loads(opts.serve))
+        return
+
+    results = run(
+        opts.app,
+        clients=opts.clients,
+        duration=opts.duration,
+        warmup=opts.warmup,
+        method=opts.method,
+        params=json.loads(opts.params),
+        pipeline=opts.pipeline,
+        siteparams=json.loads(opts.site_params))
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if opts.output is None:
+        print text
+    else:
+        with open(opts.output, 'w') as f:
+            f.write(text + '\n')
+
+
+# Private:
+class _Stats (object):
+    '''I tally what clients measure while I am started.'''
+    def __init__(self):
+        self.recording = False
+        self._started = None
+        self._elapsed = None
+        self._latencies = []
+        self._creates = []
+        self._messages = 0
+        self._errors = 0
+
+    def start(self):
+        self.recording = True
+        self._started = time.time()
+
+    def stop(self):
+        if self.recording:
+            self.recording = False
+            self._elapsed = time.time() - self._started
+
+    def session_created(self, seconds):
+        # Each client creates its session once, at the start:
+        self._creates.append(seconds)
+
+    def replied(self, sent, now):
+        # Calls sent during the warmup are not measured:
+        if self.recording and sent >= self._started:
+            self._latencies.append(now - sent)
+
+    def received(self, messages):
+        if self.recording:
+            self._messages += messages
+
+    def failed(self):
+        self._errors += 1
+
+    def summarize(self):
+        '''Return my tallies; rates are None if I never recorded.'''
+        def rate(n):
+            return n / self._elapsed if self._elapsed else None
+
+        return {
+            'duration': self._elapsed,
+            'calls': len(self._latencies),
+            'errors': self._errors,
+            'calls_per_second': rate(len(self._latencies)),
+            'messages_per_second': rate(self._messages),
+            'latency_seconds': summarize(self._latencies),
+            'create_session_seconds': summarize(self._creates),
+        }
+
+
+class _Client (object):
+    '''I am one simulated client, with one session.
+
+    A failed call is counted and replaced by another; a failed GET is
+    counted and retried shortly.
+    '''
+    def __init__(self, agent, url, method, params, pipeline, stats):
+        self._agent = agent
+        self._url = url
+        self._method = method
+        self._params = params
+        self._pipeline = pipeline
+        self._stats = stats
+        self._sid = None
+        self._callids = count()
+        self._sent = {}  # {callid: time sent}
+        self._running = False
+
+    def start(self):
+        self._running = True
+        started = time.time()
+        d = self._request('POST', self._url, ['create_session', {}])
+
+        @d.addCallback
+        def created(response):
+            self._stats.session_created(time.time() - started)
+            self._sid = response['session']
+            self._poll()
+            for _ in range(self._pipeline):
+                self._call()
+
+        d.addErrback(self._failed)
+
+    def stop(self):
+        self._running = False
+
+    # Private:
+    def _call(self):
+        if not self._running:
+            return
+
+        callid = next(self._callids)
+        self._sent[callid] = time.time()
+        d = self._request(
+            'POST',
+            self._session_url(),
+            ['call', {'id': callid,
+                      'target': None,
+                      'method': [self._method, self._params]}])
+
+        @d.addCallback
+        def accepted(response):
+            if response != 'ok':
+                raise _UnexpectedResponse(response)
+
+        @d.addErrback
+        def failed(f):
+            # Its reply will never come, so free its place:
+            if self._running:
+                self._sent.pop(callid, None)
+                self._stats.failed()
+                self._call()
+
+    def _poll(self):
+        from twisted.internet import reactor
+
+        if not self._running:
+            return
+
+        d = self._request('GET', self._session_url())
+
+        @d.addCallback
+        def received(messages):
+            now = time.time()
+            self._stats.received(len(messages))
+            for (tag, body) in messages:
+                sent = self._sent.pop(body.get('id'), None)
+                if tag != 'reply' or sent is None:
+                    continue
+
+                if body['result'][0] == 'data':
+                    self._stats.replied(sent, now)
+                else:
+                    self._stats.failed()
+                self._call()
+
+            self._poll()
+
+        @d.addErrback
+        def failed(f):
+            if self._running:
+                self._stats.failed()
+                reactor.callLater(self._RetryDelay, self._poll)
+
+    def _session_url(self):
+        return '{}/{}'.format(self._url, self._sid)
+
+    def _request(self, method, url, body=None):
+        from twisted.web.client import FileBodyProducer, readBody
+        from twisted.web.http_headers import Headers
+
+        if body is None:
+            producer = None
+        else:
+            producer = FileBodyProducer(StringIO(json.dumps(body)))
+
+        d = self._agent.request(
+            method,
+            url,
+            Headers({'Content-Type': ['application/json']}),
+            producer)
+
+        @d.addCallback
+        def read(response):
+            if response.code != 200:
+                raise _UnexpectedResponse(response.code)
+            return readBody(response).addCallback(json.loads)
+
+        return d
+
+    def _failed(self, f):
+        # Requests cut off when the run ends are not errors:
+        if self._running:
+            self._stats.failed()
+
+    _RetryDelay = 0.1
+
+
+class _UnexpectedResponse (Exception):
+    pass
+
+
+class _Server (object):
+    '''I am a server process started by _start_server.'''
+    def __init__(self, proc, port):
+        self._proc = proc
+        self.pid = proc.pid
+        self.port = port
+
+    def stop(self):
+        if self._proc.poll() is None:
+            self._proc.send_signal(signal.SIGTERM)
+        self._proc.wait()
+
+
+def _start_server(app, siteparams):
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'thinserve.api.bench',
+         '--serve', json.dumps(siteparams),
+         '--app', app],
+        stdout=subprocess.PIPE)
+
+    # The server reports its port once it is listening:
+    line = proc.stdout.readline()
+    if not line:
+        proc.wait()
+        raise SystemExit('The benchmark server failed to start.')
+    return _Server(proc, int(line))
+
+
+def _run_server(app, siteparams):
+    from twisted.internet import reactor
+    from thinserve.api.site import ThinSite
+
+    staticdir = tempfile.mkdtemp()
+    try:
+        site = ThinSite(import_object(app), staticdir, **siteparams)
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        print port.getHost().port
+        sys.stdout.flush()
+        reactor.run()
+    finally:
+        shutil.rmtree(staticdir)
+
+
+def _memory(pid):
+    '''Return the RSS and peak RSS of pid, in bytes; None off Linux.'''
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            lines = f.readlines()
+    except IOError:
+        return None
+
+    fields = dict(line.split(':', 1) for line in lines if ':' in line)
+    (rss, peak) = [
+        int(fields[name].split()[0]) * 1024
+        for name in ['VmRSS', 'VmHWM']]
+    return {'rss_bytes': rss, 'peak_rss_bytes': peak}
+
+
+def _parse_args(args):
+    p = argparse.ArgumentParser(
+        description=(
+            'Measure how many sessions, calls and messages a ThinSite '
+            'sustains; print the results as JSON.'))
+
+    p.add_argument('--app', default='thinserve.api.bench:EchoApp',
+                   help='Session factory, as module:callable.')
+    p.add_argument('--method', default='echo',
+                   help='Root object method to call.')
+    p.add_argument('--params', default='{}',
+                   help='JSON object of call params.')
+    p.add_argument('--clients', type=int, default=10,
+                   help='Number of simulated clients.')
+    p.add_argument('--pipeline', type=int, default=1,
+                   help='Calls each client keeps outstanding.')
+    p.add_argument('--duration', type=float, default=10.0,
+                   help='Seconds to measure for, after the warmup.')
+    p.add_argument('--warmup', type=float, default=1.0,
+                   help='Seconds to run before measuring.')
+    p.add_argument('--site-params', default='{}',
+                   help='JSON object of ThinSite keyword arguments.')
+    p.add_argument('--output',
+                   help='File to write results to; default stdout.')
+
+    # Used to start the server process:
+    p.add_argument('--serve', help=argparse.SUPPRESS)
+
+    return p.parse_args(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Compression of API bodies, negotiated by Accept-Encoding for responses
+and declared by Content-Encoding for requests.
+"""
+
+__all__ = ['Encodings', 'ResponseWriter', 'accepts_encoding',
+           'choose_encoding', 'decompress', 'qvalues']
+
+
+import zlib
+from thinserve.proto import error
+from thinserve.proto.metrics import Metrics
+
+
+# zlib window bits of each encoding, in order of preference. HTTP's
+# "deflate" is the zlib format, not raw deflate:
+Encodings = [('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS)]
+
+CompressionBytes = Metrics.counter(
+    'thinserve_compression_bytes_total',
+    'Bytes of compressed responses, before and after compression.',
+    labels=['encoding', 'stage'])
+
+
+class ResponseWriter (object):
+    '''I write a response body to request, compressed with encoding.
+
+    Writes are buffered until minsize bytes arrive, so that a response
+    too small to gain from compression is sent as it is. With encoding
+    None, writes pass straight through.
+    '''
+    def __init__(self, request, encoding, level=6, minsize=1024):
+        self._request = request
+        self._encoding = encoding
+        self._level = level
+        self._minsize = minsize
+        self._buffer = []
+        self._buffered = 0
+        self._compressor = None
+
+    def write(self, data):
+        if self._encoding is None:
+            self._request.write(data)
+        elif self._compressor is not None:
+            self._write_compressed(data)
+        else:
+            self._buffer.append(data)
+            self._buffered += len(data)
+            if self._buffered >= self._minsize:
+                self._start_compressing()
+
+    def close(self):
+        '''Write whatever remains; the request is not finished.'''
+        if self._compressor is not None:
+            tail = self._compressor.flush()
+            CompressionBytes.add(len(tail), self._encoding, 'out')
+            self._request.write(tail)
+        elif self._buffer:
+            self._request.write(''.join(self._buffer))
+        self._buffer = []
+
+    # Private:
+    def _start_compressing(self):
+        self._request.setHeader('Content-Encoding', self._encoding)
+        self._compressor = zlib.compressobj(
+            self._level,
+            zlib.DEFLATED,
+            dict(Encodings)[self._encoding])
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._write_compressed(data)
+
+    def _write_compressed(self, data):
+        out = self._compressor.compress(data)
+        CompressionBytes.add(len(data), self._encoding, 'in')
+        CompressionBytes.add(len(out), self._encoding, 'out')
+        if out:
+            self._request.write(out)
+
+
+def choose_encoding(header):
+    '''Return the encoding an Accept-Encoding ranks highest, or None.
+
+    Ties go to the order of Encodings. None means identity, which also
+    wins if the client ranks it above every allowed encoding.
+    '''
+    allowed = dict(qvalues(header))
+    ranked = [
+        (-_qvalue(allowed, encoding), i, encoding)
+        for (i, (encoding, _)) in enumerate(Encodings)
+        if _qvalue(allowed, encoding) > 0]
+    if not ranked:
+        return None
+
+    (negq, _, encoding) = min(ranked)
+    if allowed.get('identity', 0) > -negq:
+        return None
+    else:
+        return encoding
+
+
+def accepts_encoding(header, encoding):
+    '''Whether an Accept-Encoding header value allows encoding.'''
+    return _qvalue(dict(qvalues(header)), encoding) > 0
+
+
+def qvalues(header):
+    '''Return [(token, q)...] from an Accept-style header, in order.'''
+    pairs = []
+    for item in (header or '').split(','):
+        parts = [p.strip() for p in item.split(';')]
+        q = 1.0
+        for p in parts[1:]:
+            if p.startswith('q='):
+                try:
+                    q = float(p[2:])
+                except ValueError:
+                    q = 0
+        pairs.append((parts[0].lower(), q))
+    return pairs
+
+
+def decompress(body, encoding, limit):
+    '''Return body decoded from its Content-Encoding.
+
+    At most limit decoded bytes are produced, so that a small body
+    cannot expand without bound; past that, RequestBodyTooLarge is
+    raised.
+    '''
+    if encoding is None or encoding.strip().lower() == 'identity':
+        return body
+
+    encoding = encoding.strip().lower()
+    wbits = dict(Encodings).get(encoding)
+    if wbits is None:
+        raise error.UnsupportedContentEncoding(encoding=encoding)
+
+    d = zlib.decompressobj(wbits)
+    try:
+        text = d.decompress(body, limit + 1)
+        if len(text) <= limit and not d.unconsumed_tail:
+            text += d.flush()
+    except zlib.error:
+        raise error.CorruptRequestBody(encoding=encoding)
+
+    if len(text) > limit or d.unconsumed_tail:
+        raise error.RequestBodyTooLarge(limit=limit)
+    elif d.unused_data:
+        raise error.CorruptRequestBody(encoding=encoding)
+    else:
+        return text
+
+
+# Private:
+def _qvalue(allowed, encoding):
+    return allowed.get(encoding, allowed.get('*', 0))
@@ -0,0 +1,11 @@
+from twisted.web import resource
+from thinserve.proto.metrics import Metrics
+
+
+class MetricsResource (resource.Resource):
+    '''I serve every thinserve metric in the Prometheus text format.'''
+    isLeaf = True
+
+    def render_GET(self, req):
+        req.setHeader('Content-Type', Metrics.ContentType)
+        return Metrics.render()
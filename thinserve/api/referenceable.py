@@ -6,7 +6,9 @@ __all__ = ['Referenceable']
 
 
 from types import MethodType
-from weakref import WeakKeyDictionary
+from thinserve.proto import schema as protoschema
+from thinserve.proto import signature
+from thinserve.proto.executors import Executors
 from thinserve.util import Singleton
 
 
@@ -15,36 +17,63 @@ class Referenceable (object):
     """I am a class and method decorator for referenceable types."""
     def __init__(self):
         self._classes = {}
-        self._instances = WeakKeyDictionary()
+        self._preparers = {}
+        self._executors = {}
         self._methodcache = {}
 
     # Application Interface:
     def __call__(self, cls):
         """Decorate a class; without this, it cannot be remotely referenced."""
         methodinfo = {}
+        preparers = {}
+        executors = {}
 
         for v in vars(cls).itervalues():
             try:
-                remotename = self._methodcache[v]
+                (remotename, spec, executor) = self._methodcache[v]
             except KeyError:
                 # It's not remotely accessible:
                 pass
             else:
                 methodinfo[remotename] = v
+                # Analyze parameters now, rather than on the first call:
+                signature.of_method(v)
+                preparers[remotename] = _make_preparer(cls, v, spec)
+                if executor is not None:
+                    executors[remotename] = executor
 
         self._classes[cls] = methodinfo
+        self._preparers[cls] = preparers
+        self._executors[cls] = executors
         self._methodcache.clear()
         return cls
 
-    def Method(self, f):
-        """Decorate a method; the class must be decorated."""
-        return self._register_method(f, f.__name__)
+    def Method(self, f=None, schema=None, executor=None):
+        """Decorate a method; the class must be decorated.
 
-    def Method_without_prefix(self, prefix):
+        Given a schema (see thinserve.proto.schema), use it as
+        @Referenceable.Method(schema={...}): calls are validated against
+        the schema before dispatch, and the method receives plain values
+        rather than LazyParsers.
+
+        A method which blocks or computes for long may name an executor,
+        'threads' or 'processes', to run in that pool of
+        thinserve.proto.executors.Executors instead of on the reactor.
+        Its params are still parsed on the reactor. Process methods need
+        a schema, so that they receive plain values.
+        """
+        if f is None:
+            return lambda f: self._register_method(
+                f, f.__name__, schema, executor)
+        else:
+            return self._register_method(f, f.__name__, schema, executor)
+
+    def Method_without_prefix(self, prefix, schema=None, executor=None):
         """Decorate a method, but drop prefix from the remote name."""
         def decorator(f):
             assert f.__name__.startswith(prefix), (f, prefix)
-            return self._register_method(f, f.__name__[len(prefix):])
+            return self._register_method(
+                f, f.__name__[len(prefix):], schema, executor)
         return decorator
 
     # Framework interface (private to apps):
@@ -53,18 +82,65 @@ class Referenceable (object):
 
     def _get_bound_methods(self, obj):
         cls = type(obj)
-        try:
-            return self._instances[obj]
-        except KeyError:
-            boundmethods = dict(
-                (name, MethodType(m, obj, cls))
-                for (name, m)
-                in self._classes[cls].iteritems()
-            )
-            self._instances[obj] = boundmethods
-            return boundmethods
+        return dict(
+            (name, MethodType(m, obj, cls))
+            for (name, m)
+            in self._classes[cls].iteritems()
+        )
+
+    def _get_dispatchers(self, obj):
+        """Return {name: f(paramsparser)} to apply as variant handlers."""
+        return dict(
+            (name, _make_dispatcher(prepare, run))
+            for (name, (prepare, run))
+            in self._get_preparers(obj).iteritems()
+        )
+
+    def _get_preparers(self, obj):
+        """Return {name: (prepare, run)} to dispatch in separate steps.
+
+        prepare(paramsparser) parses the params into keyword arguments
+        for run, which calls the bound method, or submits it to its
+        executor and returns a Deferred.
+
+        Only the per-class parts are cached; the results are built for
+        each call, so that caching never keeps obj alive.
+        """
+        cls = type(obj)
+        preparers = self._preparers[cls]
+        executors = self._executors[cls]
+        return dict(
+            (name,
+             (preparers[name],
+              _make_runner(MethodType(m, obj, cls), executors.get(name))))
+            for (name, m)
+            in self._classes[cls].iteritems()
+        )
 
     # Class Private:
-    def _register_method(self, f, name):
-        self._methodcache[f] = name
+    def _register_method(self, f, name, spec, executor):
+        assert executor in (None,) + Executors.Kinds, repr(executor)
+        assert executor != 'processes' or spec is not None, \
+            'Process methods need a schema: {!r}'.format(f)
+        self._methodcache[f] = (name, spec, executor)
         return f
+
+
+def _make_preparer(cls, f, spec):
+    if spec is None:
+        # Unbound, so that the cached preparer holds no instance:
+        m = MethodType(f, None, cls)
+        return lambda lp: lp.parse_struct(m)
+    else:
+        return protoschema.compile_method(f, spec)
+
+
+def _make_runner(m, executor):
+    if executor is None:
+        return m
+    else:
+        return lambda **kwargs: Executors.submit(executor, m, kwargs)
+
+
+def _make_dispatcher(prepare, run):
+    return lambda lp: run(**prepare(lp))
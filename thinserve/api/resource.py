@@ -1,24 +1,75 @@
 import os
+import json
 import pkg_resources
 from twisted.web import resource, static
-from thinserve.api import apiresource
+from thinserve.api import apiresource, metricsresource, staticresource
 
 
 class ThinResource (resource.Resource):
-    def __init__(self, apiroot, staticdir):
+    def __init__(self, apiroot, staticdir, metrics=True, fingerprint=True,
+                 **apiparams):
+        '''Serve the api, ts and metrics children, then staticdir.
+
+        With metrics=False, there is no metrics child. Metrics are still
+        recorded, since other resources in the process may serve them;
+        to stop recording them process-wide, set
+        thinserve.proto.metrics.Metrics.enabled to False.
+
+        Static files share one staticresource.AssetCache, into which the
+        small ones are loaded now.
+
+        With fingerprint, every file in staticdir is also served, as
+        immutable, under a name with a hash of its contents; see
+        staticresource.AssetManifest. self.manifest maps names to
+        fingerprinted names, and is served as ts/manifest.json.
+        '''
         resource.Resource.__init__(self)
 
-        self.putChild('api', apiresource.ThinAPIResource(apiroot))
+        cache = staticresource.AssetCache()
+        tsdir = pkg_resources.resource_filename('thinserve', 'web/static')
+
+        if fingerprint:
+            self.manifest = staticresource.AssetManifest(staticdir, cache)
+        else:
+            self.manifest = None
+
+        self._staticdir = staticdir
+        self._staticroot = staticresource.StaticFile(
+            staticdir, cache=cache, manifest=self.manifest)
+
         self.putChild(
-            'ts',
-            static.File(
-                pkg_resources.resource_filename('thinserve', 'web/static'),
-            ),
-        )
+            'api',
+            apiresource.ThinAPIResource(apiroot, **apiparams))
+
+        ts = staticresource.StaticFile(tsdir, cache=cache)
+        if self.manifest is not None:
+            ts.putChild(
+                'manifest.json',
+                static.Data(
+                    json.dumps(self.manifest.as_dict(), sort_keys=True),
+                    'application/json'))
+        self.putChild('ts', ts)
+
+        if metrics:
+            self.putChild('metrics', metricsresource.MetricsResource())
 
         for name in os.listdir(staticdir):
-            assert name not in ['api', 'ts'], \
+            assert name not in ['api', 'ts', 'metrics'], \
                 'Reserved name: {!r}'.format(name)
 
             childpath = os.path.join(staticdir, name)
-            self.putChild(name, static.File(childpath))
+            self.putChild(
+                name,
+                staticresource.StaticFile(
+                    childpath, cache=cache, manifest=self.manifest))
+
+        for path in [tsdir, staticdir]:
+            cache.preload(path)
+
+    def getChild(self, name, request):
+        f = self._staticroot.fingerprinted(
+            os.path.join(self._staticdir, name))
+        if f is None:
+            return resource.Resource.getChild(self, name, request)
+        else:
+            return f
@@ -0,0 +1,201 @@
+"""
+Serve one ThinSite from several worker processes on one machine.
+
+The supervisor binds the public listening socket, plus one loopback
+socket per worker, then starts each worker as a fresh interpreter which
+inherits those file descriptors. Every worker accepts connections on the
+shared public socket, so the kernel spreads clients across them.
+
+Sessions live in the worker which created them, and session ids carry
+that worker's index. A worker receiving a request for a sibling's
+session proxies it to the sibling's loopback port.
+
+Workers are fresh interpreters rather than bare forks because importing
+twisted.web installs the reactor, which must not be shared across a
+fork. So ThinSite options reach them either as JSON, or from a
+'module:callable' config which each worker calls for the options JSON
+cannot carry, such as call hooks or a codec object.
+"""
+
+__all__ = ['Shard', 'serve', 'main']
+
+
+import os
+import sys
+import json
+import signal
+import socket
+import argparse
+import subprocess
+from thinserve.util import import_object
+
+
+class Shard (object):
+    '''I describe one worker among its siblings, for ThinAPIResource.'''
+    def __init__(self, index, ports, host='127.0.0.1'):
+        assert 0 <= index < len(ports), (index, ports)
+        self.index = index
+        self._ports = ports
+        self._host = host
+
+    def qualify(self, sid):
+        '''Mark a new session id as owned by this worker.'''
+        return '{:x}-{}'.format(self.index, sid)
+
+    def route(self, req):
+        '''Return a proxy for a sibling's session request, or None.'''
+        if not req.postpath:
+            return None
+
+        (owner, sep, _) = req.postpath[0].partition('-')
+        try:
+            owner = int(owner, 16)
+        except ValueError:
+            return None
+
+        if not sep or owner == self.index or owner >= len(self._ports):
+            return None
+        else:
+            from twisted.web import proxy
+
+            return proxy.ReverseProxyResource(
+                self._host,
+                self._ports[owner],
+                req.path)
+
+
+def serve(app, staticdir, port, workers, interface='', siteparams=None,
+          siteconfig=None):
+    '''Run workers serving app, a 'module:callable' session factory.
+
+    Each worker passes siteparams, a JSON-able dict, on to ThinSite, plus
+    the dict which siteconfig, a 'module:callable', returns. Return the
+    exit status once a worker exits or a signal arrives.
+    '''
+    public = _listen(interface, port)
+    privates = [_listen('127.0.0.1', 0) for _ in range(workers)]
+    ports = [s.getsockname()[1] for s in privates]
+
+    children = []
+    for (index, private) in enumerate(privates):
+        children.append(
+            subprocess.Popen(
+                [sys.executable, '-m', 'thinserve.api.shard',
+                 '--worker-index', str(index),
+                 '--worker-fds', '{},{}'.format(
+                     public.fileno(), private.fileno()),
+                 '--worker-ports', ','.join(map(str, ports)),
+                 '--site-params', json.dumps(siteparams or {})] +
+                ([] if siteconfig is None else
+                 ['--site-config', siteconfig]) +
+                [app, staticdir],
+                close_fds=False))
+
+    for s in [public] + privates:
+        s.close()
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        # A dead worker strands its sessions, so stop serving entirely:
+        os.wait()
+        return 1
+    except SystemExit as e:
+        return e.code
+    finally:
+        for child in children:
+            if child.poll() is None:
+                child.terminate()
+        for child in children:
+            child.wait()
+
+
+def main(args=sys.argv[1:]):
+    opts = _parse_args(args)
+
+    if opts.worker_index is None:
+        raise SystemExit(
+            serve(
+                opts.APP,
+                opts.STATICDIR,
+                opts.port,
+                opts.workers,
+                opts.interface,
+                json.loads(opts.site_params),
+                opts.site_config))
+    else:
+        _run_worker(opts)
+
+
+# Private:
+def _listen(interface, port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((interface, port))
+    s.listen(socket.SOMAXCONN)
+    s.setblocking(False)
+    return s
+
+
+def _run_worker(opts):
+    from twisted.internet import reactor
+    from twisted.python import log
+    from thinserve.api.site import ThinSite
+
+    log.startLogging(sys.stderr)
+
+    (publicfd, privatefd) = map(int, opts.worker_fds.split(','))
+    ports = map(int, opts.worker_ports.split(','))
+
+    siteparams = json.loads(opts.site_params)
+    if opts.site_config is not None:
+        siteparams.update(import_object(opts.site_config)())
+
+    site = ThinSite(
+        import_object(opts.APP),
+        opts.STATICDIR,
+        shard=Shard(opts.worker_index, ports),
+        **siteparams)
+
+    for fd in [publicfd, privatefd]:
+        reactor.adoptStreamPort(fd, socket.AF_INET, site)
+        # The reactor listens on a duplicate:
+        os.close(fd)
+
+    reactor.run()
+
+
+def _parse_args(args):
+    p = argparse.ArgumentParser(
+        description='Serve a thinserve app from several processes.')
+
+    p.add_argument('--workers', type=int, default=2,
+                   help='Number of worker processes.')
+    p.add_argument('--port', type=int, default=8080,
+                   help='Public TCP port.')
+    p.add_argument('--interface', default='',
+                   help='Public interface address; default all.')
+    p.add_argument('--site-params', default='{}',
+                   help='JSON object of ThinSite keyword arguments.')
+    p.add_argument('--site-config',
+                   help=('More ThinSite keyword arguments, as a '
+                         'module:callable returning a dict.'))
+    p.add_argument('APP',
+                   help='Session factory, as module:callable.')
+    p.add_argument('STATICDIR',
+                   help='Directory of static files to serve.')
+
+    # Used by the supervisor to start workers:
+    p.add_argument('--worker-index', type=int, help=argparse.SUPPRESS)
+    p.add_argument('--worker-fds', help=argparse.SUPPRESS)
+    p.add_argument('--worker-ports', help=argparse.SUPPRESS)
+
+    return p.parse_args(args)
+
+
+if __name__ == '__main__':
+    main()
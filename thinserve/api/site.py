@@ -1,14 +1,41 @@
 from twisted import internet
 from twisted.internet import endpoints
 from twisted.web import server
-from thinserve.api import resource
+from thinserve.api import apiresource, resource
+
+
+class ThinRequest (server.Request):
+    '''I stop buffering a request body one byte past the site's limit.
+
+    The resource sees the truncated body (or the Content-Length header)
+    and rejects the request, so a giant body costs bandwidth but at most
+    the limit in memory, or on disk where twisted spills a large body to
+    a temporary file.
+    '''
+    def gotLength(self, length):
+        server.Request.gotLength(self, length)
+        self._bodyroom = self.channel.site.max_body_size + 1
+
+    def handleContentChunk(self, data):
+        if self._bodyroom > 0:
+            data = data[:self._bodyroom]
+            self._bodyroom -= len(data)
+            server.Request.handleContentChunk(self, data)
 
 
 class ThinSite (server.Site):
     displayTracebacks = False
+    requestFactory = ThinRequest
+
+    def __init__(self, apiroot, staticdir, **apiparams):
+        '''apiparams are passed on to ThinAPIResource, such as codec.'''
+        server.Site.__init__(
+            self,
+            resource.ThinResource(apiroot, staticdir, **apiparams))
 
-    def __init__(self, apiroot, staticdir):
-        server.Site.__init__(self, resource.ThinResource(apiroot, staticdir))
+        self.max_body_size = apiparams.get(
+            'max_body_size',
+            apiresource.DefaultMaxBodySize)
 
     def listen(self, port):
         ep = endpoints.serverFromString(
@@ -0,0 +1,351 @@
+"""
+Static files, served with as little filesystem work per request as we can.
+"""
+
+__all__ = ['AssetCache', 'AssetManifest', 'StaticFile']
+
+
+import os
+import stat
+import hashlib
+import posixpath
+from collections import OrderedDict
+from twisted.web import http, static
+from thinserve.api import compression
+
+
+class AssetCache (object):
+    '''I remember what StaticFiles learn about the files they serve.
+
+    For each path I keep its ETag, and the contents of files up to
+    maxsize bytes, up to maxbytes in all (least recently used contents
+    are dropped first). A path is stat'ed again only once recheck
+    seconds have passed on clock, so a busy file costs no filesystem
+    calls at all in between; missing files are remembered likewise.
+
+    ETags of cached files hash their contents. Larger files are tagged
+    by size, modification time and inode instead, so that tagging them
+    never reads them.
+
+    The content digests I keep for AssetManifest come free for cached
+    files; larger files are hashed once per change, when asked.
+    '''
+    def __init__(self, clock=None, maxsize=2 ** 18, maxbytes=2 ** 25,
+                 recheck=1.0):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self._clock = clock
+        self._maxsize = maxsize
+        self._maxbytes = maxbytes
+        self._recheck = recheck
+        self._assets = {}  # {path: (checked, stat key or None, etag)}
+        self._contents = OrderedDict()  # {path: body}, in LRU order.
+        self._cachedbytes = 0
+        self._digests = {}  # {path: (stat key, sha1 hex digest)}
+
+    def get(self, path):
+        '''Return (etag, mtime, body); body is None if it is not cached.
+
+        Return None if path is not a regular file.
+        '''
+        now = self._clock.seconds()
+        asset = self._assets.get(path)
+        if asset is None or asset[0] + self._recheck <= now:
+            asset = self._assets[path] = self._check(path, now, asset)
+
+        (_, key, etag) = asset
+        if key is None:
+            return None
+
+        body = self._contents.pop(path, None)
+        if body is not None:
+            self._contents[path] = body
+        return (etag, key[1], body)
+
+    def digest(self, path):
+        '''Return the SHA-1 hex digest of path's contents, or None.
+
+        Return None if path is not a regular readable file.
+        '''
+        if self.get(path) is None:
+            return None
+
+        key = self._assets[path][1]
+        known = self._digests.get(path)
+        if known is None or known[0] != key:
+            try:
+                known = self._digests[path] = (key, _hash_file(path))
+            except IOError:
+                return None
+        return known[1]
+
+    def preload(self, top):
+        '''Load every small file beneath the directory top.'''
+        for (dirpath, _, filenames) in os.walk(top):
+            for name in filenames:
+                self.get(os.path.join(dirpath, name))
+
+    # Private:
+    def _check(self, path, now, asset):
+        try:
+            st = os.stat(path)
+        except OSError:
+            key = None
+        else:
+            if stat.S_ISREG(st.st_mode):
+                key = (st.st_size, st.st_mtime, st.st_ino)
+            else:
+                key = None
+
+        if asset is not None and asset[1] == key:
+            return (now, key, asset[2])
+
+        self._forget_contents(path)
+        self._digests.pop(path, None)
+        if key is None:
+            return (now, None, None)
+
+        (size, mtime, ino) = key
+        body = None
+        if size <= self._maxsize:
+            try:
+                with open(path, 'rb') as f:
+                    body = f.read()
+            except IOError:
+                # Such as EACCES; let static.File report it:
+                pass
+
+        if body is None:
+            etag = '"{:x}-{:x}-{:x}"'.format(size, int(mtime * 1e6), ino)
+        else:
+            digest = hashlib.sha1(body).hexdigest()
+            self._digests[path] = (key, digest)
+            etag = '"{}"'.format(digest[:20])
+            self._remember_contents(path, body)
+
+        return (now, key, etag)
+
+    def _remember_contents(self, path, body):
+        self._contents[path] = body
+        self._cachedbytes += len(body)
+        while self._cachedbytes > self._maxbytes:
+            (_, dropped) = self._contents.popitem(last=False)
+            self._cachedbytes -= len(dropped)
+
+    def _forget_contents(self, path):
+        body = self._contents.pop(path, None)
+        if body is not None:
+            self._cachedbytes -= len(body)
+
+
+class AssetManifest (object):
+    '''I name each file beneath staticdir by a hash of its contents.
+
+    The fingerprinted name of js/app.js is js/app.<hash>.js. Since its
+    contents can never change, it may be cached by browsers forever.
+    Precompressed siblings (see StaticFile) are not named themselves,
+    but are served in place of their fingerprinted file as usual.
+
+    Files are named once, when I am made, with digests from cache, an
+    AssetCache. Files added afterwards have no names, and a file changed
+    afterwards is no longer found under its old name, rather than be
+    served as immutable with the wrong contents.
+    '''
+    def __init__(self, staticdir, cache=None):
+        self._cache = AssetCache() if cache is None else cache
+        self._names = {}  # {relpath: fingerprinted relpath}
+        self._paths = {}  # {fingerprinted path: (path, digest)}
+
+        for (dirpath, _, filenames) in os.walk(staticdir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if _is_precompressed(path):
+                    continue
+
+                digest = self._cache.digest(path)
+                if digest is None:
+                    continue
+
+                fpname = _fingerprint(name, digest)
+                relpath = os.path.relpath(path, staticdir)
+                self._names[_urlpath(relpath)] = _urlpath(
+                    os.path.join(os.path.dirname(relpath), fpname))
+                self._paths[os.path.join(dirpath, fpname)] = (path, digest)
+
+    def url(self, relpath):
+        '''Return the absolute URL path of staticdir's file relpath.
+
+        relpath is '/' separated, such as 'js/app.js'.
+        '''
+        return '/' + self._names[relpath]
+
+    def as_dict(self):
+        '''Return {relpath: fingerprinted relpath} for every file.'''
+        return dict(self._names)
+
+    def resolve(self, path):
+        '''Return the file named by a fingerprinted path, or None.
+
+        Return None as well if the file has changed since it was named.
+        '''
+        entry = self._paths.get(path)
+        if entry is None:
+            return None
+
+        (realpath, digest) = entry
+        if self._cache.digest(realpath) == digest:
+            return realpath
+        else:
+            return None
+
+
+class StaticFile (static.File):
+    '''I am a static.File which serves through an AssetCache.
+
+    Each response carries an ETag, and a matching If-None-Match is
+    answered with 304 Not Modified. When Accept-Encoding allows it, a
+    precompressed sibling (foo.js.br or foo.js.gz beside foo.js) is
+    served in place of the file. Cached files are served from memory;
+    others are streamed in bulk reads of BulkBufferSize bytes.
+
+    Given an AssetManifest, a directory also serves its files under
+    their fingerprinted names, as immutable.
+    '''
+    contentEncodings = dict(static.File.contentEncodings, **{'.br': 'br'})
+
+    # In order of preference:
+    Precompressed = [('br', '.br'), ('gzip', '.gz')]
+
+    BulkBufferSize = 2 ** 18
+
+    ImmutableCacheControl = 'public, max-age=31536000, immutable'
+
+    def __init__(self, path, defaultType='text/html', ignoredExts=(),
+                 registry=None, cache=None, manifest=None, immutable=False):
+        static.File.__init__(self, path, defaultType, ignoredExts, registry)
+        self._cache = AssetCache() if cache is None else cache
+        self._manifest = manifest
+        self.immutable = immutable
+
+    def createSimilarFile(self, path):
+        f = static.File.createSimilarFile(self, path)
+        f._cache = self._cache
+        f._manifest = self._manifest
+        return f
+
+    def getChild(self, path, request):
+        f = self.fingerprinted(os.path.join(self.path, path))
+        if f is None:
+            return static.File.getChild(self, path, request)
+        else:
+            return f
+
+    def fingerprinted(self, path):
+        '''Return an immutable StaticFile for a fingerprinted path.
+
+        Return None if path is not a fingerprinted name.
+        '''
+        realpath = None
+        if self._manifest is not None:
+            realpath = self._manifest.resolve(path)
+
+        if realpath is None:
+            return None
+        else:
+            f = self.createSimilarFile(realpath)
+            f.immutable = True
+            return f
+
+    def render_GET(self, request):
+        asset = self._cache.get(self.path)
+        if asset is None:
+            # Directories, missing files and the like:
+            return static.File.render_GET(self, request)
+
+        if self.immutable:
+            request.setHeader('cache-control', self.ImmutableCacheControl)
+        request.setHeader('vary', 'accept-encoding')
+        (path, (etag, mtime, body)) = self._choose_variant(request, asset)
+        request.setHeader('etag', etag)
+
+        if _etag_matches(request.getHeader('if-none-match'), etag):
+            request.setResponseCode(http.NOT_MODIFIED)
+            return ''
+
+        variant = self if path == self.path else self.createSimilarFile(path)
+        if body is None or request.getHeader('range') is not None:
+            return static.File.render_GET(variant, request)
+        else:
+            return variant._render_cached(request, mtime, body)
+
+    render_HEAD = render_GET
+
+    def makeProducer(self, request, fileForReading):
+        producer = static.File.makeProducer(self, request, fileForReading)
+        producer.bufferSize = self.BulkBufferSize
+        return producer
+
+    # Private:
+    def _choose_variant(self, request, asset):
+        header = request.getHeader('accept-encoding')
+        for (encoding, ext) in self.Precompressed:
+            if compression.accepts_encoding(header, encoding):
+                sibling = self._cache.get(self.path + ext)
+                if sibling is not None:
+                    return (self.path + ext, sibling)
+        return (self.path, asset)
+
+    def _render_cached(self, request, mtime, body):
+        (self.type, self.encoding) = static.getTypeAndEncoding(
+            self.basename(),
+            self.contentTypes,
+            self.contentEncodings,
+            self.defaultType)
+
+        if request.setLastModified(mtime) is http.CACHED:
+            return ''
+
+        self._setContentHeaders(request, len(body))
+        request.setResponseCode(http.OK)
+        if request.method == 'HEAD':
+            return ''
+        else:
+            return body
+
+
+def _is_precompressed(path):
+    (base, ext) = os.path.splitext(path)
+    return (ext in [e for (_, e) in StaticFile.Precompressed]
+            and os.path.isfile(base))
+
+
+def _fingerprint(name, digest):
+    (base, ext) = os.path.splitext(name)
+    return '{}.{}{}'.format(base, digest[:16], ext)
+
+
+def _hash_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 16), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _urlpath(relpath):
+    return posixpath.normpath(relpath.replace(os.sep, '/'))
+
+
+def _etag_matches(header, etag):
+    if header is None:
+        return False
+
+    for tag in header.split(','):
+        tag = tag.strip()
+        # If-None-Match uses the weak comparison:
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag in ('*', etag):
+            return True
+    return False
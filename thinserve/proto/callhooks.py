@@ -0,0 +1,92 @@
+"""
+Hooks around remote method calls, for profilers and tracers.
+
+Pass hooks to ThinAPIResource as call_hooks. When there are none, calls
+take the plain dispatch path and pay nothing.
+"""
+
+__all__ = ['CallInfo', 'CallHook', 'SamplingProfiler']
+
+
+import json
+import cProfile
+import pstats
+
+
+class CallInfo (object):
+    '''I describe one call from a client to a remote method.
+
+    sid and target are known from the start. method is set at dispatch,
+    and parse_seconds once its params are prepared. exec_seconds covers
+    the method and any Deferred it returns. failed and result, the
+    exported result or error, are set with the reply.
+
+    Hooks may keep their own per-call state in extra attributes.
+    '''
+    def __init__(self, sid, target):
+        self.sid = sid
+        self.target = target
+        self.method = None
+        self.parse_seconds = None
+        self.exec_seconds = None
+        self.failed = None
+        self.result = None
+
+    @property
+    def result_size(self):
+        '''The length of result as compact JSON, or None.
+
+        It is measured only when asked for, and is an estimate for other
+        codecs. A result JSON cannot encode has no size.
+        '''
+        try:
+            return len(json.dumps(self.result, separators=(',', ':')))
+        except (TypeError, ValueError):
+            return None
+
+
+class CallHook (object):
+    '''I am notified around each dispatched call; override what you need.
+
+    Calls which fail before reaching a method, such as calls to unknown
+    methods or with malformed params, are not seen by hooks. Hooks must
+    not raise.
+    '''
+    def call_started(self, info):
+        '''The method is about to run.'''
+
+    def call_returned(self, info):
+        '''The method returned, though a Deferred result may be pending.'''
+
+    def call_finished(self, info):
+        '''The reply is queued, and info is complete.'''
+
+
+class SamplingProfiler (CallHook):
+    '''I profile every Nth call, calling report(info, stats) for each.
+
+    N is every, so every=1 profiles each call.
+
+    stats is a pstats.Stats for the synchronous part of the method.
+    '''
+    def __init__(self, every, report):
+        assert every > 0, every
+        self._every = every
+        self._report = report
+        self._count = 0
+
+    def call_started(self, info):
+        self._count += 1
+        if self._count % self._every == 0:
+            info.profile = cProfile.Profile()
+            info.profile.enable()
+
+    def call_returned(self, info):
+        profile = getattr(info, 'profile', None)
+        if profile is not None:
+            profile.disable()
+
+    def call_finished(self, info):
+        profile = getattr(info, 'profile', None)
+        if profile is not None:
+            self._report(info, pstats.Stats(profile))
@@ -0,0 +1,234 @@
+"""
+JSON codec backends, and binary codecs with JSON's data model.
+
+Every JSON backend must decode exactly the documents the standard
+library decodes in strict mode, into the same Python values, and must
+map every decoding failure to MalformedJSON. Numbers which overflow to
+infinity are malformed, and encoders refuse NaN and infinities, so that
+nothing is sent which strict JSON cannot carry. ujson is deliberately
+absent: it accepts trailing commas and leading zeros, and rejects large
+integers. So is orjson, which does not support Python 2.
+
+A binary codec must decode into the values a JSON backend would: None,
+bools, finite numbers, unicode strings, lists, and dicts with unicode
+keys.
+Anything else, such as binary strings or extension types, is a
+MalformedDocument, so parsers see the same messages either way.
+msgpack cannot encode integers beyond 64 bits, which JSON can.
+"""
+
+__all__ = ['BinaryCodec', 'Codec', 'get_binary_codec', 'get_codec',
+           'available_codecs', 'MediaTypes']
+
+
+from math import isinf, isnan
+from functable import FunctionTable
+from thinserve.proto import error
+
+
+class Codec (object):
+    '''I encode and decode protocol documents with one JSON backend.'''
+
+    ContentType = 'application/json'
+    Binary = False
+
+    def __init__(self, name, loads, encode, encode_pretty,
+                 errors=(ValueError, OverflowError)):
+        self.name = name
+        self._loads = loads
+        self._errors = errors
+        self.encode = encode
+        self.encode_pretty = encode_pretty
+
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, self.name)
+
+    def decode(self, text):
+        try:
+            return self._loads(text)
+        except self._errors:
+            raise self._malformed()
+
+    # Private:
+    def _malformed(self):
+        return error.MalformedJSON()
+
+
+class BinaryCodec (Codec):
+    '''I encode and decode protocol documents in a binary format.
+
+    Pretty encoding is the same as compact encoding.
+    '''
+    Binary = True
+
+    def __init__(self, name, contenttype, loads, encode, errors):
+        Codec.__init__(self, name, loads, encode, encode, errors)
+        self.ContentType = contenttype
+
+    def decode(self, data):
+        obj = Codec.decode(self, data)
+        if _has_json_model(obj):
+            return obj
+        else:
+            raise self._malformed()
+
+    # Private:
+    def _malformed(self):
+        return error.MalformedDocument(format=self.name)
+
+
+# Fastest first:
+Preference = ['simplejson', 'json']
+
+# Binary codecs, by the media types which select them:
+MediaTypes = {
+    'application/msgpack': 'msgpack',
+    'application/x-msgpack': 'msgpack',
+}
+
+
+def get_codec(name=None):
+    '''Return the named codec, or the most preferred installed codec.
+
+    Asking for a codec by name raises ImportError if its backend is not
+    installed.
+    '''
+    if name is not None:
+        return _backends[name]()
+
+    for name in Preference:
+        try:
+            return _backends[name]()
+        except ImportError:
+            pass
+
+    assert False, 'The stdlib json codec is always available.'
+
+
+def get_binary_codec(mediatype):
+    '''Return the binary codec for mediatype, or None if not installed.
+
+    mediatype must be a key of MediaTypes.
+    '''
+    try:
+        return _backends[MediaTypes[mediatype]]()
+    except ImportError:
+        return None
+
+
+def available_codecs():
+    '''Return the names of installed backends in order of preference.'''
+    names = []
+    for name in Preference:
+        try:
+            _backends[name]()
+        except ImportError:
+            pass
+        else:
+            names.append(name)
+    return names
+
+
+_backends = FunctionTable('_make_')
+
+
+@_backends.register
+def _make_simplejson():
+    import simplejson
+
+    def loads(text):
+        # Given a str, simplejson returns str for ASCII-only strings, but
+        # the other backends always return unicode:
+        return simplejson.loads(
+            text.decode('utf-8'),
+            allow_nan=False,
+            parse_float=_parse_finite_float)
+
+    return Codec(
+        'simplejson',
+        loads,
+        simplejson.JSONEncoder(
+            separators=(',', ':'),
+            allow_nan=False).encode,
+        simplejson.JSONEncoder(
+            indent=2,
+            separators=(',', ': '),
+            allow_nan=False).encode)
+
+
+@_backends.register
+def _make_json():
+    import json
+
+    def reject_constant(name):
+        raise ValueError('non-standard JSON constant {}'.format(name))
+
+    return Codec(
+        'json',
+        json.JSONDecoder(
+            parse_constant=reject_constant,
+            parse_float=_parse_finite_float).decode,
+        json.JSONEncoder(
+            separators=(',', ':'),
+            allow_nan=False).encode,
+        json.JSONEncoder(
+            indent=2,
+            separators=(',', ': '),
+            allow_nan=False).encode)
+
+
+@_backends.register
+def _make_msgpack():
+    import msgpack
+
+    def reject_ext(code, data):
+        raise ValueError('msgpack extension type {}'.format(code))
+
+    def loads(data):
+        return msgpack.unpackb(
+            data,
+            raw=False,
+            use_list=True,
+            ext_hook=reject_ext)
+
+    def encode(obj):
+        # Without use_bin_type, str and unicode both pack as strings:
+        return msgpack.packb(obj, use_bin_type=False)
+
+    return BinaryCodec(
+        'msgpack',
+        'application/msgpack',
+        loads,
+        encode,
+        (ValueError, TypeError, OverflowError,
+         msgpack.exceptions.UnpackException))
+
+
+def _parse_finite_float(text):
+    v = float(text)
+    if isinf(v):
+        raise ValueError('number out of range: {}'.format(text))
+    return v
+
+
+_JSONScalars = (type(None), bool, int, long, float, unicode)
+
+
+def _has_json_model(obj):
+    # Iterative, so that deep nesting cannot exhaust the stack:
+    stack = [obj]
+    while stack:
+        v = stack.pop()
+        if isinstance(v, list):
+            stack.extend(v)
+        elif isinstance(v, dict):
+            for k in v:
+                if not isinstance(k, unicode):
+                    return False
+            stack.extend(v.itervalues())
+        elif not isinstance(v, _JSONScalars):
+            return False
+        elif isinstance(v, float) and (isnan(v) or isinf(v)):
+            # Strict JSON has no NaN or infinities:
+            return False
+    return True
@@ -0,0 +1,132 @@
+__all__ = ['DecodeFailure', 'EagerParser', 'decode']
+
+
+from thinserve.proto import error
+from thinserve.proto.lazyparser import LazyParser, _IdentifierRgx
+
+
+class EagerParser (LazyParser):
+    '''I am a LazyParser which decodes the whole message in one pass.
+
+    On first use the entire message is validated and decoded into plain
+    values: lists, (tag, value) tuples for variants, and dicts. Children
+    handed out by the LazyParser interface share that decoding, so
+    nothing is validated twice, unwrap() is free, and error paths are
+    only built when something fails.
+
+    Unlike LazyParser, a malformed part of the message is reported even
+    if the application never looks at that part.
+    '''
+    def __init__(self, msg, _path='', _value=None, _parent=None, _seg=None):
+        self._m = msg
+        self._basepath = _path
+        self._v = _Undecoded if _parent is None else _value
+        self._parent = _parent
+        self._seg = _seg
+
+    @property
+    def _path(self):
+        if self._parent is None:
+            return self._basepath
+        else:
+            (tmpl, key) = self._seg
+            return ('{}' + tmpl).format(self._parent._path, key)
+
+    def unwrap(self):
+        return self._decoded()
+
+    # Private:
+    def _decoded(self):
+        v = self._v
+        if v is _Undecoded:
+            try:
+                v = self._v = decode(self._m)
+            except DecodeFailure as f:
+                raise f.errcls(
+                    self._path + ''.join(reversed(f.segments)),
+                    f.msg,
+                    **f.params)
+        return v
+
+    def _peel(self):
+        v = self._decoded()
+        m = self._m
+
+        if isinstance(v, list):
+            return [
+                self._child(x, dx, '[{}]', i)
+                for i, (x, dx) in enumerate(zip(m[1:], v))
+            ]
+        elif isinstance(v, tuple):
+            (tag, dvalue) = v
+            return (tag, self._child(m[1], dvalue, '/{}', tag))
+        elif isinstance(v, dict):
+            return dict(
+                (k, self._child(m[k], dx, '.{}', k))
+                for (k, dx) in v.iteritems())
+        else:
+            return v
+
+    def _child(self, msg, value, tmpl, key):
+        return EagerParser(msg, _value=value, _parent=self, _seg=(tmpl, key))
+
+
+class DecodeFailure (Exception):
+    '''I carry a decoding error up to the root, collecting its path.
+
+    The root raises errcls with its path plus my segments, reversed.
+    '''
+    def __init__(self, errcls, msg, **params):
+        Exception.__init__(self)
+        self.errcls = errcls
+        self.msg = msg
+        self.params = params
+        self.segments = []
+
+
+_Undecoded = object()
+
+
+def decode(v):
+    '''Return message v decoded into plain values, or raise DecodeFailure.'''
+    if isinstance(v, list):
+        if not v:
+            return []
+        elif v[0] == '@LIST':
+            out = []
+            for i in xrange(1, len(v)):
+                try:
+                    out.append(decode(v[i]))
+                except DecodeFailure as f:
+                    f.segments.append('[{}]'.format(i - 1))
+                    raise
+            return out
+        elif len(v) != 2:
+            raise DecodeFailure(error.MalformedList, v)
+        else:
+            [tag, value] = v
+            _verify_identifier(tag, v)
+            try:
+                return (tag, decode(value))
+            except DecodeFailure as f:
+                f.segments.append('/{}'.format(tag))
+                raise
+
+    elif isinstance(v, dict):
+        out = {}
+        for (k, x) in v.iteritems():
+            _verify_identifier(k, v)
+            try:
+                out[k] = decode(x)
+            except DecodeFailure as f:
+                f.segments.append('.{}'.format(k))
+                raise
+        return out
+
+    else:
+        return v
+
+
+def _verify_identifier(ident, container):
+    if not _IdentifierRgx.match(ident):
+        raise DecodeFailure(error.InvalidIdentifier, container, ident=ident)
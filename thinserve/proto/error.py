@@ -1,9 +1,19 @@
 from proptools import SetOnceProperty
+from thinserve.proto.metrics import Metrics
+
+
+# Counted wherever an error is reported to the remote side:
+ProtocolErrors = Metrics.counter(
+    'thinserve_protocol_errors_total',
+    'Protocol errors reported to clients, by error class.',
+    labels=['error'])
 
 
 class ProtocolError (Exception):
     # Subclasses should define Template as a class property.
 
+    HTTPStatus = 400
+
     params = SetOnceProperty()
 
     def __init__(self, **kw):
@@ -38,10 +48,65 @@ class UnexpectedHTTPBody (ProtocolError):
     Template = 'unexpected HTTP body'
 
 
+class RequestBodyTooLarge (ProtocolError):
+    Template = 'request body exceeds {limit} bytes'
+    HTTPStatus = 413
+
+
+class InvalidContentLength (ProtocolError):
+    Template = 'invalid Content-Length "{length}"'
+
+
+class UnsupportedContentEncoding (ProtocolError):
+    Template = 'unsupported content encoding "{encoding}"'
+    HTTPStatus = 415
+
+
+class CorruptRequestBody (ProtocolError):
+    Template = 'corrupt {encoding} request body'
+
+
+class SessionClosed (ProtocolError):
+    Template = 'session closed ({reason})'
+
+
+class OutgoingQueueFull (ProtocolError):
+    Template = 'outgoing message queue full'
+
+
+class TooManyPendingCalls (ProtocolError):
+    Template = 'too many pending calls; the limit is {limit}'
+
+
+class SchedulerFull (ProtocolError):
+    Template = 'too many calls are waiting; try again later'
+
+
+class CallTimedOut (ProtocolError):
+    Template = 'call timed out after {timeout} seconds'
+
+
+class UnknownReference (ProtocolError):
+    Template = 'unknown reference {sref}'
+
+
+class TooManyReferences (ProtocolError):
+    Template = 'too many exported references; the limit is {limit}'
+
+
 class MalformedJSON (ProtocolError):
     Template = 'malformed JSON'
 
 
+class MalformedDocument (ProtocolError):
+    Template = 'malformed {format} document'
+
+
+class UnsupportedMediaType (ProtocolError):
+    Template = 'unsupported media type "{mediatype}"'
+    HTTPStatus = 415
+
+
 class MalformedMessage (ProtocolError):
     def __init__(self, _path, _msg, **params):
         ProtocolError.__init__(self, **params)
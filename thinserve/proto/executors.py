@@ -0,0 +1,391 @@
+"""
+Worker pools for remote methods which would otherwise block the reactor.
+
+A method marked @Referenceable.Method(executor='threads') or
+executor='processes' has its params parsed on the reactor as usual, and
+is then run in a pool here. Its caller receives the result once the
+pool is done, while other calls proceed.
+
+Worker processes are fresh interpreters, started as
+python -m thinserve.proto.executors, rather than forks of the server,
+since a fork would share the running reactor. Each runs one call at a
+time, exchanging pickles with the server over its stdin and stdout.
+"""
+
+__all__ = ['Executors', 'WorkerError']
+
+
+import os
+import sys
+import struct
+import signal
+import traceback
+import multiprocessing
+import cPickle as pickle
+from collections import deque
+from twisted.internet import defer, error, protocol, threads
+from twisted.python.threadpool import ThreadPool
+from thinserve.proto.metrics import Metrics
+from thinserve.util import FunctionTableProperty, Singleton
+
+
+PoolWorkers = Metrics.gauge(
+    'thinserve_executor_workers',
+    'Size of each started executor pool.',
+    labels=['executor'])
+BusyWorkers = Metrics.gauge(
+    'thinserve_executor_busy',
+    'Workers running a method, by executor.',
+    labels=['executor'])
+WaitingCalls = Metrics.gauge(
+    'thinserve_executor_waiting',
+    'Calls waiting for a free worker, by executor.',
+    labels=['executor'])
+SaturatedCalls = Metrics.counter(
+    'thinserve_executor_saturated_total',
+    'Calls which found every worker busy, by executor.',
+    labels=['executor'])
+
+
+class WorkerError (Exception):
+    '''A method failed in a worker process; I carry its traceback.'''
+
+
+@Singleton
+class Executors (object):
+    '''I hold the process-wide 'threads' and 'processes' pools.
+
+    Each pool starts on first use and stops when the reactor shuts
+    down. By default there are 10 threads, and one process per CPU.
+
+    A method run in a process is called on a pickled copy of its
+    object, so changes it makes to its object are lost; such methods
+    suit pure computation. Their class must be importable by the
+    worker, their object, arguments and result must be picklable, and
+    an exception they raise reaches the caller as a WorkerError. So
+    does a worker exiting mid-call, or a call outlasting timeout
+    seconds, if set; the worker is then replaced.
+    '''
+    Kinds = ('threads', 'processes')
+
+    def __init__(self):
+        self._sizes = {
+            'threads': 10,
+            'processes': multiprocessing.cpu_count(),
+        }
+        self._timeout = None
+        self._pools = {}
+        self._busy = dict.fromkeys(self.Kinds, 0)
+        self._stopswithreactor = False
+        Metrics.collector(self._report_metrics)
+
+    def configure(self, threads=None, processes=None, timeout=None):
+        '''Set pool sizes, and the timeout of calls in processes.
+
+        Call this before either pool is used.
+        '''
+        assert not self._pools, 'Pools are already started.'
+        for (kind, size) in [('threads', threads), ('processes', processes)]:
+            if size is not None:
+                assert size > 0, (kind, size)
+                self._sizes[kind] = size
+        if timeout is not None:
+            assert timeout > 0, timeout
+            self._timeout = timeout
+
+    def submit(self, kind, m, kwargs):
+        '''Return a Deferred of bound method m(**kwargs), run in kind.'''
+        pool = self._pools.get(kind)
+        if pool is None:
+            pool = self._pools[kind] = self._starters[kind]()
+
+        self._busy[kind] += 1
+        if self._busy[kind] > self._sizes[kind]:
+            SaturatedCalls.inc(kind)
+
+        d = defer.maybeDeferred(self._submitters[kind], pool, m, kwargs)
+
+        @d.addBoth
+        def finished(result):
+            self._busy[kind] -= 1
+            return result
+
+        return d
+
+    def stop(self):
+        '''Stop the started pools; they restart on next use.
+
+        Return a Deferred which fires once they have stopped.
+        '''
+        pools = self._pools
+        self._pools = {}
+        d = defer.gatherResults([
+            defer.maybeDeferred(self._stoppers[kind], pool)
+            for (kind, pool) in pools.iteritems()])
+        d.addCallback(lambda _: None)
+        return d
+
+    # Private:
+    _starters = FunctionTableProperty('_start_')
+    _submitters = FunctionTableProperty('_submit_')
+    _stoppers = FunctionTableProperty('_stop_')
+
+    @_starters.register
+    def _start_threads(self):
+        pool = ThreadPool(0, self._sizes['threads'], 'thinserve-executor')
+        pool.start()
+        self._stop_with_reactor()
+        return pool
+
+    @_submitters.register
+    def _submit_threads(self, pool, m, kwargs):
+        from twisted.internet import reactor
+        return threads.deferToThreadPool(reactor, pool, m, **kwargs)
+
+    @_stoppers.register
+    def _stop_threads(self, pool):
+        pool.stop()
+
+    @_starters.register
+    def _start_processes(self):
+        pool = _ProcessPool(self._sizes['processes'], self._timeout)
+        pool.start()
+        self._stop_with_reactor()
+        return pool
+
+    @_submitters.register
+    def _submit_processes(self, pool, m, kwargs):
+        # Pickle here, so unpicklable arguments fail the call at once:
+        payload = pickle.dumps(
+            (m.im_class, m.__name__, m.im_self, kwargs),
+            pickle.HIGHEST_PROTOCOL)
+
+        return pool.submit(payload).addCallback(_load_outcome)
+
+    @_stoppers.register
+    def _stop_processes(self, pool):
+        return pool.stop()
+
+    def _stop_with_reactor(self):
+        # Pools restart after a stop, but one trigger stops them all:
+        if not self._stopswithreactor:
+            from twisted.internet import reactor
+            reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+            self._stopswithreactor = True
+
+    def _report_metrics(self):
+        for kind in self.Kinds:
+            if kind in self._pools:
+                size = self._sizes[kind]
+                busy = self._busy[kind]
+                PoolWorkers.set(size, kind)
+                BusyWorkers.set(min(busy, size), kind)
+                WaitingCalls.set(max(busy - size, 0), kind)
+
+
+class _ProcessPool (object):
+    '''I run pickled calls in size worker processes, queueing the rest.'''
+    def __init__(self, size, timeout):
+        self._size = size
+        self._timeout = timeout
+        self._idle = []
+        self._workers = set()
+        self._waiting = deque()  # [(payload, Deferred)]
+        self._running = False
+
+    def start(self):
+        self._running = True
+        for _ in range(self._size):
+            self._spawn()
+
+    def submit(self, payload):
+        '''Return a Deferred of the pickled outcome of payload.'''
+        if not self._workers:
+            return defer.fail(_no_workers())
+
+        d = defer.Deferred()
+        self._waiting.append((payload, d))
+        self._dispatch()
+        return d
+
+    def stop(self):
+        '''Kill my workers; return a Deferred which fires once they exit.'''
+        self._running = False
+        (waiting, self._waiting) = (self._waiting, deque())
+        workers = list(self._workers)
+        for worker in workers:
+            worker.kill()
+        for (_, d) in waiting:
+            d.errback(WorkerError('The process pool stopped.'))
+        return defer.DeferredList([w.exited for w in workers])
+
+    # Called by _Worker:
+    def worker_idle(self, worker):
+        self._idle.append(worker)
+        self._dispatch()
+
+    def worker_exited(self, worker):
+        self._workers.discard(worker)
+        if worker in self._idle:
+            self._idle.remove(worker)
+
+        # A worker which never ran a call may be failing to start, so
+        # replacing it could loop:
+        if self._running and worker.used:
+            self._spawn()
+        elif not self._workers:
+            (waiting, self._waiting) = (self._waiting, deque())
+            for (_, d) in waiting:
+                d.errback(_no_workers())
+
+    # Private:
+    def _spawn(self):
+        worker = _Worker(self, self._timeout)
+        self._workers.add(worker)
+        worker.spawn()
+        self._idle.append(worker)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._idle and self._waiting:
+            (payload, d) = self._waiting.popleft()
+            self._idle.pop().run(payload, d)
+
+
+class _Worker (protocol.ProcessProtocol):
+    '''I am one worker process of a _ProcessPool.'''
+    def __init__(self, pool, timeout):
+        self._pool = pool
+        self._timeout = timeout
+        self._buffer = ''
+        self._call = None
+        self._timer = None
+        self.used = False
+        self.exited = defer.Deferred()
+
+    def spawn(self):
+        from twisted.internet import reactor
+
+        # The worker imports what this process can:
+        env = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join(os.path.abspath(p) for p in sys.path))
+        reactor.spawnProcess(
+            self,
+            sys.executable,
+            [sys.executable, '-m', 'thinserve.proto.executors'],
+            env=env,
+            childFDs={0: 'w', 1: 'r', 2: 2})
+
+    def run(self, payload, d):
+        from twisted.internet import reactor
+
+        self._call = d
+        self.used = True
+        self.transport.write(_frame(payload))
+        if self._timeout is not None:
+            self._timer = reactor.callLater(
+                self._timeout, self._timed_out)
+
+    def kill(self):
+        if not self.exited.called:
+            try:
+                self.transport.signalProcess('KILL')
+            except error.ProcessExitedAlready:
+                pass
+
+    def outReceived(self, data):
+        self._buffer += data
+        while len(self._buffer) >= _HeaderSize:
+            (size,) = struct.unpack(_Header, self._buffer[:_HeaderSize])
+            end = _HeaderSize + size
+            if len(self._buffer) < end:
+                break
+            (outcome, self._buffer) = (
+                self._buffer[_HeaderSize:end], self._buffer[end:])
+            d = self._finish_call()
+            # Without a call, I timed out and am being killed:
+            if d is not None:
+                self._pool.worker_idle(self)
+                d.callback(outcome)
+
+    def processEnded(self, reason):
+        self._pool.worker_exited(self)
+        if self._call is not None:
+            self._finish_call().errback(
+                WorkerError('The worker process exited mid-call.'))
+        self.exited.callback(None)
+
+    # Private:
+    def _finish_call(self):
+        '''Return my call's Deferred, or None, and forget it.'''
+        (d, self._call) = (self._call, None)
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        return d
+
+    def _timed_out(self):
+        self._timer = None
+        d = self._finish_call()
+        self.kill()
+        d.errback(
+            WorkerError(
+                'The call timed out after {} seconds.'.format(
+                    self._timeout)))
+
+
+def _no_workers():
+    return WorkerError('No worker processes are running.')
+
+
+_Header = '>I'
+_HeaderSize = struct.calcsize(_Header)
+
+
+def _frame(data):
+    return struct.pack(_Header, len(data)) + data
+
+
+def _serve_worker():
+    # Keep the protocol's pipes away from the methods, whose prints then
+    # reach stderr:
+    calls = os.fdopen(os.dup(0), 'rb')
+    outcomes = os.fdopen(os.dup(1), 'wb')
+    os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+    os.dup2(2, 1)
+
+    # An interrupt is for the server to handle, not its workers:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    while True:
+        header = calls.read(_HeaderSize)
+        if len(header) < _HeaderSize:
+            return
+        (size,) = struct.unpack(_Header, header)
+        outcomes.write(_frame(_call_in_worker(calls.read(size))))
+        outcomes.flush()
+
+
+def _call_in_worker(payload):
+    try:
+        (cls, name, obj, kwargs) = pickle.loads(payload)
+        outcome = ('result', getattr(cls, name)(obj, **kwargs))
+        return pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return pickle.dumps(
+            ('error', traceback.format_exc()),
+            pickle.HIGHEST_PROTOCOL)
+
+
+def _load_outcome(data):
+    (tag, value) = pickle.loads(data)
+    if tag == 'result':
+        return value
+    else:
+        raise WorkerError(value)
+
+
+if __name__ == '__main__':
+    _serve_worker()
@@ -2,9 +2,7 @@ __all__ = ['LazyParser']
 
 
 import re
-import inspect
-from types import ClassType, InstanceType, FunctionType, MethodType
-from thinserve.proto import error
+from thinserve.proto import error, signature
 
 
 _IdentifierRgx = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
@@ -18,6 +16,10 @@ class LazyParser (object):
     def __repr__(self):
         return '<{} {!r}>'.format(type(self).__name__, self._m)
 
+    def raw(self):
+        '''Return my message exactly as it was decoded from JSON.'''
+        return self._m
+
     def unwrap(self):
         v = self._peel()
         if isinstance(v, list):
@@ -54,10 +56,19 @@ class LazyParser (object):
     def iter(self):
         return iter(self.parse_type(list))
 
+    def is_list(self):
+        '''Do I encode a list rather than a variant? Elements are unchecked.'''
+        m = self._m
+        return isinstance(m, list) and (m == [] or m[0] == '@LIST')
+
     def apply_struct(self, f):
+        return f(**self.parse_struct(f))
+
+    def parse_struct(self, f):
+        '''Return my struct as keyword arguments checked against f.'''
         params = self.parse_type(dict)
         self._check_arg_info(f, params.keys())
-        return f(**params)
+        return params
 
     def apply_variant_struct(self, **fs):
         return self.apply_variant(
@@ -127,50 +138,16 @@ class LazyParser (object):
             raise errcls(self._path, self._m, **params)
 
     def _check_arg_info(self, f, paramnames):
-        assert callable(f), repr(f)
-
-        if type(f) is FunctionType:
-            protectfirst = False
-        elif type(f) is MethodType:
-            protectfirst = True
-        elif type(f) in (type, ClassType):
-            # It's a class:
-            protectfirst = True
-            if getattr(f, '__new__', object.__new__) is not object.__new__:
-                f = f.__new__
-            else:
-                f = f.__init__
-        elif isinstance(type(f), type) or type(f) is InstanceType:
-            # It's a new-style class instance:
-            protectfirst = True
-            f = f.__call__
-        else:
-            assert False, 'Unsupported callable: {!r}'.format(f)
-
-        argnames, _, keywords, defaults = inspect.getargspec(f)
-        # assertion: varargs is always ignored and unreachable from
-        # remote attackers.
-
-        if protectfirst:
-            # Protect self/cls parameters:
-            argnames.pop(0)
-
-        defcount = 0 if defaults is None else len(defaults)
-
-        if defcount == 0:
-            required = set(argnames)
-        else:
-            required = set(argnames[:-defcount])
-
+        sig = signature.of(f)
         actual = set(paramnames)
 
-        missing = required - actual
+        missing = sig.required - actual
         if missing:
             raise error.MissingStructKeys(
                 self._path, self._m, keys=list(missing))
 
-        if keywords is None:
-            unknown = actual - set(argnames)
+        if sig.allowed is not None:
+            unknown = actual - sig.allowed
             if unknown:
                 raise error.UnexpectedStructKeys(
                     self._path, self._m, keys=list(unknown))
@@ -0,0 +1,213 @@
+"""
+A process-wide registry of counters, gauges and histograms.
+
+Metrics are created once at import time, next to the code they measure,
+and exported in the Prometheus text format. Gauges of state which is
+cheap to count on demand (such as the number of sessions) are computed
+by collectors at export time, so the hot paths pay nothing for them.
+
+Setting Metrics.enabled to False makes every update a no-op.
+"""
+
+__all__ = ['Metrics']
+
+
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from thinserve.util import Singleton
+
+
+DefaultBuckets = (
+    .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+@Singleton
+class Metrics (object):
+    '''I hold every metric in this process.'''
+
+    ContentType = 'text/plain; version=0.0.4'
+
+    def __init__(self):
+        self.enabled = True
+        self._metrics = OrderedDict()
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DefaultBuckets):
+        return self._add(Histogram, name, help, labels, buckets)
+
+    def collector(self, f):
+        '''Decorate f() to be called to update gauges before each export.'''
+        self._collectors.append(f)
+        return f
+
+    def render(self):
+        '''Return every metric in the Prometheus text format.'''
+        for f in self._collectors:
+            f()
+
+        lines = []
+        for m in self._metrics.itervalues():
+            m._render(lines)
+        return '\n'.join(lines) + '\n'
+
+    # Private:
+    def _add(self, cls, name, help, labels, *args):
+        m = self._metrics.get(name)
+        if m is None:
+            m = self._metrics[name] = cls(self, name, help, labels, *args)
+        else:
+            assert (type(m), m.labels) == (cls, tuple(labels)), \
+                'Conflicting definitions of metric {!r}'.format(name)
+        return m
+
+
+class _Metric (object):
+    Type = None
+
+    def __init__(self, registry, name, help, labels):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        if not labels:
+            self._values[()] = self._initial()
+
+    def value(self, *labels):
+        return self._values.get(labels, self._initial())
+
+    # Private:
+    def _initial(self):
+        return 0
+
+    def _render(self, lines):
+        lines.append('# HELP {} {}'.format(self.name, _escape_help(self.help)))
+        lines.append('# TYPE {} {}'.format(self.name, self.Type))
+        for labels in sorted(self._values):
+            self._render_sample(lines, labels, self._values[labels])
+
+    def _render_sample(self, lines, labels, value):
+        lines.append(_sample(self.name, zip(self.labels, labels), value))
+
+
+class Counter (_Metric):
+    '''I count events, such as errors; I only go up.'''
+    Type = 'counter'
+
+    def inc(self, *labels):
+        if self._registry.enabled:
+            self._values[labels] = self._values.get(labels, 0) + 1
+
+    def add(self, amount, *labels):
+        assert amount >= 0, amount
+        if self._registry.enabled:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge (_Metric):
+    '''I hold a value which goes up and down, such as a queue length.'''
+    Type = 'gauge'
+
+    def set(self, value, *labels):
+        if self._registry.enabled:
+            self._values[labels] = value
+
+
+class Histogram (_Metric):
+    '''I count observations, such as durations, into buckets.'''
+    Type = 'histogram'
+
+    def __init__(self, registry, name, help, labels, buckets):
+        self._buckets = tuple(sorted(buckets))
+        _Metric.__init__(self, registry, name, help, labels)
+
+    def observe(self, value, *labels):
+        if self._registry.enabled:
+            try:
+                state = self._values[labels]
+            except KeyError:
+                state = self._values[labels] = self._initial()
+
+            # Bucket counts are cumulated on export, not here:
+            state[0][bisect_left(self._buckets, value)] += 1
+            state[1] += value
+
+    def timer(self, *labels):
+        '''Return a context manager which observes its duration.'''
+        if self._registry.enabled:
+            return _Timer(self, labels)
+        else:
+            return _NullTimer
+
+    # Private:
+    def _initial(self):
+        # [per-bucket counts, including +Inf], sum:
+        return [[0] * (len(self._buckets) + 1), 0]
+
+    def _render_sample(self, lines, labels, state):
+        pairs = zip(self.labels, labels)
+        (counts, total) = state
+        cumulative = 0
+        for (bound, count) in zip(self._buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append(
+                _sample(
+                    self.name + '_bucket',
+                    pairs + [('le', _format_value(bound))],
+                    cumulative))
+        lines.append(_sample(self.name + '_sum', pairs, total))
+        lines.append(_sample(self.name + '_count', pairs, cumulative))
+
+
+class _Timer (object):
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.time()
+
+    def __exit__(self, *excinfo):
+        self._histogram.observe(time.time() - self._started, *self._labels)
+
+
+class _NullTimerType (object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *excinfo):
+        pass
+
+
+_NullTimer = _NullTimerType()
+
+
+def _sample(name, pairs, value):
+    if pairs:
+        name += '{' + ','.join(
+            '{}="{}"'.format(k, _escape_label(v)) for (k, v) in pairs) + '}'
+    return '{} {}'.format(name, _format_value(value))
+
+
+def _format_value(v):
+    if isinstance(v, float):
+        return repr(v)
+    else:
+        return str(v)
+
+
+def _escape_help(s):
+    return s.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def _escape_label(v):
+    if isinstance(v, unicode):
+        v = v.encode('utf-8')
+    return _escape_help(str(v)).replace('"', r'\"')
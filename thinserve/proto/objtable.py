@@ -0,0 +1,61 @@
+"""
+Handles for the objects a session exports to its client.
+"""
+
+__all__ = ['ObjectTable']
+
+
+from thinserve.proto import error
+
+
+class ObjectTable (object):
+    '''I give a session's exported objects integer handles.
+
+    The client names an exported object by its handle, as a call target,
+    until it releases the handle. I hold exported objects until then, or
+    until I am cleared when the session closes. Handles are never
+    reused, so a stale handle is reported rather than misdirected.
+
+    Exporting an already exported object returns its existing handle.
+    If limit is given, exporting more than limit objects at once raises
+    TooManyReferences.
+    '''
+    def __init__(self, limit=None):
+        self._limit = limit
+        self._objects = {}  # {handle: obj}
+        self._handles = {}  # {id(obj): handle}, valid while obj is held.
+        self._nexthandle = 1
+
+    def __len__(self):
+        return len(self._objects)
+
+    def export(self, obj):
+        try:
+            return self._handles[id(obj)]
+        except KeyError:
+            if self._limit is not None and len(self._objects) >= self._limit:
+                raise error.TooManyReferences(limit=self._limit)
+
+            handle = self._nexthandle
+            self._nexthandle += 1
+            self._objects[handle] = obj
+            self._handles[id(obj)] = handle
+            return handle
+
+    def lookup(self, handle):
+        # bool is an int subclass, but never a handle:
+        if type(handle) in (int, long):
+            try:
+                return self._objects[handle]
+            except KeyError:
+                pass
+        raise error.UnknownReference(sref=handle)
+
+    def release(self, handle):
+        obj = self.lookup(handle)
+        del self._objects[handle]
+        del self._handles[id(obj)]
+
+    def clear(self):
+        self._objects.clear()
+        self._handles.clear()
@@ -0,0 +1,164 @@
+"""
+Admission control for incoming calls, shared by every session.
+
+Without a scheduler each call starts as soon as it is received, so one
+busy session can keep any number of methods running at once. A
+CallScheduler bounds how many run, in total and per session, and queues
+the rest.
+"""
+
+__all__ = ['CallScheduler']
+
+
+import time
+from collections import deque, OrderedDict
+from itertools import count
+from weakref import WeakSet
+from twisted.internet import defer
+from thinserve.proto import error
+from thinserve.proto.metrics import Metrics
+from thinserve.util import FunctionTableProperty
+
+
+QueueSeconds = Metrics.histogram(
+    'thinserve_call_queue_seconds',
+    'Time incoming calls wait in a scheduler queue before starting.')
+RunningCalls = Metrics.gauge(
+    'thinserve_scheduled_calls_running',
+    'Calls started by schedulers which have not finished.')
+QueuedCalls = Metrics.gauge(
+    'thinserve_scheduled_calls_queued',
+    'Calls waiting in scheduler queues.')
+
+
+class CallScheduler (object):
+    '''I start calls within concurrency limits, queueing the excess.
+
+    At most maxrunning calls run at once overall, and at most
+    maxpersession for any one session. A call runs until the Deferred
+    it returns fires. Calls beyond maxqueued waiting calls are refused
+    with SchedulerFull, so an overloaded server answers quickly with
+    errors rather than slowly with everything.
+
+    When a slot frees, order picks the next call:
+
+    'fair' - sessions take turns, one call each, so a session with a
+             long queue delays others by at most one call per turn.
+    'fifo' - the oldest waiting call which its session's limit allows.
+    '''
+    def __init__(self, maxrunning=None, maxpersession=None, maxqueued=None,
+                 order='fair'):
+        assert maxrunning is None or maxrunning > 0, repr(maxrunning)
+        assert maxpersession is None or maxpersession > 0, \
+            repr(maxpersession)
+        self._maxrunning = maxrunning
+        self._maxpersession = maxpersession
+        self._maxqueued = maxqueued
+        self._pick = self._pickers[order]
+        self._queues = OrderedDict()  # {key: deque([(seq, t, f, d)...])}
+        self._sessionrunning = {}  # {key: running calls}
+        self._seq = count()
+        self._pumping = False
+        self.running = 0
+        self.queued = 0
+        _schedulers.add(self)
+
+    def submit(self, key, f):
+        '''Call f() once a slot is free; return a Deferred of its result.
+
+        key identifies the caller's session.
+        '''
+        d = defer.Deferred()
+        if key not in self._queues and self._has_slot(key):
+            self._start(key, f, d)
+        elif self._maxqueued is not None and self.queued >= self._maxqueued:
+            d.errback(error.SchedulerFull())
+        else:
+            queue = self._queues.setdefault(key, deque())
+            queue.append((next(self._seq), time.time(), f, d))
+            self.queued += 1
+        return d
+
+    def discard(self, key):
+        '''Drop key's waiting calls, such as when its session closes.
+
+        Their Deferreds never fire.
+        '''
+        self.queued -= len(self._queues.pop(key, ()))
+
+    # Private:
+    def _has_slot(self, key):
+        return ((self._maxrunning is None
+                 or self.running < self._maxrunning)
+                and (self._maxpersession is None
+                     or self._sessionrunning.get(key, 0)
+                     < self._maxpersession))
+
+    def _start(self, key, f, d):
+        self.running += 1
+        self._sessionrunning[key] = self._sessionrunning.get(key, 0) + 1
+        defer.maybeDeferred(f).addBoth(self._finished, key, d)
+
+    def _finished(self, result, key, d):
+        self.running -= 1
+        self._sessionrunning[key] -= 1
+        if self._sessionrunning[key] == 0:
+            del self._sessionrunning[key]
+
+        # The caller sees the result before the next call starts:
+        d.callback(result)
+        self._pump()
+
+    def _pump(self):
+        # Calls which finish synchronously would otherwise recurse here:
+        if self._pumping:
+            return
+
+        self._pumping = True
+        try:
+            while self._queues:
+                key = self._pick(
+                    k for k in self._queues if self._has_slot(k))
+                if key is None:
+                    break
+
+                # Popping moves key to the back of the turn order:
+                queue = self._queues.pop(key)
+                (_, queuedat, f, d) = queue.popleft()
+                if queue:
+                    self._queues[key] = queue
+                self.queued -= 1
+
+                QueueSeconds.observe(time.time() - queuedat)
+                self._start(key, f, d)
+        finally:
+            self._pumping = False
+
+    _pickers = FunctionTableProperty('_pick_')
+
+    @_pickers.register
+    def _pick_fair(self, keys):
+        return next(keys, None)
+
+    @_pickers.register
+    def _pick_fifo(self, keys):
+        # The oldest call at the head of an eligible queue:
+        oldest = None
+        for key in keys:
+            seq = self._queues[key][0][0]
+            if oldest is None or seq < oldest[0]:
+                oldest = (seq, key)
+        return None if oldest is None else oldest[1]
+
+
+_schedulers = WeakSet()
+
+
+@Metrics.collector
+def _collect_metrics():
+    _report_metrics(_schedulers)
+
+
+def _report_metrics(schedulers):
+    RunningCalls.set(sum(s.running for s in schedulers))
+    QueuedCalls.set(sum(s.queued for s in schedulers))
@@ -0,0 +1,155 @@
+"""
+Compiled parameter schemas for remote methods.
+
+A schema maps each parameter name of a method to a spec:
+
+type, or tuple of types - the value must be an instance. bool is not
+                          an int here unless it is listed.
+[spec] - the value must be a list whose elements match spec.
+{name: spec, ...} - the value must be a struct with exactly these keys.
+predicate function - the function's docstring describes the predicate,
+                     as with LazyParser.parse_predicate.
+
+Specs are compiled once into nested check functions, so validating a
+call is one walk over the raw params, decoding as it checks, with no
+per-field parsers.
+"""
+
+__all__ = ['compile_method']
+
+
+from types import ClassType
+from thinserve.proto import error, signature
+from thinserve.proto.eagerparser import DecodeFailure, decode
+
+
+def compile_method(func, spec):
+    '''Return a validator for func's params, for use when func is a method.
+
+    The validator takes the params parser and returns a dict of plain
+    values, or raises a MalformedMessage.
+    '''
+    sig = signature.of_method(func)
+    names = frozenset(spec)
+
+    assert sig.required <= names, \
+        'Schema for {!r} lacks required params {!r}'.format(
+            func, sorted(sig.required - names))
+    assert sig.allowed is None or names <= sig.allowed, \
+        'Schema for {!r} has unknown params {!r}'.format(
+            func, sorted(names - sig.allowed))
+
+    check = _compile_struct(spec, sig.required)
+
+    def validate(lp):
+        try:
+            return check(lp.raw())
+        except DecodeFailure as f:
+            raise f.errcls(
+                lp._path + ''.join(reversed(f.segments)),
+                f.msg,
+                **f.params)
+
+    return validate
+
+
+# Private:
+#
+# Each check takes a raw message value and returns it decoded, or raises
+# DecodeFailure.
+def _compile(spec):
+    if isinstance(spec, (type, ClassType, tuple)):
+        return _compile_type(spec)
+    elif isinstance(spec, list):
+        [elemspec] = spec
+        return _compile_list(_compile(elemspec))
+    elif isinstance(spec, dict):
+        return _compile_struct(spec, frozenset(spec))
+    else:
+        assert callable(spec) and spec.__doc__ is not None, repr(spec)
+        return _compile_predicate(spec)
+
+
+def _compile_type(t):
+    types = t if isinstance(t, tuple) else (t,)
+    expected = '|'.join(x.__name__ for x in types)
+
+    # bool subclasses int, but true is not a count:
+    rejectbool = int in types and bool not in types
+
+    def check(v):
+        v = decode(v)
+        if not isinstance(v, t) or (rejectbool and isinstance(v, bool)):
+            raise _unexpected_type(v, expected)
+        return v
+
+    return check
+
+
+def _compile_predicate(p):
+    def check(v):
+        v = decode(v)
+        if not p(v):
+            raise DecodeFailure(
+                error.FailedPredicate, v,
+                description=p.__doc__)
+        return v
+
+    return check
+
+
+def _compile_list(checkelem):
+    def check(v):
+        if not (isinstance(v, list) and (not v or v[0] == '@LIST')):
+            raise _unexpected_type(decode(v), 'list')
+
+        out = []
+        for i in xrange(1, len(v)):
+            try:
+                out.append(checkelem(v[i]))
+            except DecodeFailure as f:
+                f.segments.append('[{}]'.format(i - 1))
+                raise
+        return out
+
+    return check
+
+
+def _compile_struct(spec, required):
+    fields = [(k, _compile(s)) for (k, s) in spec.iteritems()]
+    allowed = frozenset(spec)
+
+    def check(v):
+        if not isinstance(v, dict):
+            raise _unexpected_type(decode(v), 'dict')
+
+        keys = frozenset(v)
+
+        missing = required - keys
+        if missing:
+            raise DecodeFailure(
+                error.MissingStructKeys, v, keys=list(missing))
+
+        unknown = keys - allowed
+        if unknown:
+            raise DecodeFailure(
+                error.UnexpectedStructKeys, v, keys=list(unknown))
+
+        out = {}
+        for (k, checkfield) in fields:
+            if k in v:
+                try:
+                    out[k] = checkfield(v[k])
+                except DecodeFailure as f:
+                    f.segments.append('.{}'.format(k))
+                    raise
+        return out
+
+    return check
+
+
+def _unexpected_type(v, expected):
+    return DecodeFailure(
+        error.UnexpectedType, v,
+        actual=type(v).__name__,
+        expected=expected)
@@ -1,76 +1,405 @@
-import itertools
-from functable import FunctionTableProperty
+import time
 from twisted.internet import defer
 from thinserve.api.referenceable import Referenceable
 from thinserve.api.remerr import RemoteError
+from thinserve.proto.callhooks import CallInfo
+from thinserve.proto.metrics import Metrics
+from thinserve.proto.objtable import ObjectTable
 from thinserve.proto.shuttle import Shuttle
-from thinserve.proto.error import InternalError
+from thinserve.proto.error import \
+    CallTimedOut, InternalError, InvalidParameter, OutgoingQueueFull, \
+    ProtocolError, ProtocolErrors, SchedulerFull, TooManyPendingCalls
+from thinserve.util import FunctionTableProperty
+
+
+CallSeconds = Metrics.histogram(
+    'thinserve_call_seconds',
+    'Time from receiving a call to queueing its reply, by method.',
+    labels=['method'])
 
 
 class Session (object):
-    def __init__(self, rootobj):
+    def __init__(self, rootobj, clock=None, sid=None, callhooks=(),
+                 maxrefs=None, calltimeout=None, maxpendingcalls=None,
+                 scheduler=None, **shuttleopts):
+        '''callhooks are thinserve.proto.callhooks.CallHooks.
+
+        @Referenceable objects in call results, or in the params of calls
+        to the client, are exported as ["@SREF", handle]. The client may
+        use a handle as a call target until it sends a release message.
+        At most maxrefs objects may be exported at once.
+
+        My calls to the client time out after calltimeout seconds unless
+        they give their own timeout. At most maxpendingcalls of them may
+        await replies at once.
+
+        Calls from the client start through scheduler, a
+        thinserve.proto.scheduler.CallScheduler, if given. A call holds
+        its place in the scheduler until its reply is queued, which under
+        the 'wait' overflow policy means until the client has gathered
+        enough of the backlog. A reply refused by the 'reject' policy is
+        dropped and counted as an OutgoingQueueFull protocol error.
+        '''
+        assert clock is not None or calltimeout is None, \
+            'Timeouts require a clock.'
         assert Referenceable._check(rootobj), \
             'The root object must be @Referenceable.'
+        self.sid = sid
+        self._callhooks = tuple(callhooks)
         self._rootobj = rootobj
+        self._objects = ObjectTable(limit=maxrefs)
         self._pendingcalls = {}
-        self._idgen = itertools.count(0)
-        self._shuttle = Shuttle()
+        self._calltimers = {}
+        self._orphanedcalls = set()
+        self._calltimeout = calltimeout
+        self._maxpendingcalls = maxpendingcalls
+        self._scheduler = scheduler
+        self._nextcallid = 0
+        self._clock = clock
+        self._shuttle = Shuttle(clock, **shuttleopts)
+        self._observer = None
+
+    @property
+    def queued_messages(self):
+        return self._shuttle.queued_messages
+
+    @property
+    def pending_calls(self):
+        '''The number of my calls awaiting replies.'''
+        return len(self._pendingcalls)
+
+    @property
+    def gathers(self):
+        '''How many gathers I have been asked for, so far.'''
+        return self._shuttle.gathers
+
+    @property
+    def gathering(self):
+        '''Is a gather waiting for my outgoing messages?'''
+        return self._shuttle.blocked
+
+    def set_observer(self, observer):
+        '''Call observer() after any change to my snapshot; None stops.'''
+        self._observer = observer
+
+    def snapshot(self):
+        '''Return my protocol state as plain JSON-compatible values.
+
+        The root object and the Deferreds of pending calls are not
+        included; they cannot outlive this process.
+        '''
+        return {
+            'nextcallid': self._nextcallid,
+            'pendingcalls': sorted(
+                self._orphanedcalls.union(self._pendingcalls)),
+            'queued': self._shuttle.pending_messages(),
+        }
+
+    def restore(self, snapshot):
+        '''Resume from a snapshot taken of this session in another life.
+
+        Replies to calls which were pending in the snapshot are accepted
+        and discarded, since nothing remains to receive them.
+        '''
+        assert self._nextcallid == 0 and not self._pendingcalls, \
+            'Only a fresh Session may be restored.'
+        self._nextcallid = snapshot['nextcallid']
+        self._orphanedcalls = set(snapshot['pendingcalls'])
+        self._shuttle.requeue(snapshot['queued'])
+
+    def drained(self):
+        '''Return a Deferred which fires once my outgoing queue has room.
+
+        See _send_call.
+        '''
+        return self._shuttle.drained()
 
     def gather_outgoing_messages(self):
-        d = defer.Deferred()
+        d = defer.Deferred(canceller=self._shuttle.cancel_gather)
         self._shuttle.gather_messages(d)
+        # Gathers may also be answered later, by the Shuttle's timers:
+        d.addBoth(self._changed)
+        self._changed()
         return d
 
+    def close(self, reason):
+        '''Errback the blocked GET and every pending call with reason.'''
+        self._shuttle.close(reason)
+        self._objects.clear()
+        if self._scheduler is not None:
+            self._scheduler.discard(self)
+
+        for timer in self._calltimers.itervalues():
+            timer.cancel()
+        self._calltimers = {}
+
+        pending = self._pendingcalls
+        self._pendingcalls = {}
+        for d in pending.itervalues():
+            d.errback(reason)
+
     def receive_message(self, msg):
-        msg.apply_variant_struct(**self._receivers)
+        try:
+            msg.apply_variant_struct(**self._receivers)
+        finally:
+            self._changed()
+
+    def receive_messages(self, msgs):
+        '''Receive a list of messages in order.
+
+        A message which raises a ProtocolError does not stop the rest.
+        Return a list of [index, error] for the failed messages.
+        '''
+        errors = []
+        for (i, msg) in enumerate(msgs.iter()):
+            try:
+                self.receive_message(msg)
+            except ProtocolError as e:
+                ProtocolErrors.inc(type(e).__name__)
+                errors.append([i, e.as_proto_object()])
+        return errors
 
     _receivers = FunctionTableProperty('_receive_')
 
     @_receivers.register
     def _receive_call(self, id, target, method):
+        started = time.time()
         id = id.parse_type(int)
-        obj = self._resolve_sref(target.unwrap())
-        methods = Referenceable._get_bound_methods(obj)
+        sref = target.unwrap()
 
-        d = defer.maybeDeferred(method.apply_variant_struct, **methods)
+        try:
+            obj = self._resolve_sref(sref)
+        except ProtocolError:
+            # Such as a released reference; the caller gets an error reply:
+            (info, methods) = (None, {})
+            d = self._respond(id, info, defer.fail())
+        else:
+            if self._callhooks:
+                info = CallInfo(self.sid, sref)
+                methods = self._get_hooked_dispatchers(obj, info)
+            else:
+                info = None
+                methods = Referenceable._get_dispatchers(obj)
 
-        d.addCallback(lambda r: ['data', r])
+            def run():
+                return self._respond(
+                    id,
+                    info,
+                    defer.maybeDeferred(method.apply_variant, **methods))
+
+            if self._scheduler is None:
+                d = run()
+            else:
+                d = self._scheduler.submit(self, run)
+
+                @d.addErrback
+                def refused(f):
+                    # Only refusal fails here; run() replies to the rest:
+                    f.trap(SchedulerFull)
+                    return self._respond(id, info, defer.fail(f))
+
+        d.addCallback(
+            lambda _: CallSeconds.observe(
+                time.time() - started,
+                _method_label(method, methods)))
+
+    def _respond(self, id, info, d):
+        '''Reply to call id with the outcome of d.'''
+        d.addCallback(lambda r: ['data', self._export(r)])
 
         d.addErrback(InternalError.coerce_unexpected_failure)
-        d.addErrback(lambda f: ['error', f.value.as_proto_object()])
 
-        d.addCallback(lambda reply: self._send_reply(id, reply))
+        @d.addErrback
+        def error_reply(f):
+            ProtocolErrors.inc(f.type.__name__)
+            return ['error', f.value.as_proto_object()]
+
+        @d.addCallback
+        def send_reply(reply):
+            queued = self._send_reply(id, reply)
+            if info is not None and info.method is not None:
+                self._finish_hooked_call(info, reply)
+            return queued
+
+        return d
 
     @_receivers.register
     def _receive_reply(self, id, result):
         id = id.parse_type(int)
 
-        d = self._pendingcalls.pop(id)
+        d = self._pendingcalls.pop(id, None)
+        if d is None:
+            if not 0 <= id < self._nextcallid:
+                raise InvalidParameter(name='id')
+
+            # The call was cancelled, timed out or made in a previous
+            # life, so nothing waits for this reply:
+            self._orphanedcalls.discard(id)
+            return
+
+        self._cancel_timer(id)
 
         result.apply_variant(
             data=d.callback,
             error=lambda lp: d.errback(RemoteError(lp)))
 
-    def _send_call(self, target, method, params):
-        callid = self._idgen.next()
+    @_receivers.register
+    def _receive_release(self, target):
+        self._objects.release(target.unwrap())
+
+    def _send_call(self, target, method, params, timeout=None):
+        '''Call the client; return a Deferred for the result.
 
-        self._shuttle.send_message(
-            ['call',
-             {'id': callid,
-              'target': target,
-              'method': [method, params]}])
+        Cancelling the Deferred, or the call timing out, sends the client
+        a cancel message, and a later reply is discarded.
 
-        d = defer.Deferred()
+        If the outgoing queue is full, the 'reject' policy fails the call
+        with OutgoingQueueFull. The 'wait' policy queues it anyway; callers
+        making many calls should then wait on drained() between them.
+        '''
+        if (self._maxpendingcalls is not None
+                and len(self._pendingcalls) >= self._maxpendingcalls):
+            return defer.fail(
+                TooManyPendingCalls(limit=self._maxpendingcalls))
+
+        if timeout is None:
+            timeout = self._calltimeout
+
+        callid = self._nextcallid
+        try:
+            self._queue(
+                ['call',
+                 {'id': callid,
+                  'target': target,
+                  'method': [method, self._export(params)]}])
+        except OutgoingQueueFull:
+            return defer.fail()
+        self._nextcallid += 1
+
+        d = defer.Deferred(canceller=lambda _: self._abandon_call(callid))
         self._pendingcalls[callid] = d
+        if timeout is not None:
+            assert self._clock is not None, 'Timeouts require a clock.'
+            self._calltimers[callid] = self._clock.callLater(
+                timeout, self._time_out_call, callid, timeout)
+        self._changed()
         return d
 
+    def _time_out_call(self, callid, timeout):
+        del self._calltimers[callid]
+        d = self._pendingcalls[callid]
+        self._abandon_call(callid)
+        d.errback(CallTimedOut(timeout=timeout))
+
+    def _abandon_call(self, callid):
+        if self._pendingcalls.pop(callid, None) is None:
+            return
+
+        self._cancel_timer(callid)
+        try:
+            self._queue(['cancel', {'id': callid}])
+        except OutgoingQueueFull as e:
+            # The client's reply is discarded all the same:
+            ProtocolErrors.inc(type(e).__name__)
+        self._changed()
+
+    def _cancel_timer(self, callid):
+        timer = self._calltimers.pop(callid, None)
+        if timer is not None:
+            timer.cancel()
+
     def _send_reply(self, id, result):
-        self._shuttle.send_message(
-            ['reply',
-             {'id': id, 'result': result}])
+        '''Queue a reply; return a Deferred if it must wait for room.'''
+        try:
+            return self._queue(
+                ['reply',
+                 {'id': id, 'result': result}])
+        except OutgoingQueueFull as e:
+            # Nothing waits on a reply, so it is only counted:
+            ProtocolErrors.inc(type(e).__name__)
+            return None
+        finally:
+            self._changed()
+
+    def _queue(self, msg):
+        '''Send msg; return a Deferred if it must wait for room.'''
+        queued = self._shuttle.send_message(msg)
+        if queued is not None:
+            # If the session closes first, nothing remains to wait:
+            queued.addErrback(lambda _: None)
+        return queued
+
+    def _get_hooked_dispatchers(self, obj, info):
+        return dict(
+            (name,
+             lambda lp, name=name, prepare=prepare, m=m:
+                 self._dispatch_hooked(info, name, prepare, m, lp))
+            for (name, (prepare, m))
+            in Referenceable._get_preparers(obj).iteritems())
+
+    def _dispatch_hooked(self, info, name, prepare, m, lp):
+        info.method = name
+
+        started = time.time()
+        kwargs = prepare(lp)
+        info.parse_seconds = time.time() - started
+
+        for hook in self._callhooks:
+            hook.call_started(info)
+
+        started = time.time()
+        d = defer.maybeDeferred(m, **kwargs)
+
+        for hook in reversed(self._callhooks):
+            hook.call_returned(info)
+
+        @d.addBoth
+        def executed(result):
+            info.exec_seconds = time.time() - started
+            return result
+
+        return d
+
+    def _finish_hooked_call(self, info, reply):
+        if info.exec_seconds is None:
+            # The params could not be prepared, so the method never ran:
+            return
+
+        (tag, result) = reply
+        info.failed = tag == 'error'
+        info.result = result
+
+        for hook in self._callhooks:
+            hook.call_finished(info)
+
+    def _changed(self, passthrough=None):
+        if self._observer is not None:
+            self._observer()
+        return passthrough
 
     def _resolve_sref(self, sref):
         if sref is None:
             return self._rootobj
         else:
-            raise NotImplementedError(sref)
+            return self._objects.lookup(sref)
+
+    def _export(self, value):
+        '''Replace @Referenceable objects within value by srefs.'''
+        if isinstance(value, (list, tuple)):
+            return [self._export(v) for v in value]
+        elif isinstance(value, dict):
+            return dict((k, self._export(v)) for (k, v) in value.iteritems())
+        elif Referenceable._check(value):
+            return ['@SREF', self._objects.export(value)]
+        else:
+            return value
+
+
+def _method_label(method, methods):
+    # Only known names are used, so clients cannot create labels:
+    m = method.raw()
+    if (isinstance(m, list) and len(m) == 2
+            and isinstance(m[0], basestring) and m[0] in methods):
+        return m[0]
+    else:
+        return '(unknown)'
@@ -0,0 +1,170 @@
+"""
+Sessions which outlive their process, stored in a SQLite file.
+
+Only protocol state is stored: queued outgoing messages, the next call
+id and the ids of pending calls, plus the params each session was
+created with. The root object is recreated from those params, so state
+an application keeps in it does not survive.
+"""
+
+__all__ = ['SQLiteSessionTable']
+
+
+import json
+import sqlite3
+from twisted.python import log
+from thinserve.proto.sessiontable import SessionTable
+
+
+class SQLiteSessionTable (SessionTable):
+    '''I am a SessionTable which stores each session's protocol state.
+
+    Live sessions are held in memory as usual. When a session changes,
+    its snapshot is written at the end of the current reactor turn, and
+    every session changed in that turn is written in one transaction, so
+    a burst of messages costs one write.
+
+    The SQLite I/O blocks the reactor: a lookup must return a restored
+    session at once, and a write waits on the file's lock if another
+    process holds it. Keep the file on a local disk.
+
+    Looking up an id which is stored but not live restores the session:
+    restore(sid, createparams) must return a fresh Session, or None if
+    it cannot, which then resumes from its snapshot. So a restarted
+    process, or another process sharing the file, continues the session
+    with its queued messages intact. A session which fails to restore is
+    logged and looked up as unknown.
+
+    Two processes must not hold one session live at once, since neither
+    sees the other's changes; route each session to a single process,
+    as thinserve.api.shard does.
+
+    Expired and evicted sessions are deleted. Sessions closed by
+    close_all stay stored, to be restored after a restart.
+    '''
+    def __init__(self, path, clock, restore, timeout=None, maxsessions=None):
+        SessionTable.__init__(
+            self, clock, timeout=timeout, maxsessions=maxsessions)
+        self._restore = restore
+        self._dirty = set()
+        self._flusher = None
+
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute(_Schema)
+            if timeout is not None:
+                self._db.execute(
+                    'DELETE FROM sessions WHERE lastaccess <= ?',
+                    (clock.seconds() - timeout,))
+
+    def __getitem__(self, sid):
+        try:
+            return SessionTable.__getitem__(self, sid)
+        except KeyError:
+            try:
+                session = self._load(sid)
+            except Exception:
+                log.err(None, 'Restoring session {!r} failed.'.format(sid))
+                session = None
+
+            if session is None:
+                raise KeyError(sid)
+            else:
+                return session
+
+    def add(self, sid, session, createparams):
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)',
+                (sid,
+                 self._clock.seconds(),
+                 json.dumps(createparams),
+                 json.dumps(session.snapshot())))
+
+        self._watch(sid, session)
+        self[sid] = session
+
+    def close_all(self, reason='shutdown'):
+        self.flush()
+        SessionTable.close_all(self, reason)
+
+    def flush(self):
+        '''Write every changed session now.'''
+        if self._flusher is not None:
+            if self._flusher.active():
+                self._flusher.cancel()
+            self._flusher = None
+
+        dirty = self._dirty
+        self._dirty = set()
+
+        now = self._clock.seconds()
+        rows = [
+            (now, json.dumps(self._entries[sid][0].snapshot()), sid)
+            for sid in dirty
+            if sid in self._entries]
+
+        if rows:
+            with self._db:
+                self._db.executemany(
+                    'UPDATE sessions SET lastaccess = ?, snapshot = ? '
+                    'WHERE sid = ?',
+                    rows)
+
+    # Private:
+    def _load(self, sid):
+        row = self._db.execute(
+            'SELECT lastaccess, createparams, snapshot FROM sessions '
+            'WHERE sid = ?',
+            (sid,)).fetchone()
+
+        if row is None:
+            return None
+
+        (lastaccess, createparams, snapshot) = row
+
+        if (self._timeout is not None
+                and lastaccess + self._timeout <= self._clock.seconds()):
+            session = None
+        else:
+            session = self._restore(sid, json.loads(createparams))
+
+        if session is None:
+            self._delete(sid)
+        else:
+            session.restore(json.loads(snapshot))
+            self._watch(sid, session)
+            self[sid] = session
+            self._mark_dirty(sid)
+
+        return session
+
+    def _watch(self, sid, session):
+        session.set_observer(lambda: self._mark_dirty(sid))
+
+    def _mark_dirty(self, sid):
+        self._dirty.add(sid)
+        if self._flusher is None:
+            self._flusher = self._clock.callLater(0, self.flush)
+
+    def _delete(self, sid):
+        with self._db:
+            self._db.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+    def _close(self, sid, session, reason):
+        session.set_observer(None)
+        self._dirty.discard(sid)
+        if reason in ('expired', 'evicted'):
+            self._delete(sid)
+
+        SessionTable._close(self, sid, session, reason)
+
+
+_Schema = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    sid TEXT PRIMARY KEY,
+    lastaccess REAL NOT NULL,
+    createparams TEXT NOT NULL,
+    snapshot TEXT NOT NULL
+)
+'''
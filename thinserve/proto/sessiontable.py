@@ -0,0 +1,131 @@
+__all__ = ['SessionTable']
+
+
+from collections import OrderedDict
+from weakref import WeakSet
+from thinserve.proto import error
+from thinserve.proto.metrics import Metrics
+
+
+Sessions = Metrics.gauge(
+    'thinserve_sessions',
+    'Live sessions.')
+QueuedMessages = Metrics.gauge(
+    'thinserve_queued_messages',
+    'Outgoing messages waiting for a gather, over all sessions.')
+BlockedGathers = Metrics.gauge(
+    'thinserve_blocked_gathers',
+    'Gathers (GETs or event streams) waiting for messages.')
+PendingCalls = Metrics.gauge(
+    'thinserve_pending_calls',
+    'Calls to clients awaiting replies, over all sessions.')
+
+
+class SessionTable (object):
+    '''I map session ids to Sessions, closing idle and excess sessions.
+
+    Entries are kept in order of last access, so the least recently
+    used session is always first. Idle expiry and LRU eviction both pop
+    from the front, and a single delayed call on the clock tracks the
+    oldest deadline, so reaping never scans the whole table.
+    '''
+    def __init__(self, clock, timeout=None, maxsessions=None):
+        assert maxsessions is None or maxsessions > 0, repr(maxsessions)
+        self._clock = clock
+        self._timeout = timeout
+        self._maxsessions = maxsessions
+        self._entries = OrderedDict()  # {sid: (session, lastaccess)}
+        self._reaper = None
+        _tables.add(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, sid):
+        return sid in self._entries
+
+    def __getitem__(self, sid):
+        '''Return the session for sid and mark it recently used.'''
+        (s, _) = self._entries.pop(sid)
+        self._entries[sid] = (s, self._clock.seconds())
+        return s
+
+    def __setitem__(self, sid, session):
+        self._entries.pop(sid, None)
+        self._entries[sid] = (session, self._clock.seconds())
+
+        if self._maxsessions is not None:
+            while len(self._entries) > self._maxsessions:
+                self._close_oldest('evicted')
+
+        self._schedule_reaper()
+
+    def add(self, sid, session, createparams):
+        '''Add a new session, given the raw params it was created with.
+
+        I keep sessions only in memory, so I ignore createparams, but
+        tables which persist sessions need them to recreate the root
+        object.
+        '''
+        self[sid] = session
+
+    def itervalues(self):
+        return (s for (s, _) in self._entries.itervalues())
+
+    def close_all(self, reason='shutdown'):
+        while self._entries:
+            self._close_oldest(reason)
+
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+
+    # Private:
+    def _close_oldest(self, reason):
+        (sid, (s, _)) = self._entries.popitem(last=False)
+        self._close(sid, s, reason)
+
+    def _close(self, sid, session, reason):
+        session.close(error.SessionClosed(reason=reason))
+
+    def _schedule_reaper(self):
+        if self._reaper is None and self._timeout is not None:
+            for (_, lastaccess) in self._entries.itervalues():
+                delay = lastaccess + self._timeout - self._clock.seconds()
+                self._reaper = self._clock.callLater(max(0, delay), self._reap)
+                break
+
+    def _reap(self):
+        self._reaper = None
+        horizon = self._clock.seconds() - self._timeout
+
+        while self._entries:
+            (_, (_, lastaccess)) = next(self._entries.iteritems())
+            if lastaccess > horizon:
+                break
+            self._close_oldest('expired')
+
+        self._schedule_reaper()
+
+
+_tables = WeakSet()
+
+
+@Metrics.collector
+def _collect_metrics():
+    _report_metrics(_tables)
+
+
+def _report_metrics(tables):
+    sessions = queued = blocked = pending = 0
+    for table in tables:
+        for s in table.itervalues():
+            sessions += 1
+            queued += s.queued_messages
+            blocked += s.gathering
+            pending += s.pending_calls
+
+    Sessions.set(sessions)
+    QueuedMessages.set(queued)
+    BlockedGathers.set(blocked)
+    PendingCalls.set(pending)
@@ -1,52 +1,327 @@
-from functable import FunctionTableProperty
+import json
+from collections import deque
+from twisted.internet import defer
+from thinserve.proto import error
+from thinserve.util import FunctionTableProperty
 
 
 class Shuttle (object):
-    '''I hold either pending HTTP response or pending outgoing messages.'''
-    def __init__(self):
+    '''I hold either pending HTTP response or pending outgoing messages.
+
+    If polltimeout is given, a blocked gather is answered with [] after
+    that many seconds on clock.
+
+    If batchdelay is given, a message arriving at a blocked gather opens
+    a coalescing window instead of releasing the gather at once: the
+    batch is released batchdelay seconds later, or sooner once it holds
+    batchsize messages or batchbytes bytes of encoded JSON. batchsize and
+    batchbytes only cut a window short, so they require batchdelay.
+
+    Messages queued with no gather waiting are limited to maxqueued
+    messages and maxqueuedbytes bytes of encoded JSON. When a send would
+    exceed a limit, the overflow policy applies:
+
+    'drop_oldest' - discard the oldest queued messages to make room.
+    'reject' - raise OutgoingQueueFull and do not queue the message.
+    'wait' - queue the message, and return a Deferred from send_message
+             which fires when the queue is next drained by a gather.
+    '''
+    def __init__(self,
+                 clock=None,
+                 polltimeout=None,
+                 batchdelay=None,
+                 batchsize=None,
+                 batchbytes=None,
+                 maxqueued=None,
+                 maxqueuedbytes=None,
+                 overflow='drop_oldest'):
+        if clock is None:
+            assert polltimeout is None and batchdelay is None, \
+                'Timeouts require a clock.'
+        if batchdelay is None:
+            assert batchsize is None and batchbytes is None, \
+                'batchsize and batchbytes limit a batchdelay window.'
         self._state = _Empty
+        self._clock = clock
+        self._polltimeout = polltimeout
+        self._batchdelay = batchdelay
+        self._batchsize = batchsize
+        self._batchbytes = batchbytes
+        self._fillbytes = 0
+        self._timer = None
+        self._maxqueued = maxqueued
+        self._maxqueuedbytes = maxqueuedbytes
+        self._overflow = self._overflows[overflow]
+        self._queuedbytes = 0
+        self._drainwaiters = []
+        self.dropped_messages = 0
+        self.gathers = 0
+
+    @property
+    def queued_messages(self):
+        (tag, state) = self._state
+        if tag == 'queued':
+            return len(state)
+        elif tag == 'filling':
+            return len(state[1])
+        else:
+            return 0
+
+    @property
+    def blocked(self):
+        '''Is a gather waiting for messages?'''
+        return self._state[0] in ('blocked', 'filling')
+
+    @property
+    def queued_bytes(self):
+        '''The encoded size of queued messages, if maxqueuedbytes is set.'''
+        return self._queuedbytes
+
+    def pending_messages(self):
+        '''Return a list of the messages not yet handed to a gather.'''
+        (tag, state) = self._state
+        if tag == 'queued':
+            return list(state)
+        elif tag == 'filling':
+            return list(state[1])
+        else:
+            return []
+
+    def requeue(self, msgs):
+        '''Queue msgs, as saved by pending_messages, into an empty Shuttle.
+
+        Queue limits are not applied, so nothing saved is dropped.
+        '''
+        assert self._state is _Empty, self._state
+        if msgs:
+            self._state = ('queued', deque(msgs))
+            self._queuedbytes = sum(map(self._measure_queued, msgs))
 
     def send_message(self, msg):
-        self._apply(self._senders, msg)
+        return self._apply(self._senders, msg)
+
+    def drained(self):
+        '''Return a Deferred which fires once my queue is within limits.
+
+        Under the 'wait' policy, senders should wait on this before
+        sending more.
+        '''
+        if self._exceeds_queue_limits(self.queued_messages,
+                                      self._queuedbytes):
+            d = defer.Deferred()
+            self._drainwaiters.append(d)
+            return d
+        else:
+            return defer.succeed(None)
 
     def gather_messages(self, d):
+        '''Fire d with messages, releasing any older gather with [].
+
+        The older gather is released after d is in place, so it may
+        gather again at once; gathers counts them all.
+        '''
+        self.gathers += 1
         self._apply(self._gatherers, d)
 
+    def close(self, reason):
+        '''Drop queued messages and errback any blocked gather.'''
+        self._apply(self._closers, reason)
+        self._state = _Empty
+        self._queuedbytes = 0
+        self._release_drain_waiters(lambda d: d.errback(reason))
+
+    def cancel_gather(self, d):
+        '''Forget d if it is blocked, such as when its client disconnects.'''
+        (tag, state) = self._state
+        if tag == 'blocked' and state is d:
+            self._unblock()
+        elif tag == 'filling' and state[0] is d:
+            # Keep the partial batch for the next gather:
+            (_, msgs) = state
+            self._unblock()
+            self._state = ('queued', deque(msgs))
+            self._queuedbytes = sum(map(self._measure_queued, msgs))
+
     # Private:
     def _apply(self, ftab, arg):
         (tag, state) = self._state
-        ftab[tag](state, arg)
+        return ftab[tag](state, arg)
+
+    def _block(self, d):
+        self._cancel_timer()
+        self._state = ('blocked', d)
+        if self._polltimeout is not None:
+            self._timer = self._clock.callLater(
+                self._polltimeout,
+                self._poll_timed_out)
+
+    def _unblock(self):
+        self._state = _Empty
+        self._cancel_timer()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _poll_timed_out(self):
+        self._timer = None
+        (_, d) = self._state
+        self._state = _Empty
+        d.callback([])
+
+    def _batch_is_full(self, q):
+        return (
+            (self._batchsize is not None
+             and len(q) >= self._batchsize)
+            or
+            (self._batchbytes is not None
+             and self._fillbytes >= self._batchbytes))
+
+    def _flush(self):
+        (_, (d, q)) = self._state
+        self._unblock()
+        d.callback(q)
+
+    def _flush_timed_out(self):
+        self._timer = None
+        self._flush()
+
+    def _exceeds_queue_limits(self, count, size):
+        return (
+            (self._maxqueued is not None
+             and count > self._maxqueued)
+            or
+            (self._maxqueuedbytes is not None
+             and size > self._maxqueuedbytes))
+
+    def _measure_queued(self, msg):
+        if self._maxqueuedbytes is None:
+            return 0
+        else:
+            return _message_size(msg)
+
+    def _enqueue(self, q, msg, size):
+        q.append(msg)
+        self._queuedbytes += size
+
+    def _release_drain_waiters(self, release):
+        waiters = self._drainwaiters
+        self._drainwaiters = []
+        for d in waiters:
+            release(d)
+
+    _overflows = FunctionTableProperty('_overflow_')
+
+    @_overflows.register
+    def _overflow_drop_oldest(self, q, msg, size):
+        self._enqueue(q, msg, size)
+        while len(q) > 1 and self._exceeds_queue_limits(
+                len(q), self._queuedbytes):
+            self._queuedbytes -= self._measure_queued(q.popleft())
+            self.dropped_messages += 1
+
+    @_overflows.register
+    def _overflow_reject(self, q, msg, size):
+        self.dropped_messages += 1
+        raise error.OutgoingQueueFull()
+
+    @_overflows.register
+    def _overflow_wait(self, q, msg, size):
+        self._enqueue(q, msg, size)
+        d = defer.Deferred()
+        self._drainwaiters.append(d)
+        return d
 
     _senders = FunctionTableProperty('_send_')
 
     @_senders.register
     def _send_empty(self, _, msg):
-        self._state = ('queued', [msg])
+        q = deque()
+        result = self._send_queued(q, msg)
+        self._state = ('queued', q)
+        return result
 
     @_senders.register
     def _send_queued(self, q, msg):
-        q.append(msg)
+        size = self._measure_queued(msg)
+        if self._exceeds_queue_limits(len(q) + 1, self._queuedbytes + size):
+            return self._overflow(q, msg, size)
+        else:
+            self._enqueue(q, msg, size)
 
     @_senders.register
     def _send_blocked(self, d, msg):
-        d.callback([msg])
-        self._state = _Empty
+        self._unblock()
+        if self._batchdelay is None:
+            d.callback([msg])
+        else:
+            self._fillbytes = 0
+            self._state = ('filling', (d, []))
+            self._timer = self._clock.callLater(
+                self._batchdelay,
+                self._flush_timed_out)
+            self._send_filling(self._state[1], msg)
+
+    @_senders.register
+    def _send_filling(self, filling, msg):
+        (_, q) = filling
+        q.append(msg)
+        if self._batchbytes is not None:
+            self._fillbytes += _message_size(msg)
+        if self._batch_is_full(q):
+            self._flush()
 
     _gatherers = FunctionTableProperty('_gather_')
 
     @_gatherers.register
     def _gather_empty(self, _, d):
-        self._state = ('blocked', d)
+        self._block(d)
 
     @_gatherers.register
     def _gather_queued(self, q, d):
-        d.callback(q)
         self._state = _Empty
+        self._queuedbytes = 0
+        d.callback(list(q))
+        self._release_drain_waiters(lambda d: d.callback(None))
 
     @_gatherers.register
     def _gather_blocked(self, oldd, newd):
+        self._block(newd)
+        oldd.callback([])
+
+    @_gatherers.register
+    def _gather_filling(self, filling, newd):
+        (oldd, q) = filling
+        # The newer request gets the batch; the older one is released:
+        self._unblock()
+        newd.callback(q)
         oldd.callback([])
-        self._state = ('blocked', newd)
+
+    _closers = FunctionTableProperty('_close_')
+
+    @_closers.register
+    def _close_empty(self, _, reason):
+        pass
+
+    @_closers.register
+    def _close_queued(self, q, reason):
+        pass
+
+    @_closers.register
+    def _close_blocked(self, d, reason):
+        self._unblock()
+        d.errback(reason)
+
+    @_closers.register
+    def _close_filling(self, filling, reason):
+        (d, _) = filling
+        self._unblock()
+        d.errback(reason)
 
 
 _Empty = ('empty', None)
+
+
+def _message_size(msg):
+    return len(json.dumps(msg, separators=(',', ':')))
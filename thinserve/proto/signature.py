@@ -0,0 +1,92 @@
+"""
+Cached analysis of which struct keys a callable accepts.
+
+LazyParser.apply_struct validates every call against the target's
+parameters. The analysis is done once per underlying function (or class)
+and cached by identity, so each call only does set operations.
+"""
+
+__all__ = ['Signature', 'of', 'of_method']
+
+
+import inspect
+from types import ClassType, InstanceType, FunctionType, MethodType
+from weakref import WeakKeyDictionary
+
+
+class Signature (object):
+    '''I hold the required and allowed parameter names of a callable.
+
+    allowed is None when the callable accepts arbitrary keywords.
+    '''
+    __slots__ = ['required', 'allowed']
+
+    def __init__(self, f, protectfirst):
+        argnames, _, keywords, defaults = inspect.getargspec(f)
+        # assertion: varargs is always ignored and unreachable from
+        # remote attackers.
+
+        if protectfirst:
+            # Protect self/cls parameters:
+            argnames = argnames[1:]
+
+        defcount = 0 if defaults is None else len(defaults)
+
+        if defcount == 0:
+            self.required = frozenset(argnames)
+        else:
+            self.required = frozenset(argnames[:-defcount])
+
+        if keywords is None:
+            self.allowed = frozenset(argnames)
+        else:
+            self.allowed = None
+
+
+def of(f):
+    '''Return the Signature of any callable, analyzing it on first use.'''
+    assert callable(f), repr(f)
+
+    t = type(f)
+    if t is FunctionType:
+        return _lookup(_functions, f, lambda: Signature(f, False))
+    elif t is MethodType:
+        return of_method(f.im_func)
+    elif t in (type, ClassType):
+        return _lookup(_constructors, f, lambda: _analyze_class(f))
+    elif t is InstanceType:
+        # It's an old-style class instance:
+        cls = f.__class__
+        return _lookup(_callables, cls, lambda: Signature(cls.__call__, True))
+    elif isinstance(t, type):
+        # It's a new-style class instance:
+        return _lookup(_callables, t, lambda: Signature(t.__call__, True))
+    else:
+        assert False, 'Unsupported callable: {!r}'.format(f)
+
+
+def of_method(func):
+    '''Return the Signature of func when it is called as a method.'''
+    return _lookup(_methods, func, lambda: Signature(func, True))
+
+
+# Private:
+_functions = WeakKeyDictionary()
+_methods = WeakKeyDictionary()
+_constructors = WeakKeyDictionary()
+_callables = WeakKeyDictionary()
+
+
+def _lookup(cache, key, analyze):
+    try:
+        return cache[key]
+    except KeyError:
+        sig = cache[key] = analyze()
+        return sig
+
+
+def _analyze_class(cls):
+    if getattr(cls, '__new__', object.__new__) is not object.__new__:
+        return Signature(cls.__new__, True)
+    else:
+        return Signature(cls.__init__, True)
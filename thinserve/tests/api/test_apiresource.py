@@ -1,16 +1,24 @@
 import json
-from unittest import TestCase
+import marshal
+import zlib
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
 from twisted.web import server
-from mock import MagicMock, call, patch
-from thinserve.api.apiresource import ThinAPIResource
-from thinserve.proto import error
+from mock import ANY, MagicMock, call, patch
+from thinserve.api import apiresource
+from thinserve.api.apiresource import ThinAPIResource, DefaultMaxBodySize
+from thinserve.api.referenceable import Referenceable
+from thinserve.proto import error, session
+from thinserve.proto.codec import BinaryCodec
+from thinserve.proto.eagerparser import EagerParser
 from thinserve.tests.testutil import check_mock, EqCb
 
 
 class ThinAPIResourceTests (TestCase):
     def setUp(self):
         self.m_createsession = MagicMock(name='createsession')
-        self.tar = ThinAPIResource(self.m_createsession)
+        self.clock = task.Clock()
+        self.tar = ThinAPIResource(self.m_createsession, clock=self.clock)
         self.m_request = None
 
     @patch('thinserve.proto.session.Session')
@@ -35,7 +43,106 @@ class ThinAPIResourceTests (TestCase):
 
         check_mock(
             self, m_Session,
-            [call(self.m_createsession.return_value)])
+            [call(self.m_createsession.return_value,
+                  clock=self.clock,
+                  sid=entropy.encode("hex"),
+                  callhooks=(),
+                  maxrefs=None,
+                  calltimeout=None,
+                  maxpendingcalls=None,
+                  scheduler=None,
+                  polltimeout=30,
+                  batchdelay=None,
+                  batchsize=None,
+                  batchbytes=None,
+                  maxqueued=None,
+                  maxqueuedbytes=None,
+                  overflow='drop_oldest')])
+
+    @patch('thinserve.proto.session.Session')
+    @patch('os.urandom')
+    def test_POST_create_session_sharded(self, m_urandom, m_Session):
+        m_urandom.return_value = 'fake entropy'
+        m_shard = MagicMock(name='Shard')
+        m_shard.route.return_value = None
+        m_shard.qualify.return_value = 'QUALIFIED_SID'
+        self.tar = ThinAPIResource(
+            self.m_createsession, clock=self.clock, shard=m_shard)
+
+        self._make_request(
+            'POST', [],
+            ["create_session", {}],
+            True, 200,
+            {"session": 'QUALIFIED_SID'})
+
+        check_mock(
+            self, m_shard,
+            [call.route(self.m_request),
+             call.qualify('fake entropy'.encode('hex'))])
+
+        self.assertIs(
+            m_Session.return_value,
+            self.tar._sessions['QUALIFIED_SID'])
+
+    def test_sharded_request_for_sibling_is_proxied(self):
+        m_shard = MagicMock(name='Shard')
+        self.tar = ThinAPIResource(
+            self.m_createsession, clock=self.clock, shard=m_shard)
+        m_request = MagicMock(name='Request')
+        m_request.getHeader.return_value = None
+        m_request.content.read.return_value = 'body'
+
+        self.assertEqual(server.NOT_DONE_YET, self.tar.render(m_request))
+        check_mock(
+            self, m_shard,
+            [call.route(m_request),
+             call.route().render(m_request)])
+        check_mock(
+            self, m_request,
+            _NegotiationCalls + [
+             call.getHeader('content-length'),
+             call.content.read(DefaultMaxBodySize + 1),
+             call.requestHeaders.removeHeader('transfer-encoding'),
+             call.requestHeaders.setRawHeaders('content-length', ['4'])])
+
+    def test_sharded_request_too_large_for_sibling(self):
+        m_shard = MagicMock(name='Shard')
+        self.tar = ThinAPIResource(
+            self.m_createsession, clock=self.clock, shard=m_shard,
+            max_body_size=3)
+
+        self._make_request(
+            'POST', ['1-SIBLING_SESSION_ID'],
+            'mangled JSON',
+            False, 413,
+            {"template": error.RequestBodyTooLarge.Template,
+             "params": {"limit": 3}},
+            [call.getHeader('content-length'),
+             call.content.read(4)])
+
+        check_mock(self, m_shard, [call.route(self.m_request)])
+
+    @patch('os.urandom')
+    def test_session_db_restores_sessions(self, m_urandom):
+        m_urandom.return_value = 'fake entropy'
+        sid = 'fake entropy'.encode('hex')
+        self.m_createsession.side_effect = lambda: _App()
+        path = self.mktemp()
+
+        self.tar = ThinAPIResource(
+            self.m_createsession, clock=self.clock, session_db=path)
+        self._make_request(
+            'POST', [],
+            ["create_session", {}],
+            True, 200,
+            {"session": sid})
+
+        # As if the process restarted:
+        tar = ThinAPIResource(
+            self.m_createsession, clock=self.clock, session_db=path)
+
+        self.assertIsInstance(tar._sessions[sid], session.Session)
+        check_mock(self, self.m_createsession, [call(), call()])
 
     def test_GET_session_poll(self):
         sid = 'FAKE_SESSION_ID'
@@ -52,12 +159,159 @@ class ThinAPIResourceTests (TestCase):
             'GET', [sid],
             None,
             True, 200,
-            msgs)
+            msgs,
+            [call.notifyFinish(),
+             call.notifyFinish().addErrback(ANY)])
 
         check_mock(
             self, m_session,
             [call.gather_outgoing_messages()])
 
+    def test_GET_session_poll_client_disconnects(self):
+        sid = 'FAKE_SESSION_ID'
+        gatherd = defer.Deferred()
+        finishd = defer.Deferred()
+
+        m_session = MagicMock(name='SessionInstance')
+        m_session.gather_outgoing_messages.return_value = gatherd
+        self.tar._sessions[sid] = m_session
+
+        m_request = MagicMock(name='Request')
+        m_request.method = 'GET'
+        m_request.postpath = [sid]
+        m_request.content.read.return_value = ''
+        m_request.getHeader.return_value = None
+        m_request.notifyFinish.return_value = finishd
+
+        self.tar.render(m_request)
+        finishd.errback(Exception('connection lost'))
+
+        # The response is abandoned rather than written:
+        self.assertEqual(None, self.successResultOf(gatherd))
+        check_mock(
+            self, m_request,
+            _NegotiationCalls + [
+             call.content.read(1),
+             call.notifyFinish()])
+
+    def test_GET_unencodable_response_ends_request(self):
+        sid = 'FAKE_SESSION_ID'
+        m_session = MagicMock(name='SessionInstance')
+        m_session.gather_outgoing_messages.return_value = [
+            ['reply', {'id': 0, 'result': ['data', float('nan')]}]]
+        self.tar._sessions[sid] = m_session
+
+        m_request = MagicMock(name='Request')
+        m_request.method = 'GET'
+        m_request.postpath = [sid]
+        m_request.content.read.return_value = ''
+        m_request.getHeader.return_value = None
+        m_request.startedWriting = False
+        m_request.finished = False
+
+        before = error.ProtocolErrors.value('InternalError')
+        self.tar.render(m_request)
+
+        check_mock(
+            self, m_request,
+            _NegotiationCalls + [
+             call.content.read(1),
+             call.notifyFinish(),
+             call.notifyFinish().addErrback(ANY),
+             call.setResponseCode(200),
+             call.setHeader('Content-Type', 'application/json'),
+             call.setHeader('Vary', 'Accept-Encoding'),
+             call.getHeader('accept-encoding'),
+             call.setResponseCode(400),
+             call.responseHeaders.removeHeader('content-encoding'),
+             call.write(json.dumps(
+                 {'template': error.InternalError.Template, 'params': {}},
+                 separators=(',', ':'))),
+             call.finish()])
+        self.assertEqual(
+            before + 1,
+            error.ProtocolErrors.value('InternalError'))
+
+    def test_GET_session_events(self):
+        (s, m_request, finishd) = self._start_event_stream()
+
+        reply = ['reply', {'id': 0, 'result': ['data', 'yum']}]
+        s._send_reply(0, ['data', 'yum'])
+        self.clock.advance(30)
+        s.close(error.SessionClosed(reason='expired'))
+
+        check_mock(
+            self, m_request,
+            _NegotiationCalls + [
+             call.content.read(1),
+             call.setResponseCode(200),
+             call.setHeader('Content-Type', 'text/event-stream'),
+             call.setHeader('Cache-Control', 'no-cache'),
+             call.write(':\n\n'),
+             call.notifyFinish(),
+             call.write(
+                 'data: {}\n\n'.format(
+                     json.dumps([reply], separators=(',', ':')))),
+             call.write(':\n\n'),
+             call.write(
+                 'event: error\ndata: {}\n\n'.format(
+                     json.dumps(
+                         {'template': error.SessionClosed.Template,
+                          'params': {'reason': 'expired'}},
+                         separators=(',', ':')))),
+             call.finish()])
+
+    def test_GET_session_events_client_disconnects(self):
+        (s, m_request, finishd) = self._start_event_stream()
+
+        finishd.errback(Exception('connection lost'))
+        s._send_reply(0, ['data', 'yum'])
+
+        check_mock(
+            self, m_request,
+            _NegotiationCalls + [
+             call.content.read(1),
+             call.setResponseCode(200),
+             call.setHeader('Content-Type', 'text/event-stream'),
+             call.setHeader('Cache-Control', 'no-cache'),
+             call.write(':\n\n'),
+             call.notifyFinish()])
+        self.assertEqual(1, len(s.snapshot()['queued']))
+
+    def test_GET_takes_over_from_session_events(self):
+        (s, m_request, finishd) = self._start_event_stream()
+
+        m_get = MagicMock(name='Request')
+        m_get.method = 'GET'
+        m_get.postpath = ['FAKE_SESSION_ID']
+        m_get.content.read.return_value = ''
+        m_get.getHeader.return_value = None
+        self.assertEqual(server.NOT_DONE_YET, self.tar.render(m_get))
+
+        reply = ['reply', {'id': 0, 'result': ['data', 'yum']}]
+        s._send_reply(0, ['data', 'yum'])
+        self.clock.advance(30)
+
+        # The stream ends quietly, and the GET gets the message:
+        self.assertEqual(
+            [call.write(':\n\n'), call.notifyFinish(), call.finish()],
+            m_request.mock_calls[-3:])
+        self.assertIn(
+            call.write(json.dumps([reply], separators=(',', ':'))),
+            m_get.mock_calls)
+        self.assertFalse(s.gathering)
+        self.assertEqual(
+            [], [c for c in self.clock.getDelayedCalls()
+                 if c.func.__name__ != '_reap'])
+
+    def test_error_GET_events_unknown_session(self):
+        self._make_request(
+            'GET', ['BOGUS_SESSION_ID', 'events'],
+            None,
+            True, 400,
+            {"template": error.InvalidParameter.Template,
+             "params": {"name": "session"}})
+
     def test_POST_session_message(self):
         sid = 'FAKE_SESSION_ID'
         msg = {"fruit": "banana"}
@@ -78,19 +332,250 @@ class ThinAPIResourceTests (TestCase):
             self, m_session,
             [call.receive_message(EqCb(lambda lp: lp.unwrap() == msg))])
 
+    def test_pretty_response(self):
+        self.tar = ThinAPIResource(
+            self.m_createsession, clock=self.clock, pretty=True, codec='json')
+        m_request = MagicMock(name='Request')
+        self.tar._write_json(m_request, {'x': [1, 2]})
+
+        check_mock(
+            self, m_request,
+            [call.write(
+                json.dumps({'x': [1, 2]}, indent=2, separators=(',', ': ')))])
+
+    def test_large_batch_is_written_in_chunks(self):
+        msgs = [['reply', {'id': i, 'result': ['data', 'x' * 100]}]
+                for i in range(100)]
+        self.tar._WriteChunkBytes = 1024
+        m_request = MagicMock(name='Request')
+        self.tar._write_json(m_request, msgs)
+
+        writes = [c[1][0] for c in m_request.write.mock_calls]
+        self.failUnless(len(writes) > 1, writes)
+        self.assertEqual(
+            json.dumps(msgs, separators=(',', ':')),
+            ''.join(writes))
+
+    def test_compressed_GET_session_poll(self):
+        sid = 'FAKE_SESSION_ID'
+        msgs = [['reply', {'id': i, 'result': ['data', 'yum']}]
+                for i in range(100)]
+
+        m_session = MagicMock(name='SessionInstance')
+        m_session.gather_outgoing_messages.return_value = msgs
+        self.tar._sessions[sid] = m_session
+
+        m_request = MagicMock(name='Request')
+        m_request.method = 'GET'
+        m_request.postpath = [sid]
+        m_request.content.read.return_value = ''
+        m_request.getHeader.side_effect = \
+            {'accept-encoding': 'gzip, deflate'}.get
+
+        self.tar.render(m_request)
+
+        m_request.setHeader.assert_any_call('Content-Encoding', 'gzip')
+        body = ''.join(c[1][0] for c in m_request.write.mock_calls)
+        self.assertEqual(
+            json.dumps(msgs, separators=(',', ':')),
+            zlib.decompress(body, 16 + zlib.MAX_WBITS))
+
+    def test_POST_compressed_body(self):
+        sid = 'FAKE_SESSION_ID'
+        msg = {"fruit": "banana"}
+
+        m_session = MagicMock(name='SessionInstance')
+        self.tar._sessions[sid] = m_session
+
+        c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        m_request = MagicMock(name='Request')
+        m_request.method = 'POST'
+        m_request.postpath = [sid]
+        m_request.content.read.return_value = \
+            c.compress(json.dumps(msg)) + c.flush()
+        m_request.getHeader.side_effect = \
+            {'content-encoding': 'gzip'}.get
+
+        self.tar.render(m_request)
+
+        m_request.setResponseCode.assert_called_once_with(200)
+        check_mock(
+            self, m_session,
+            [call.receive_message(EqCb(lambda lp: lp.unwrap() == msg))])
+
+    def test_uncompressed_responses(self):
+        self.tar = ThinAPIResource(
+            self.m_createsession, clock=self.clock, compress_level=None)
+        m_request = MagicMock(name='Request')
+        m_request.method = 'HEAD'
+        m_request.postpath = []
+        m_request.getHeader.return_value = None
+
+        self.tar.render(m_request)
+
+        self.assertNotIn(
+            call.getHeader('accept-encoding'),
+            m_request.mock_calls)
+
+    @patch('thinserve.proto.session.Session')
+    @patch('os.urandom')
+    def test_POST_create_session_binary(self, m_urandom, m_Session):
+        m_urandom.return_value = 'fake entropy'
+        self._add_marshal_codec()
+
+        for (accept, contenttype, decode) in [
+                (None, 'application/x-marshal', marshal.loads),
+                ('application/json', 'application/json', json.loads),
+                ('application/json;q=0.5, application/x-marshal',
+                 'application/x-marshal', marshal.loads)]:
+            m_request = self._binary_request(
+                'POST', [],
+                marshal.dumps([u'create_session', {}]),
+                {'content-type': 'application/x-marshal; x=y',
+                 'accept': accept})
+
+            self.tar.render(m_request)
+
+            m_request.setHeader.assert_any_call('Content-Type', contenttype)
+            self.assertEqual(
+                {'session': 'fake entropy'.encode('hex')},
+                decode(''.join(c[1][0] for c in m_request.write.mock_calls)),
+                accept)
+
+    def test_GET_session_poll_binary(self):
+        sid = 'FAKE_SESSION_ID'
+        msgs = [['reply', {'id': 0, 'result': ['data', 'yum']}]]
+        self._add_marshal_codec()
+
+        m_session = MagicMock(name='SessionInstance')
+        m_session.gather_outgoing_messages.return_value = msgs
+        self.tar._sessions[sid] = m_session
+
+        m_request = self._binary_request(
+            'GET', [sid], '', {'accept': 'application/x-marshal'})
+        self.tar.render(m_request)
+
+        self.assertEqual(
+            [call.write(marshal.dumps(msgs))],
+            m_request.write.mock_calls)
+
+    def test_error_POST_binary_codec_not_installed(self):
+        self.tar._binarycodecs['application/x-marshal'] = None
+
+        m_request = self._binary_request(
+            'POST', [],
+            marshal.dumps([u'create_session', {}]),
+            {'content-type': 'application/x-marshal'})
+        self.tar.render(m_request)
+
+        m_request.setResponseCode.assert_called_once_with(415)
+        m_request.setHeader.assert_any_call(
+            'Content-Type', 'application/json')
+        m_request.write.assert_called_once_with(
+            json.dumps(
+                {'template': error.UnsupportedMediaType.Template,
+                 'params': {'mediatype': 'application/x-marshal'}},
+                separators=(',', ':')))
+
+    def test_error_POST_malformed_binary(self):
+        self._add_marshal_codec()
+
+        m_request = self._binary_request(
+            'POST', [],
+            marshal.dumps(['create_session', {}]),
+            {'content-type': 'application/x-marshal'})
+        self.tar.render(m_request)
+
+        m_request.setResponseCode.assert_called_once_with(400)
+        self.assertEqual(
+            {'template': error.MalformedDocument.Template,
+             'params': {'format': 'marshal'}},
+            marshal.loads(m_request.write.call_args[0][0]))
+
+    def test_accepted_media_types(self):
+        for (header, expected) in [
+                (None, ['']),
+                ('*/*', ['*/*']),
+                ('text/html, application/msgpack;q=0.9, */*;q=0.1',
+                 ['text/html', 'application/msgpack', '*/*']),
+                ('application/json;q=0, application/msgpack',
+                 ['application/msgpack'])]:
+            self.assertEqual(
+                expected,
+                apiresource._accepted_media_types(header),
+                header)
+
+    def test_empty_batch(self):
+        m_request = MagicMock(name='Request')
+        self.tar._write_json(m_request, [])
+
+        check_mock(self, m_request, [call.write('[]')])
+
+    def test_idle_session_expires(self):
+        sid = 'FAKE_SESSION_ID'
+        m_session = MagicMock(name='SessionInstance')
+        self.tar._sessions[sid] = m_session
+
+        self.clock.advance(300)
+
+        check_mock(
+            self, m_session,
+            [call.close(EqCb(lambda e: isinstance(e, error.SessionClosed)))])
+
+        self._make_request(
+            'GET', [sid],
+            None,
+            True, 400,
+            {"template": error.InvalidParameter.Template,
+             "params": {"name": "session"}})
+
+    def test_POST_session_message_batch(self):
+        sid = 'FAKE_SESSION_ID'
+        msgs = ['@LIST', ['call', {}], ['reply', {}]]
+
+        m_session = MagicMock(name='SessionInstance')
+        m_session.receive_messages.return_value = []
+        self.tar._sessions[sid] = m_session
+
+        self._make_request(
+            'POST', [sid],
+            msgs,
+            True, 200,
+            'ok')
+
+        check_mock(
+            self, m_session,
+            [call.receive_messages(
+                EqCb(lambda lp: lp.unwrap() == [('call', {}),
+                                                ('reply', {})]))])
+
+    def test_POST_session_message_batch_errors(self):
+        sid = 'FAKE_SESSION_ID'
+        errors = [[1, {'template': 'bad', 'params': {}}]]
+
+        m_session = MagicMock(name='SessionInstance')
+        m_session.receive_messages.return_value = errors
+        self.tar._sessions[sid] = m_session
+
+        self._make_request(
+            'POST', [sid],
+            ['@LIST', ['call', {}], ['bogus', {}]],
+            True, 200,
+            {'errors': errors})
+
     # Test many error input conditions:
     def test_unexpected_internal_error(self):
         # Violate the interface to cause an "unexpected" error:
-        @self.tar._method_handlers.register
-        def _handle_GET(req):
-            assert False, 'Intentional test corruption.'
+        with patch.object(self.tar, '_get_session') as m_get_session:
+            m_get_session.side_effect = AssertionError(
+                'Intentional test corruption.')
 
-        self._make_request(
-            'GET', [],
-            None,
-            False, 400,
-            {"template": error.InternalError.Template,
-             "params": {}})
+            self._make_request(
+                'GET', [],
+                None,
+                True, 400,
+                {"template": error.InternalError.Template,
+                 "params": {}})
 
     def test_error_GET(self):
         self._make_request(
@@ -154,6 +639,64 @@ class ThinAPIResourceTests (TestCase):
             {"template": error.InvalidParameter.Template,
              "params": {"name": "session"}})
 
+    def test_error_POST_content_length_too_large(self):
+        m_request = MagicMock(name='Request')
+        m_request.method = 'POST'
+        m_request.postpath = []
+        m_request.getHeader.return_value = str(DefaultMaxBodySize + 1)
+
+        self.tar.render(m_request)
+
+        body = json.dumps(
+            {"template": error.RequestBodyTooLarge.Template,
+             "params": {"limit": DefaultMaxBodySize}},
+            separators=(',', ':'))
+
+        # The body is never read:
+        check_mock(
+            self, m_request,
+            _NegotiationCalls + [
+             call.getHeader('content-length'),
+             call.setResponseCode(413),
+             call.setHeader('Content-Type', 'application/json'),
+             call.setHeader('Vary', 'Accept-Encoding'),
+             call.getHeader('accept-encoding'),
+             call.write(body),
+             call.finish()])
+
+    def test_error_POST_body_too_large(self):
+        self.tar = ThinAPIResource(
+            self.m_createsession, clock=self.clock, max_body_size=8)
+
+        m_request = MagicMock(name='Request')
+        m_request.getHeader.return_value = None
+        m_request.content.read.return_value = '["create_session", {}]'[:9]
+
+        self.assertRaises(
+            error.RequestBodyTooLarge,
+            self.tar._read_body,
+            m_request)
+
+        check_mock(
+            self, m_request,
+            [call.getHeader('content-length'),
+             call.content.read(9)])
+
+    def test_error_POST_invalid_content_length(self):
+        for length in ['twelve', '-1']:
+            m_request = MagicMock(name='Request')
+            m_request.getHeader.return_value = length
+
+            self.assertRaises(
+                error.InvalidContentLength,
+                self.tar._read_body,
+                m_request)
+
+            # The body is never read:
+            check_mock(
+                self, m_request,
+                [call.getHeader('content-length')])
+
     def test_error_POST_malformed_json(self):
         self._make_request(
             'POST', [],
@@ -163,12 +706,46 @@ class ThinAPIResourceTests (TestCase):
              "params": {}})
 
     # Helper code:
+    def _add_marshal_codec(self):
+        # marshal stands in for msgpack, which may not be installed:
+        self.tar._binarycodecs['application/x-marshal'] = BinaryCodec(
+            'marshal',
+            'application/x-marshal',
+            marshal.loads,
+            marshal.dumps,
+            (ValueError, EOFError, TypeError))
+
+    def _binary_request(self, method, postpath, body, headers):
+        m_request = MagicMock(name='Request')
+        m_request.method = method
+        m_request.postpath = postpath
+        m_request.content.read.return_value = body
+        m_request.getHeader.side_effect = headers.get
+        return m_request
+
+    def _start_event_stream(self):
+        sid = 'FAKE_SESSION_ID'
+        s = session.Session(_App(), clock=self.clock, polltimeout=30)
+        self.tar._sessions[sid] = s
+
+        finishd = defer.Deferred()
+        m_request = MagicMock(name='Request')
+        m_request.method = 'GET'
+        m_request.postpath = [sid, 'events']
+        m_request.content.read.return_value = ''
+        m_request.getHeader.return_value = None
+        m_request.notifyFinish.return_value = finishd
+
+        self.assertEqual(server.NOT_DONE_YET, self.tar.render(m_request))
+        return (s, m_request, finishd)
+
     def _make_request(
             self,
             method, postpath, reqbody,
-            resreadsreq, rescode, resbody):
+            resreadsreq, rescode, resbody,
+            extracalls=[]):
 
-        m_request = MagicMock(name='Request')
+        m_request = self.m_request = MagicMock(name='Request')
         m_request.method = method
         m_request.postpath = postpath
         if reqbody is None:
@@ -179,19 +756,51 @@ class ThinAPIResourceTests (TestCase):
             readrv = json.dumps(reqbody, indent=2)
 
         m_request.content.read.return_value = readrv
+        m_request.getHeader.return_value = None
 
         r = self.tar.render(m_request)
 
         self.assertEqual(r, server.NOT_DONE_YET)
 
-        expected = [
+        expected = extracalls + [
             call.setResponseCode(rescode),
             call.setHeader('Content-Type', 'application/json'),
-            call.write(json.dumps(resbody, indent=2)),
+            call.setHeader('Vary', 'Accept-Encoding'),
+            call.getHeader('accept-encoding'),
+            call.write(json.dumps(resbody, separators=(',', ':'))),
             call.finish(),
         ]
 
-        if resreadsreq:
-            expected.insert(0, call.content.read())
+        if resreadsreq and method == 'GET':
+            expected.insert(0, call.content.read(1))
+        elif resreadsreq:
+            expected[:0] = [
+                call.getHeader('content-length'),
+                call.content.read(DefaultMaxBodySize + 1),
+                call.getHeader('content-encoding'),
+            ]
+
+        expected[:0] = _NegotiationCalls
 
         check_mock(self, m_request, expected)
+
+
+class ThinAPIResourceEagerParserTests (ThinAPIResourceTests):
+    def setUp(self):
+        ThinAPIResourceTests.setUp(self)
+        self.tar = ThinAPIResource(
+            self.m_createsession,
+            clock=self.clock,
+            parser=EagerParser)
+
+
+_NegotiationCalls = [
+    call.getHeader('content-type'),
+    call.getHeader('accept'),
+]
+
+
+@Referenceable
+class _App (object):
+    def __init__(self):
+        pass
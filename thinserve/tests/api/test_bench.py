@@ -0,0 +1,87 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+from unittest import TestCase, skipUnless
+import thinserve
+from thinserve.api import bench
+
+
+class SummaryTests (TestCase):
+    def test_percentile(self):
+        samples = range(1, 1001)
+        for (p, expected) in [(50, 500), (99, 990), (99.9, 999), (100, 1000)]:
+            self.assertEqual(expected, bench.percentile(samples, p), p)
+
+        self.assertEqual(7, bench.percentile([7], 99.9))
+
+    def test_summarize(self):
+        self.assertEqual(
+            {'count': 4, 'mean': 2.5, 'p50': 2, 'p99': 4, 'p999': 4,
+             'max': 4},
+            bench.summarize([4.0, 1.0, 3.0, 2.0]))
+
+    def test_summarize_nothing(self):
+        self.assertEqual({'count': 0}, bench.summarize([]))
+
+    def test_warmup_calls_are_not_measured(self):
+        stats = bench._Stats()
+        stats.start()
+        stats.replied(stats._started - 1, stats._started + 1)
+        stats.replied(stats._started, stats._started + 1)
+
+        self.assertEqual(1, stats.summarize()['calls'])
+
+    def test_rates_without_recording(self):
+        results = bench._Stats().summarize()
+
+        self.assertEqual(
+            (None, None),
+            (results['calls_per_second'], results['messages_per_second']))
+        json.dumps(results, allow_nan=False)
+
+
+@skipUnless(sys.platform.startswith('linux'), 'Reads /proc for RSS.')
+class BenchProcessTests (TestCase):
+    '''Run a short benchmark against a real server.'''
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_results(self):
+        output = os.path.join(self.dir, 'results.json')
+
+        # The package may be used in place rather than installed:
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(thinserve.__file__))] +
+            filter(None, [env.get('PYTHONPATH')]))
+
+        subprocess.check_call(
+            [sys.executable, '-m', 'thinserve.api.bench',
+             '--clients', '2',
+             '--pipeline', '2',
+             '--duration', '0.5',
+             '--warmup', '0.2',
+             '--params', '{"value": "hello"}',
+             '--output', output],
+            env=env)
+
+        with open(output) as f:
+            results = json.load(f)
+
+        self.assertEqual(
+            (2, 0, 2),
+            (results['clients'],
+             results['errors'],
+             results['create_session_seconds']['count']))
+        self.assertGreater(results['calls'], 0)
+        self.assertEqual(
+            results['calls'],
+            results['latency_seconds']['count'])
+        self.assertLessEqual(
+            results['latency_seconds']['p50'],
+            results['latency_seconds']['p999'])
+        self.assertGreater(results['server']['end']['rss_bytes'], 0)
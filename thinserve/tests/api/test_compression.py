@@ -0,0 +1,118 @@
+import zlib
+from unittest import TestCase
+from mock import MagicMock, call
+from thinserve.api import compression
+from thinserve.api.compression import ResponseWriter
+from thinserve.proto import error
+from thinserve.tests.testutil import check_mock
+
+
+class ResponseWriterTests (TestCase):
+    def test_small_response_is_not_compressed(self):
+        m_request = MagicMock(name='Request')
+        w = ResponseWriter(m_request, 'gzip', minsize=10)
+        w.write('abc')
+        w.write('def')
+        w.close()
+
+        check_mock(self, m_request, [call.write('abcdef')])
+
+    def test_large_response_is_compressed(self):
+        for (encoding, wbits) in compression.Encodings:
+            m_request = MagicMock(name='Request')
+            w = ResponseWriter(m_request, encoding, minsize=10)
+            for i in range(100):
+                w.write('["message", {}]'.format(i))
+            w.close()
+
+            self.assertEqual(
+                call.setHeader('Content-Encoding', encoding),
+                m_request.mock_calls[0])
+
+            body = ''.join(c[1][0] for c in m_request.write.mock_calls)
+            self.assertEqual(
+                ''.join('["message", {}]'.format(i) for i in range(100)),
+                zlib.decompress(body, wbits))
+            self.assertLess(len(body), 1000)
+
+    def test_no_encoding(self):
+        m_request = MagicMock(name='Request')
+        w = ResponseWriter(m_request, None, minsize=0)
+        w.write('abc')
+        w.close()
+
+        check_mock(self, m_request, [call.write('abc')])
+
+    def test_choose_encoding(self):
+        for (header, expected) in [
+                (None, None),
+                ('identity', None),
+                ('deflate', 'deflate'),
+                ('deflate, gzip', 'gzip'),
+                ('gzip;q=0, deflate', 'deflate'),
+                ('gzip;q=0.5, deflate', 'deflate'),
+                ('deflate;q=0.5, gzip;q=0.5', 'gzip'),
+                ('*;q=0.1, deflate', 'deflate'),
+                ('identity, gzip;q=0.5', None),
+                ('*', 'gzip')]:
+            self.assertEqual(
+                expected,
+                compression.choose_encoding(header),
+                header)
+
+    def test_accepts_encoding(self):
+        for (header, encoding, expected) in [
+                (None, 'gzip', False),
+                ('gzip', 'gzip', True),
+                ('GZIP', 'gzip', True),
+                ('gzip;q=0', 'gzip', False),
+                ('gzip; q=0.5', 'gzip', True),
+                ('deflate', 'gzip', False),
+                ('*', 'gzip', True),
+                ('*;q=0', 'gzip', False)]:
+            self.assertEqual(
+                expected,
+                compression.accepts_encoding(header, encoding),
+                (header, encoding))
+
+
+class DecompressTests (TestCase):
+    def test_encodings(self):
+        text = '["create_session", {}]'
+        for (encoding, body) in [
+                (None, text),
+                ('identity', text),
+                ('gzip', _compress(text, 16 + zlib.MAX_WBITS)),
+                ('Deflate', _compress(text, zlib.MAX_WBITS))]:
+            self.assertEqual(
+                text,
+                compression.decompress(body, encoding, 100),
+                encoding)
+
+    def test_decompressed_size_is_limited(self):
+        body = _compress('x' * 10 ** 6, 16 + zlib.MAX_WBITS)
+
+        self.assertLess(len(body), 10 ** 4)
+        self.assertRaises(
+            error.RequestBodyTooLarge,
+            compression.decompress,
+            body, 'gzip', 10 ** 4)
+
+    def test_unsupported_encoding(self):
+        self.assertRaises(
+            error.UnsupportedContentEncoding,
+            compression.decompress,
+            'abc', 'br', 100)
+
+    def test_corrupt_body(self):
+        for body in ['not gzip',
+                     _compress('abc', 16 + zlib.MAX_WBITS) + 'trailer']:
+            self.assertRaises(
+                error.CorruptRequestBody,
+                compression.decompress,
+                body, 'gzip', 100)
+
+
+def _compress(text, wbits):
+    c = zlib.compressobj(6, zlib.DEFLATED, wbits)
+    return c.compress(text) + c.flush()
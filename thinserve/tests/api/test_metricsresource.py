@@ -0,0 +1,17 @@
+from unittest import TestCase
+from mock import MagicMock, call, patch
+from thinserve.api.metricsresource import MetricsResource
+from thinserve.tests.testutil import check_mock
+
+
+class MetricsResourceTests (TestCase):
+    @patch('thinserve.api.metricsresource.Metrics')
+    def test_render_GET(self, m_Metrics):
+        m_request = MagicMock(name='Request')
+
+        body = MetricsResource().render_GET(m_request)
+
+        self.assertIs(m_Metrics.render.return_value, body)
+        check_mock(
+            self, m_request,
+            [call.setHeader('Content-Type', m_Metrics.ContentType)])
@@ -1,5 +1,10 @@
+import weakref
 from unittest import TestCase
+from mock import patch
 from thinserve.api.referenceable import Referenceable
+from thinserve.proto import error
+from thinserve.proto.executors import Executors
+from thinserve.proto.lazyparser import LazyParser
 
 
 class ReferenceableTests (TestCase):
@@ -66,3 +71,116 @@ class ReferenceableTests (TestCase):
         brm = Referenceable._get_bound_methods(i)
         self.assertEqual(['foo'], brm.keys())
         self.assertEqual((i, 17), brm['foo'](x=17))
+
+    def test_pos_method_with_schema(self):
+
+        @Referenceable
+        class C (object):
+            @Referenceable.Method(schema={'x': int})
+            def foo(self, x):
+                return (self, x)
+
+            @Referenceable.Method_without_prefix('_remote_', schema={})
+            def _remote_bar(self):
+                return self
+
+        i = C()
+
+        self.assertEqual((i, 42), i.foo(42))
+
+        dispatchers = Referenceable._get_dispatchers(i)
+        self.assertEqual(['bar', 'foo'], sorted(dispatchers.keys()))
+        self.assertEqual((i, 17), dispatchers['foo'](LazyParser({'x': 17})))
+        self.assertIs(i, dispatchers['bar'](LazyParser({})))
+        self.assertRaises(
+            error.UnexpectedType,
+            dispatchers['foo'],
+            LazyParser({'x': 'seventeen'}))
+
+    def test_pos_dispatcher_without_schema_gets_parsers(self):
+
+        @Referenceable
+        class C (object):
+            @Referenceable.Method
+            def foo(self, x):
+                return x
+
+        dispatchers = Referenceable._get_dispatchers(C())
+        self.assertIsInstance(
+            dispatchers['foo'](LazyParser({'x': 17})),
+            LazyParser)
+
+    def test_preparers(self):
+
+        @Referenceable
+        class C (object):
+            @Referenceable.Method(schema={'x': int})
+            def foo(self, x):
+                return x
+
+            @Referenceable.Method
+            def bar(self, y):
+                return y
+
+        i = C()
+        preparers = Referenceable._get_preparers(i)
+        self.assertEqual(['bar', 'foo'], sorted(preparers.keys()))
+
+        (prepare, m) = preparers['foo']
+        self.assertEqual({'x': 17}, prepare(LazyParser({'x': 17})))
+        self.assertEqual(i.foo, m)
+
+        (prepare, m) = preparers['bar']
+        kwargs = prepare(LazyParser({'y': 3}))
+        self.assertEqual(['y'], kwargs.keys())
+        self.assertEqual(3, kwargs['y'].unwrap())
+        self.assertRaises(
+            error.MissingStructKeys,
+            prepare,
+            LazyParser({}))
+
+    def test_executor_methods(self):
+
+        @Referenceable
+        class C (object):
+            @Referenceable.Method(schema={'x': int}, executor='threads')
+            def foo(self, x):
+                return x
+
+        i = C()
+        (prepare, run) = Referenceable._get_preparers(i)['foo']
+
+        with patch.object(Executors, 'submit') as m_submit:
+            d = run(**prepare(LazyParser({'x': 17})))
+
+        self.assertIs(m_submit.return_value, d)
+        m_submit.assert_called_once_with('threads', i.foo, {'x': 17})
+
+    def test_dispatch_does_not_keep_instances(self):
+
+        @Referenceable
+        class C (object):
+            @Referenceable.Method
+            def foo(self):
+                return 'x'
+
+            @Referenceable.Method(schema={}, executor='threads')
+            def bar(self):
+                return 'y'
+
+        i = C()
+        Referenceable._get_dispatchers(i)['foo'](LazyParser({}))
+        Referenceable._get_bound_methods(i)
+        ref = weakref.ref(i)
+        del i
+
+        self.assertIsNone(ref())
+
+    def test_process_methods_need_a_schema(self):
+        def f(self):
+            pass
+
+        self.assertRaises(
+            AssertionError, Referenceable.Method(executor='processes'), f)
+        self.assertRaises(
+            AssertionError, Referenceable.Method(executor='fibers'), f)
@@ -2,32 +2,44 @@ import os
 from unittest import TestCase
 from mock import call, patch, sentinel
 from thinserve.api.resource import ThinResource
+from thinserve.proto.metrics import Metrics
 
 
 class ThinResourceTests (TestCase):
+    @patch('thinserve.api.metricsresource.MetricsResource')
     @patch('thinserve.api.apiresource.ThinAPIResource')
     @patch('thinserve.api.resource.ThinResource.putChild')
-    @patch('twisted.web.static.File')
+    @patch('thinserve.api.staticresource.AssetManifest')
+    @patch('thinserve.api.staticresource.AssetCache')
+    @patch('thinserve.api.staticresource.StaticFile')
+    @patch('twisted.web.static.Data')
     @patch('pkg_resources.resource_filename')
     @patch('os.listdir')
     def test__init__(self,
                      m_listdir,
                      m_resource_filename,
+                     m_Data,
                      m_File,
+                     m_AssetCache,
+                     m_AssetManifest,
                      m_putChild,
-                     m_ThinAPIResource):
+                     m_ThinAPIResource,
+                     m_MetricsResource):
 
         staticdir = os.path.join('fake', 'test', 'staticdir')
         childnames = ['child'+str(i) for i in range(7)]
         childpaths = [os.path.join(staticdir, cn) for cn in childnames]
 
         m_listdir.return_value = childnames
-        ThinResource(sentinel.apiroot, staticdir)
+        m_AssetManifest.return_value.as_dict.return_value = {
+            'child0': 'child0.0123'}
+        tr = ThinResource(sentinel.apiroot, staticdir)
 
         self.assertEqual(
             m_putChild.mock_calls,
             [call('api', m_ThinAPIResource.return_value),
-             call('ts', m_File.return_value)]
+             call('ts', m_File.return_value),
+             call('metrics', m_MetricsResource.return_value)]
             + [call(cn, m_File.return_value) for cn in childnames])
 
         self.assertEqual(
@@ -38,7 +50,43 @@ class ThinResourceTests (TestCase):
             m_resource_filename.mock_calls,
             [call('thinserve', 'web/static')])
 
+        cache = m_AssetCache.return_value
+        manifest = m_AssetManifest.return_value
+        self.assertIs(manifest, tr.manifest)
         self.assertEqual(
             m_File.mock_calls,
-            [call(m_resource_filename.return_value)]
-            + [call(p) for p in childpaths])
+            [call(staticdir, cache=cache, manifest=manifest),
+             call(m_resource_filename.return_value, cache=cache),
+             call().putChild('manifest.json', m_Data.return_value)]
+            + [call(p, cache=cache, manifest=manifest) for p in childpaths])
+
+        self.assertEqual(
+            m_Data.mock_calls,
+            [call('{"child0": "child0.0123"}', 'application/json')])
+
+        self.assertEqual(
+            m_AssetCache.mock_calls,
+            [call(),
+             call().preload(m_resource_filename.return_value),
+             call().preload(staticdir)])
+
+    @patch('thinserve.api.apiresource.ThinAPIResource')
+    @patch('thinserve.api.resource.ThinResource.putChild')
+    @patch('thinserve.api.staticresource.AssetCache')
+    @patch('thinserve.api.staticresource.StaticFile')
+    @patch('os.listdir')
+    def test__init__without_metrics(self,
+                                    m_listdir,
+                                    m_File,
+                                    m_AssetCache,
+                                    m_putChild,
+                                    m_ThinAPIResource):
+        m_listdir.return_value = []
+
+        ThinResource(sentinel.apiroot, 'staticdir', metrics=False)
+
+        self.assertEqual(
+            [c[1][0] for c in m_putChild.mock_calls],
+            ['api', 'ts'])
+        # Recording is a process-wide choice, left to the process:
+        self.assertEqual(True, Metrics.enabled)
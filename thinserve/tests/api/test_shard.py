@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import shutil
+import httplib
+import tempfile
+import subprocess
+from unittest import TestCase, skipUnless
+from mock import MagicMock
+from twisted.web import proxy
+import thinserve
+from thinserve.api.referenceable import Referenceable
+from thinserve.api.shard import Shard
+
+
+class ShardTests (TestCase):
+    def setUp(self):
+        self.shard = Shard(1, [8001, 8002, 8003])
+
+    def test_qualify(self):
+        self.assertEqual('1-abcd', self.shard.qualify('abcd'))
+
+    def test_route_sibling_session(self):
+        r = self.shard.route(self._make_request('2-abcd'))
+
+        self.assertIsInstance(r, proxy.ReverseProxyResource)
+        self.assertEqual(('127.0.0.1', 8003, '/api/2-abcd'),
+                         (r.host, r.port, r.path))
+
+    def test_route_sibling_event_stream(self):
+        r = self.shard.route(self._make_request('2-abcd', 'events'))
+
+        self.assertEqual('/api/2-abcd/events', r.path)
+
+    def test_route_local(self):
+        for postpath in [[], ['1-abcd'], ['abcd'], ['zz-abcd'], ['7-abcd'],
+                         ['1-abcd', 'events']]:
+            req = self._make_request(*postpath)
+            self.assertIsNone(self.shard.route(req), postpath)
+
+    def _make_request(self, *postpath):
+        m_request = MagicMock(name='Request')
+        m_request.postpath = list(postpath)
+        m_request.path = '/'.join(['/api'] + list(postpath))
+        return m_request
+
+
+@skipUnless(sys.platform.startswith('linux'), 'Needs fd inheritance.')
+class ShardProcessTests (TestCase):
+    '''Run a real sharded server and check session affinity.'''
+    Workers = 2
+
+    def setUp(self):
+        self.staticdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.staticdir)
+
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        self.port = s.getsockname()[1]
+        s.close()
+
+        # The package may be used in place rather than installed:
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(thinserve.__file__))] +
+            filter(None, [env.get('PYTHONPATH')]))
+
+        devnull = open(os.devnull, 'w')
+        self.addCleanup(devnull.close)
+
+        self.proc = subprocess.Popen(
+            [sys.executable, '-m', 'thinserve.api.shard',
+             '--workers', str(self.Workers),
+             '--port', str(self.port),
+             '--interface', '127.0.0.1',
+             '--site-params', json.dumps({'pretty': True}),
+             '--site-config', __name__ + ':site_config',
+             __name__ + ':PidApp',
+             self.staticdir],
+            env=env,
+            stderr=devnull)
+        self.addCleanup(self._stop)
+
+    def test_sessions_stick_to_their_worker(self):
+        sids = self._create_sessions_on_every_worker()
+
+        for sid in sids:
+            pids = set(self._call_pid(sid) for _ in range(4))
+            self.assertEqual(1, len(pids), (sid, pids))
+
+    def test_site_options_reach_workers(self):
+        self._create_session()
+
+        (status, body) = self._send('POST', '', ['create_session', {}])
+        self.assertEqual(200, status)
+        self.assertIn('\n', body)
+
+        (status, _) = self._send('POST', '', ['x' * 1024])
+        self.assertEqual(413, status)
+
+        # Whichever worker receives them, owner or sibling:
+        for sid in self._create_sessions_on_every_worker():
+            for _ in range(4):
+                (status, _) = self._send('POST', sid, ['x' * 5000])
+                self.assertEqual(413, status)
+
+    # Helper code:
+    def _stop(self):
+        if self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGTERM)
+        self.assertEqual(0, self.proc.wait())
+
+    def _create_sessions_on_every_worker(self):
+        # The kernel may favour one worker, so keep going until both own
+        # sessions:
+        sids = []
+        while set(sid.split('-')[0] for sid in sids) != set(['0', '1']):
+            self.assertLess(len(sids), 200, sids)
+            sids.append(self._create_session())
+        return sids
+
+    def _create_session(self):
+        # Workers may still be starting:
+        deadline = time.time() + 10
+        while True:
+            try:
+                return self._request('POST', '', ['create_session', {}])[
+                    'session']
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def _call_pid(self, sid):
+        self.assertEqual(
+            'ok',
+            self._request(
+                'POST', sid,
+                ['call', {'id': 0, 'target': None, 'method': ['pid', {}]}]))
+
+        [[_, reply]] = self._request('GET', sid)
+        return reply['result'][1]
+
+    def _request(self, method, path, body=None):
+        (status, text) = self._send(method, path, body)
+        self.assertEqual(200, status)
+        return json.loads(text)
+
+    def _send(self, method, path, body=None):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        try:
+            conn.request(
+                method,
+                '/api/' + path if path else '/api',
+                None if body is None else json.dumps(body))
+            res = conn.getresponse()
+            return (res.status, res.read())
+        finally:
+            conn.close()
+
+
+def site_config():
+    return {'max_body_size': 1024}
+
+
+@Referenceable
+class PidApp (object):
+    def __init__(self):
+        pass
+
+    @Referenceable.Method
+    def pid(self):
+        return os.getpid()
@@ -1,6 +1,6 @@
 from unittest import TestCase
-from mock import call, patch, sentinel, ANY
-from thinserve.api.site import ThinSite
+from mock import MagicMock, call, patch, sentinel, ANY
+from thinserve.api.site import ThinSite, ThinRequest
 
 
 class ThinSiteTests (TestCase):
@@ -18,6 +18,15 @@ class ThinSiteTests (TestCase):
             [call(m_reactor, 'tcp:4242'),
              call().listen(ts)])
 
+    @patch('thinserve.api.resource.ThinResource')
+    @patch('twisted.web.server.Site.__init__')
+    def test__init__apiparams(self, m_Site__init__, m_ThinResource):
+        ThinSite(sentinel.apiroot, sentinel.staticdir, codec='json')
+
+        self.assertEqual(
+            m_ThinResource.mock_calls,
+            [call(sentinel.apiroot, sentinel.staticdir, codec='json')])
+
     @patch('thinserve.api.resource.ThinResource')
     @patch('twisted.web.server.Site.__init__')
     def _test_init(self, m_Site__init__, m_ThinResource):
@@ -34,3 +43,28 @@ class ThinSiteTests (TestCase):
             [call(ANY, m_ThinResource.return_value)])
 
         return ts
+
+
+class ThinRequestTests (TestCase):
+    def test_body_buffering_stops_past_limit(self):
+        channel = MagicMock(name='channel')
+        channel.site.max_body_size = 4
+
+        req = ThinRequest(channel, False)
+        req.gotLength(None)
+        for chunk in ['abc', 'def', 'ghi']:
+            req.handleContentChunk(chunk)
+
+        req.content.seek(0)
+        self.assertEqual('abcde', req.content.read())
+
+    def test_small_body_is_buffered(self):
+        channel = MagicMock(name='channel')
+        channel.site.max_body_size = 4
+
+        req = ThinRequest(channel, False)
+        req.gotLength(4)
+        req.handleContentChunk('abcd')
+
+        req.content.seek(0)
+        self.assertEqual('abcd', req.content.read())
@@ -0,0 +1,287 @@
+import os
+import shutil
+import hashlib
+import tempfile
+from unittest import TestCase
+from twisted.internet import task
+from twisted.web import http, server
+from twisted.web.test.requesthelper import DummyRequest
+from thinserve.api.staticresource import \
+    AssetCache, AssetManifest, StaticFile
+from thinserve.api import staticresource
+
+
+class StaticFileTests (TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.clock = task.Clock()
+        self.cache = AssetCache(clock=self.clock, maxsize=100)
+        self.jstype = StaticFile.contentTypes['.js']
+
+        self._write('app.js', 'var x;')
+        self._write('app.js.gz', 'gzipped')
+        self._write('app.js.br', 'brotlied')
+        self._write('big.txt', 'x' * 1000)
+
+    def test_cached_file(self):
+        req = self._get('app.js')
+
+        self.assertEqual(
+            (http.OK, 'var x;', self.jstype, '6'),
+            (req.responseCode,
+             ''.join(req.written),
+             req.outgoingHeaders['content-type'],
+             req.outgoingHeaders['content-length']))
+
+        # The file is not read again, or even stat'ed, until recheck:
+        os.remove(os.path.join(self.dir, 'app.js'))
+        self.assertEqual('var x;', ''.join(self._get('app.js').written))
+
+        self.clock.advance(1)
+        self.assertEqual(http.NOT_FOUND, self._get('app.js').responseCode)
+
+    def test_changed_file(self):
+        etag = self._etag(self._get('app.js'))
+
+        self._write('app.js', 'var y;')
+        self.clock.advance(1)
+        req = self._get('app.js')
+
+        self.assertEqual('var y;', ''.join(req.written))
+        self.assertNotEqual(etag, self._etag(req))
+
+    def test_if_none_match(self):
+        etag = self._etag(self._get('app.js'))
+
+        for header in [etag, 'W/' + etag, '"other", ' + etag, '*']:
+            req = self._get('app.js', **{'if-none-match': header})
+            self.assertEqual(
+                (http.NOT_MODIFIED, ''),
+                (req.responseCode, ''.join(req.written)),
+                header)
+
+        req = self._get('app.js', **{'if-none-match': '"other"'})
+        self.assertEqual(http.OK, req.responseCode)
+
+    def test_precompressed_siblings(self):
+        for (accept, body, encoding) in [
+                (None, 'var x;', None),
+                ('gzip', 'gzipped', 'gzip'),
+                ('gzip, deflate, br', 'brotlied', 'br'),
+                ('br;q=0, gzip', 'gzipped', 'gzip'),
+                ('*', 'brotlied', 'br'),
+                ('*, br;q=0', 'gzipped', 'gzip')]:
+            req = self._get('app.js', **{'accept-encoding': accept})
+
+            self.assertEqual(
+                (body, encoding, self.jstype),
+                (''.join(req.written),
+                 req.outgoingHeaders.get('content-encoding'),
+                 req.outgoingHeaders['content-type']),
+                accept)
+            self.assertEqual(
+                'accept-encoding',
+                req.outgoingHeaders['vary'])
+
+    def test_variants_have_their_own_etags(self):
+        plain = self._etag(self._get('app.js'))
+        gzipped = self._etag(
+            self._get('app.js', **{'accept-encoding': 'gzip'}))
+
+        self.assertNotEqual(plain, gzipped)
+
+    def test_large_file_is_streamed(self):
+        req = self._get('big.txt')
+
+        self.assertEqual(
+            (http.OK, 'x' * 1000),
+            (req.responseCode, ''.join(req.written)))
+        self.assertIsNotNone(self._etag(req))
+
+    def test_head(self):
+        for (name, size) in [('app.js', '6'), ('big.txt', '1000')]:
+            req = self._get(name, method='HEAD')
+            self.assertEqual(
+                (size, ''),
+                (req.outgoingHeaders['content-length'],
+                 ''.join(req.written)))
+
+    def test_directory_children_share_the_cache(self):
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        self._write(os.path.join('sub', 'a.css'), 'a {}')
+
+        root = StaticFile(self.dir, cache=self.cache)
+        req = DummyRequest(['a.css'])
+        child = root.getChild('sub', req).getChild('a.css', req)
+
+        self.assertIs(self.cache, child._cache)
+        self.assertEqual('a {}', ''.join(self._render(child, req).written))
+
+    def test_fingerprinted_child(self):
+        manifest = AssetManifest(self.dir)
+        root = StaticFile(self.dir, cache=self.cache, manifest=manifest)
+        name = manifest.url('app.js')[1:]
+
+        req = DummyRequest([])
+        child = root.getChild(name, req)
+        self._render(child, req)
+
+        self.assertEqual(
+            ('var x;', StaticFile.ImmutableCacheControl),
+            (''.join(req.written), req.outgoingHeaders['cache-control']))
+
+        req = self._get('app.js')
+        self.assertNotIn('cache-control', req.outgoingHeaders)
+
+    def test_changed_fingerprinted_file_is_not_found(self):
+        manifest = AssetManifest(self.dir, self.cache)
+        root = StaticFile(self.dir, cache=self.cache, manifest=manifest)
+        name = manifest.url('app.js')[1:]
+
+        self._write('app.js', 'var changed;')
+        self.clock.advance(1)
+
+        req = DummyRequest([])
+        child = root.getChild(name, req)
+        self.assertEqual(
+            http.NOT_FOUND,
+            self._render(child, req).responseCode)
+
+    def test_unknown_fingerprint(self):
+        manifest = AssetManifest(self.dir)
+        root = StaticFile(self.dir, cache=self.cache, manifest=manifest)
+        req = DummyRequest([])
+        child = root.getChild('app.0123456789abcdef.js', req)
+
+        self.assertEqual(
+            http.NOT_FOUND,
+            self._render(child, req).responseCode)
+
+    # Helper code:
+    def _write(self, name, body):
+        with open(os.path.join(self.dir, name), 'wb') as f:
+            f.write(body)
+
+    def _get(self, name, method='GET', **headers):
+        req = DummyRequest([])
+        req.method = method
+        for (k, v) in headers.iteritems():
+            if v is not None:
+                req.headers[k] = v
+
+        f = StaticFile(os.path.join(self.dir, name), cache=self.cache)
+        return self._render(f, req)
+
+    def _render(self, resource, req):
+        result = resource.render(req)
+        if result is not server.NOT_DONE_YET:
+            req.write(result)
+            req.finish()
+        self.assertTrue(req.finished)
+        return req
+
+    def _etag(self, req):
+        return req.outgoingHeaders['etag']
+
+
+class AssetCacheTests (TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.clock = task.Clock()
+
+    def test_missing_and_non_files(self):
+        cache = AssetCache(clock=self.clock)
+        self.assertIsNone(cache.get(os.path.join(self.dir, 'nope')))
+        self.assertIsNone(cache.get(self.dir))
+
+    def test_lru_contents(self):
+        cache = AssetCache(clock=self.clock, maxbytes=10)
+        paths = [self._write(name, '12345') for name in 'abc']
+
+        for p in paths:
+            cache.get(p)
+
+        self.assertEqual(
+            [None, '12345', '12345'],
+            [cache.get(p)[2] for p in paths])
+        self.assertEqual(10, cache._cachedbytes)
+
+    def test_digest(self):
+        cache = AssetCache(clock=self.clock, maxsize=5)
+        paths = [self._write(name, body)
+                 for (name, body) in [('small', 'abc'), ('large', 'abcdef')]]
+
+        self.assertEqual(
+            [hashlib.sha1('abc').hexdigest(),
+             hashlib.sha1('abcdef').hexdigest(),
+             None],
+            [cache.digest(p) for p in paths + [self.dir]])
+
+        self._write('large', 'changed')
+        self.clock.advance(1)
+        self.assertEqual(
+            hashlib.sha1('changed').hexdigest(),
+            cache.digest(paths[1]))
+
+    def test_preload(self):
+        cache = AssetCache(clock=self.clock)
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        path = self._write(os.path.join('sub', 'x'), 'hello')
+
+        cache.preload(self.dir)
+
+        self.assertEqual(['hello'], cache._contents.values())
+        self.assertEqual('hello', cache.get(path)[2])
+
+    def _write(self, name, body):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(body)
+        return path
+
+
+class AssetManifestTests (TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        os.mkdir(os.path.join(self.dir, 'js'))
+        self.app = self._write(os.path.join('js', 'app.js'), 'var x;')
+        self._write(os.path.join('js', 'app.js.gz'), 'gzipped')
+        self._write('index.html', '<html/>')
+
+    def test_names(self):
+        manifest = AssetManifest(self.dir)
+        digest = staticresource._hash_file(self.app)[:16]
+
+        self.assertEqual(
+            {'js/app.js': 'js/app.{}.js'.format(digest),
+             'index.html': 'index.{}.html'.format(
+                 staticresource._hash_file(
+                     os.path.join(self.dir, 'index.html'))[:16])},
+            manifest.as_dict())
+        self.assertEqual(
+            '/js/app.{}.js'.format(digest),
+            manifest.url('js/app.js'))
+
+    def test_names_change_with_contents(self):
+        before = AssetManifest(self.dir).url('js/app.js')
+        self._write(os.path.join('js', 'app.js'), 'var y;')
+        after = AssetManifest(self.dir).url('js/app.js')
+
+        self.assertNotEqual(before, after)
+
+    def test_resolve(self):
+        manifest = AssetManifest(self.dir)
+        fppath = os.path.join(self.dir, manifest.url('js/app.js')[1:])
+
+        self.assertEqual(self.app, manifest.resolve(fppath))
+        self.assertIsNone(manifest.resolve(self.app))
+
+    def _write(self, name, body):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(body)
+        return path
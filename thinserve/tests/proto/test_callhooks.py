@@ -0,0 +1,36 @@
+import pstats
+from unittest import TestCase
+from thinserve.proto.callhooks import CallInfo, SamplingProfiler
+
+
+class SamplingProfilerTests (TestCase):
+    def test_profiles_one_call_in_every(self):
+        reports = []
+        sp = SamplingProfiler(3, lambda info, stats: reports.append(
+            (info, stats)))
+
+        infos = [CallInfo('SID', None) for _ in range(7)]
+        for info in infos:
+            sp.call_started(info)
+            sum(range(100))
+            sp.call_returned(info)
+            sp.call_finished(info)
+
+        self.assertEqual(
+            [infos[2], infos[5]],
+            [info for (info, _) in reports])
+        for (_, stats) in reports:
+            self.assertIsInstance(stats, pstats.Stats)
+            self.failUnless(stats.total_calls > 0)
+
+
+class CallInfoTests (TestCase):
+    def test_result_size(self):
+        info = CallInfo('SID', None)
+        info.result = ['@LIST', 'fig']
+        self.assertEqual(len('["@LIST","fig"]'), info.result_size)
+
+    def test_result_size_of_unencodable_result(self):
+        info = CallInfo('SID', None)
+        info.result = object()
+        self.assertIsNone(info.result_size)
@@ -0,0 +1,197 @@
+import marshal
+from unittest import TestCase, skipUnless
+from thinserve.proto import codec, error
+from thinserve.proto.lazyparser import LazyParser
+
+
+WellFormed = [
+    'null', 'true', 'false',
+    '0', '-1', '42', '99999999999999999999999', '1.5', '1e308',
+    '""', '"banana"', '"caf\\u00e9"', '"\\ud800"',
+    '[]', '["@LIST"]', '["@LIST", 1, "two", null]',
+    '{}', '{"x": 42}',
+    '["call", {"id": 0, "target": null,'
+    ' "method": ["eat", {"fruit": "apple"}]}]',
+    ' [ "my_variant" , [ "@LIST" , { "x" : [ "@LIST" ] } ] ] ',
+]
+
+Malformed = [
+    '',
+    'mangled JSON',
+    '{',
+    '[1,]',
+    '{"a": 1,}',
+    '{"a" 1}',
+    '"unterminated',
+    '[1] x',
+    '[01]',
+    'NaN',
+    '[Infinity]',
+    '1e999',
+    '[-1e999]',
+    '\xff',
+]
+
+
+class CodecConformanceTests (TestCase):
+    def setUp(self):
+        self.reference = codec.get_codec('json')
+        self.codecs = [codec.get_codec(n) for n in codec.available_codecs()]
+
+    def test_stdlib_is_always_available(self):
+        self.assertIn('json', codec.available_codecs())
+
+    def test_default_is_most_preferred(self):
+        self.assertEqual(
+            codec.available_codecs()[0],
+            codec.get_codec().name)
+
+    def test_decode_same_parser_inputs(self):
+        for c in self.codecs:
+            for text in WellFormed:
+                expected = self.reference.decode(text)
+                actual = c.decode(text)
+
+                self.assertEqual(
+                    _typed(expected), _typed(actual), (c, text))
+
+                try:
+                    unwrapped = LazyParser(expected).unwrap()
+                except error.MalformedMessage:
+                    continue
+                self.assertEqual(
+                    _typed(unwrapped),
+                    _typed(LazyParser(actual).unwrap()),
+                    (c, text))
+
+    def test_decode_errors_map_to_MalformedJSON(self):
+        for c in self.codecs:
+            for text in Malformed:
+                self.assertRaises(
+                    error.MalformedJSON,
+                    c.decode,
+                    text)
+
+    def test_encode_round_trip(self):
+        for c in self.codecs:
+            for text in WellFormed:
+                obj = self.reference.decode(text)
+                for encode in [c.encode, c.encode_pretty]:
+                    self.assertEqual(
+                        _typed(obj),
+                        _typed(self.reference.decode(encode(obj))),
+                        (c, text))
+
+    def test_encode_rejects_non_finite_numbers(self):
+        for c in self.codecs:
+            for v in [float('nan'), float('inf'), -float('inf')]:
+                for encode in [c.encode, c.encode_pretty]:
+                    self.assertRaises(ValueError, encode, [v])
+
+    def test_compact_encoding(self):
+        for c in self.codecs:
+            self.assertEqual(
+                '{"x":[1,"y"]}',
+                c.encode({'x': [1, 'y']}))
+
+    def test_unknown_backend(self):
+        self.assertRaises(KeyError, codec.get_codec, 'no-such-codec')
+
+
+def _typed(v):
+    '''Pair each value with its type so 1 != True and str != unicode.'''
+    if isinstance(v, list):
+        return (list, [_typed(x) for x in v])
+    elif isinstance(v, tuple):
+        return (tuple, tuple(_typed(x) for x in v))
+    elif isinstance(v, dict):
+        return (dict, sorted((_typed(k), _typed(x)) for (k, x) in v.items()))
+    else:
+        return (type(v), v)
+
+
+class BinaryCodecTests (TestCase):
+    def setUp(self):
+        # marshal stands in for a binary format which may be missing:
+        self.codec = codec.BinaryCodec(
+            'marshal',
+            'application/x-marshal',
+            marshal.loads,
+            marshal.dumps,
+            (ValueError, EOFError, TypeError))
+
+    def test_decode_json_model(self):
+        reference = codec.get_codec('json')
+        for text in WellFormed:
+            obj = reference.decode(text)
+            self.assertEqual(
+                _typed(obj),
+                _typed(self.codec.decode(self.codec.encode(obj))),
+                text)
+
+    def test_decode_rejects_other_values(self):
+        for obj in ['bytes', [u'x', 'bytes'], {'key': u'value'}, {1: 2},
+                    (u'tuple',), float('nan'), [float('inf')],
+                    {u'x': float('-inf')}, {u'x': [set()]}]:
+            self.assertRaises(
+                error.MalformedDocument,
+                self.codec.decode,
+                marshal.dumps(obj))
+
+    def test_decode_errors_map_to_MalformedDocument(self):
+        for data in ['', '\xff', marshal.dumps(u'x')[:-1]]:
+            self.assertRaises(
+                error.MalformedDocument,
+                self.codec.decode,
+                data)
+
+    def test_deep_nesting(self):
+        obj = []
+        for _ in range(10000):
+            obj = [obj]
+
+        self.assertTrue(codec._has_json_model(obj))
+
+
+@skipUnless(
+    codec.get_binary_codec('application/msgpack'),
+    'msgpack is not installed')
+class MsgpackCodecTests (TestCase):
+    def setUp(self):
+        self.reference = codec.get_codec('json')
+        self.codec = codec.get_binary_codec('application/msgpack')
+
+    def test_round_trip(self):
+        for text in WellFormed:
+            obj = self.reference.decode(text)
+            if isinstance(obj, long) and obj >= 2 ** 64:
+                continue  # Beyond msgpack's integers.
+
+            actual = self.codec.decode(self.codec.encode(obj))
+
+            self.assertEqual(_typed(obj), _typed(actual), text)
+
+            try:
+                unwrapped = LazyParser(obj).unwrap()
+            except error.MalformedMessage:
+                continue
+            self.assertEqual(
+                _typed(unwrapped),
+                _typed(LazyParser(actual).unwrap()),
+                text)
+
+    def test_str_encodes_as_text(self):
+        self.assertEqual(
+            u'banana',
+            self.codec.decode(self.codec.encode('banana')))
+
+    def test_malformed(self):
+        import msgpack
+
+        for data in ['', '\xc1', msgpack.packb([1, 2])[:-1],
+                     msgpack.packb(msgpack.ExtType(1, 'x')),
+                     msgpack.packb('bytes', use_bin_type=True)]:
+            self.assertRaises(
+                error.MalformedDocument,
+                self.codec.decode,
+                data)
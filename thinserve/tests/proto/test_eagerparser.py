@@ -0,0 +1,94 @@
+from unittest import TestCase
+from mock import patch
+from thinserve.proto import error
+from thinserve.proto.eagerparser import EagerParser
+from thinserve.proto.lazyparser import LazyParser
+from thinserve.tests.proto import test_lazyparser as lazytests
+
+
+class _WithEagerParser (object):
+    '''Run a LazyParser test case against EagerParser instead.'''
+    def setUp(self):
+        patcher = patch.object(lazytests, 'LazyParser', EagerParser)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super(_WithEagerParser, self).setUp()
+
+
+class EagerParser_basic (_WithEagerParser, lazytests.LazyParser_basic):
+    def test_repr(self):
+        lp = EagerParser({'x': 42})
+        self.assertEqual("<EagerParser {'x': 42}>", repr(lp))
+
+
+class EagerParser_unwrap (_WithEagerParser, lazytests.LazyParser_unwrap):
+    pass
+
+
+class EagerParser_type_and_predicate (
+        _WithEagerParser,
+        lazytests.LazyParser_type_and_predicate):
+    pass
+
+
+class EagerParser_list (_WithEagerParser, lazytests.LazyParser_list):
+    pass
+
+
+class EagerParser_struct (_WithEagerParser, lazytests.LazyParser_struct):
+    pass
+
+
+class EagerParser_struct_protected_privileged_parameter (
+        _WithEagerParser,
+        lazytests.LazyParser_struct_protected_privileged_parameter):
+    pass
+
+
+class EagerParser_variant (_WithEagerParser, lazytests.LazyParser_variant):
+    pass
+
+
+class EagerParser_path (_WithEagerParser, lazytests.LazyParser_path):
+    pass
+
+
+class EagerParser_eager (TestCase):
+    _error_cases = [
+        ['foo'],
+        {'a': 1, 'b': ['@LIST', 0, {'c': ['x', 1, 2]}]},
+        ['tag', {'_bad': 1}],
+        ['@LIST', ['bad tag', 0]],
+    ]
+
+    def test_errors_match_lazy_unwrap(self):
+        for msg in self._error_cases:
+            lazyexc = self._catch(LazyParser(msg).unwrap)
+            eagerexc = self._catch(EagerParser(msg).unwrap)
+
+            self.assertEqual(type(lazyexc), type(eagerexc))
+            self.assertEqual(lazyexc.as_proto_object(),
+                             eagerexc.as_proto_object())
+
+    def test_whole_message_is_validated(self):
+        lp = EagerParser({'a': 1, 'b': ['@LIST', ['x', 1, 2]]})
+
+        exc = self._catch(lambda: lp.apply_struct(lambda a, b: None))
+        self.assertIsInstance(exc, error.MalformedList)
+        self.assertEqual('.b[0]', exc.path)
+
+    def test_children_share_decoding(self):
+        lp = EagerParser(['@LIST', ['v', {'x': ['@LIST', 1]}]])
+
+        [variant] = lp.iter()
+        (tag, body) = variant.parse_type(tuple)
+        self.assertEqual('v', tag)
+        self.assertIs(lp.unwrap()[0][1], body.unwrap())
+
+    def _catch(self, f):
+        try:
+            f()
+        except error.MalformedMessage as e:
+            return e
+        else:
+            self.fail('Expected a MalformedMessage from {!r}'.format(f))
@@ -0,0 +1,122 @@
+import os
+import time
+import threading
+from mock import patch
+from twisted.internet import defer, reactor
+from twisted.trial.unittest import TestCase
+from thinserve.api.referenceable import Referenceable
+from thinserve.proto import executors
+from thinserve.proto.executors import Executors, WorkerError
+
+
+@Referenceable
+class Worker (object):
+    def __init__(self):
+        self.release = threading.Event()
+
+    @Referenceable.Method
+    def where(self):
+        return (os.getpid(), threading.current_thread().name)
+
+    @Referenceable.Method
+    def wait(self):
+        self.release.wait(10)
+
+    @Referenceable.Method(schema={'x': int})
+    def crash(self, x):
+        return 1 / x
+
+    @Referenceable.Method
+    def exit(self):
+        os._exit(1)
+
+    @Referenceable.Method
+    def sleep(self):
+        time.sleep(10)
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+
+class ExecutorsTests (TestCase):
+    def setUp(self):
+        self.addCleanup(Executors.stop)
+        self.w = Worker()
+
+    def test_threads(self):
+        d = Executors.submit('threads', self.w.where, {})
+
+        @d.addCallback
+        def check(where):
+            (pid, thread) = where
+            self.assertEqual(os.getpid(), pid)
+            self.assertIn('thinserve-executor', thread)
+
+        return d
+
+    def test_processes(self):
+        d = Executors.submit('processes', self.w.where, {})
+        d.addCallback(lambda where: self.assertNotEqual(os.getpid(), where[0]))
+        return d
+
+    def test_process_failure(self):
+        d = Executors.submit('processes', self.w.crash, {'x': 0})
+        d = self.assertFailure(d, WorkerError)
+        d.addCallback(
+            lambda e: self.assertIn('ZeroDivisionError', e.args[0]))
+        return d
+
+    def test_process_exits(self):
+        d = Executors.submit('processes', self.w.exit, {})
+        d = self.assertFailure(d, WorkerError)
+
+        # The worker is replaced:
+        d.addCallback(
+            lambda _: Executors.submit('processes', self.w.where, {}))
+        d.addCallback(lambda where: self.assertNotEqual(os.getpid(), where[0]))
+        return d
+
+    def test_process_timeout(self):
+        # Restored afterwards:
+        self.patch(Executors, '_timeout', None)
+        Executors.configure(timeout=0.2)
+
+        d = Executors.submit('processes', self.w.sleep, {})
+        d = self.assertFailure(d, WorkerError)
+        d.addCallback(lambda e: self.assertIn('timed out', e.args[0]))
+        return d
+
+    def test_stops_with_reactor_once(self):
+        self.patch(Executors, '_stopswithreactor', False)
+        with patch.object(reactor, 'addSystemEventTrigger') as m_add:
+            for _ in range(2):
+                Executors.submit('threads', self.w.where, {})
+                Executors.stop()
+
+        self.assertEqual(1, len(m_add.mock_calls))
+
+    def test_unpicklable_arguments(self):
+        d = Executors.submit('processes', self.w.crash, {'x': lambda: 0})
+        return self.assertFailure(d, Exception)
+
+    def test_saturation(self):
+        Executors.configure(threads=1)
+        self.addCleanup(Executors.configure, threads=10)
+        self.addCleanup(Executors.stop)
+
+        saturated = executors.SaturatedCalls.value('threads')
+        ds = [Executors.submit('threads', self.w.wait, {}) for _ in range(3)]
+
+        executors.Executors._report_metrics()
+        self.assertEqual(
+            [1, 1, 2, saturated + 2],
+            [executors.PoolWorkers.value('threads'),
+             executors.BusyWorkers.value('threads'),
+             executors.WaitingCalls.value('threads'),
+             executors.SaturatedCalls.value('threads')])
+
+        self.w.release.set()
+        return defer.gatherResults(ds)
@@ -142,6 +142,29 @@ class LazyParser_list (TestCase):
         for lp in self.neglps:
             self.assertRaises(error.MalformedList, lp.iter)
 
+    def test_is_list(self):
+        for _, lp in self.poslps:
+            self.failUnless(lp.is_list())
+
+        for lp in self.neglps + [LazyParser(['tag', 3]), LazyParser(3)]:
+            self.failIf(lp.is_list())
+
+    def test_parse_struct(self):
+        def f(a, b=2):
+            pass
+
+        params = LazyParser({'a': 1}).parse_struct(f)
+        self.assertEqual(['a'], params.keys())
+        self.assertEqual(1, params['a'].unwrap())
+        self.assertRaises(
+            error.UnexpectedStructKeys,
+            LazyParser({'a': 1, 'c': 3}).parse_struct,
+            f)
+
+    def test_raw(self):
+        msg = ['tag', {'x': ['@LIST', 1]}]
+        self.assertIs(msg, LazyParser(msg).raw())
+
     def test_neg_non_array(self):
         lp = LazyParser(3)
 
@@ -0,0 +1,95 @@
+from unittest import TestCase
+from mock import patch
+from thinserve.proto.metrics import Metrics
+
+
+class MetricsTests (TestCase):
+    def setUp(self):
+        # A private registry, rather than the process-wide one:
+        self.reg = type(Metrics)()
+
+    def test_counter(self):
+        c = self.reg.counter('errors_total', 'Errors.', labels=['kind'])
+        c.inc('a')
+        c.inc('a')
+        c.add(5, 'b')
+
+        self.assertEqual(2, c.value('a'))
+        self.assertEqual(
+            '# HELP errors_total Errors.\n'
+            '# TYPE errors_total counter\n'
+            'errors_total{kind="a"} 2\n'
+            'errors_total{kind="b"} 5\n',
+            self.reg.render())
+
+    def test_unlabeled_metrics_start_at_zero(self):
+        self.reg.gauge('sessions', 'Sessions.')
+
+        self.assertEqual(
+            '# HELP sessions Sessions.\n'
+            '# TYPE sessions gauge\n'
+            'sessions 0\n',
+            self.reg.render())
+
+    def test_collector(self):
+        g = self.reg.gauge('sessions', 'Sessions.')
+
+        @self.reg.collector
+        def collect():
+            g.set(g.value() + 1)
+
+        self.reg.render()
+        self.assertIn('sessions 2\n', self.reg.render())
+
+    def test_histogram(self):
+        h = self.reg.histogram(
+            'call_seconds', 'Calls.', labels=['method'], buckets=[0.1, 1])
+        for v in [0.05, 0.5, 0.5, 7]:
+            h.observe(v, 'eat')
+
+        self.assertEqual(
+            '# HELP call_seconds Calls.\n'
+            '# TYPE call_seconds histogram\n'
+            'call_seconds_bucket{method="eat",le="0.1"} 1\n'
+            'call_seconds_bucket{method="eat",le="1"} 3\n'
+            'call_seconds_bucket{method="eat",le="+Inf"} 4\n'
+            'call_seconds_sum{method="eat"} 8.05\n'
+            'call_seconds_count{method="eat"} 4\n',
+            self.reg.render())
+
+    @patch('time.time')
+    def test_histogram_timer(self, m_time):
+        h = self.reg.histogram('t', 'T.', buckets=[1])
+        m_time.side_effect = [10.0, 10.5]
+
+        with h.timer():
+            pass
+
+        self.assertEqual([[1, 0], 0.5], h.value())
+
+    def test_disabled(self):
+        c = self.reg.counter('c', 'C.')
+        g = self.reg.gauge('g', 'G.')
+        h = self.reg.histogram('h', 'H.', buckets=[1])
+        self.reg.enabled = False
+
+        c.inc()
+        g.set(3)
+        h.observe(0.5)
+        with h.timer():
+            pass
+
+        self.assertEqual((0, 0, [[0, 0], 0]),
+                         (c.value(), g.value(), h.value()))
+
+    def test_redefinition(self):
+        c = self.reg.counter('c', 'C.', labels=['x'])
+
+        self.assertIs(c, self.reg.counter('c', 'C.', labels=['x']))
+        self.assertRaises(AssertionError, self.reg.gauge, 'c', 'C.')
+
+    def test_label_escaping(self):
+        c = self.reg.counter('c', 'C.', labels=['x'])
+        c.inc(u'a"b\\c\n\xe9')
+
+        self.assertIn('c{x="a\\"b\\\\c\\n\xc3\xa9"} 1\n', self.reg.render())
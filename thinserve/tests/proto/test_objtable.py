@@ -0,0 +1,56 @@
+from unittest import TestCase
+from thinserve.proto import error
+from thinserve.proto.objtable import ObjectTable
+
+
+class ObjectTableTests (TestCase):
+    def setUp(self):
+        self.t = ObjectTable(limit=2)
+        self.a = object()
+        self.b = object()
+
+    def test_export_and_lookup(self):
+        ha = self.t.export(self.a)
+        hb = self.t.export(self.b)
+
+        self.assertNotEqual(ha, hb)
+        self.assertIs(self.a, self.t.lookup(ha))
+        self.assertIs(self.b, self.t.lookup(hb))
+        self.assertEqual(2, len(self.t))
+
+    def test_export_twice(self):
+        self.assertEqual(self.t.export(self.a), self.t.export(self.a))
+        self.assertEqual(1, len(self.t))
+
+    def test_release(self):
+        h = self.t.export(self.a)
+        self.t.release(h)
+
+        self.assertEqual(0, len(self.t))
+        self.assertRaises(error.UnknownReference, self.t.lookup, h)
+        self.assertRaises(error.UnknownReference, self.t.release, h)
+
+        # Handles are not reused:
+        self.assertNotEqual(h, self.t.export(self.a))
+
+    def test_unknown_references(self):
+        self.t.export(self.a)
+        for handle in [0, 2, True, '1', [1], 1.0]:
+            self.assertRaises(
+                error.UnknownReference, self.t.lookup, handle)
+
+    def test_limit(self):
+        self.t.export(self.a)
+        self.t.export(self.b)
+
+        self.assertRaises(error.TooManyReferences, self.t.export, object())
+
+        # Exporting an already exported object is not limited:
+        self.t.export(self.a)
+
+    def test_clear(self):
+        h = self.t.export(self.a)
+        self.t.clear()
+
+        self.assertEqual(0, len(self.t))
+        self.assertRaises(error.UnknownReference, self.t.lookup, h)
@@ -0,0 +1,132 @@
+from unittest import TestCase
+from twisted.internet import defer
+from thinserve.proto import error, scheduler
+from thinserve.proto.scheduler import CallScheduler
+
+
+class CallSchedulerTests (TestCase):
+    def setUp(self):
+        self.started = []
+        self.pending = {}
+
+    def test_unlimited(self):
+        cs = CallScheduler()
+        d = cs.submit('a', lambda: 42)
+
+        self.assertEqual(42, self._result(d))
+        self.assertEqual((0, 0), (cs.running, cs.queued))
+
+    def test_max_running(self):
+        cs = CallScheduler(maxrunning=2)
+        for (key, name) in [('a', 'a1'), ('b', 'b1'), ('c', 'c1')]:
+            self._submit(cs, key, name)
+
+        self.assertEqual(['a1', 'b1'], self.started)
+        self.assertEqual((2, 1), (cs.running, cs.queued))
+
+        self.pending['a1'].callback(None)
+        self.assertEqual(['a1', 'b1', 'c1'], self.started)
+        self.assertEqual((2, 0), (cs.running, cs.queued))
+
+    def test_max_per_session(self):
+        cs = CallScheduler(maxpersession=1)
+        for (key, name) in [('a', 'a1'), ('a', 'a2'), ('b', 'b1')]:
+            self._submit(cs, key, name)
+
+        self.assertEqual(['a1', 'b1'], self.started)
+
+        self.pending['b1'].callback(None)
+        self.assertEqual(['a1', 'b1'], self.started)
+
+        self.pending['a1'].callback(None)
+        self.assertEqual(['a1', 'b1', 'a2'], self.started)
+
+    def test_fair_order(self):
+        cs = CallScheduler(maxrunning=1)
+        self._submit(cs, 'x', 'x0')
+        for name in ['a1', 'a2', 'a3', 'b1', 'b2', 'c1']:
+            self._submit(cs, name[0], name)
+
+        self._drain(['x0', 'a1', 'b1', 'c1', 'a2', 'b2', 'a3'])
+
+    def test_fifo_order(self):
+        cs = CallScheduler(maxrunning=1, order='fifo')
+        self._submit(cs, 'x', 'x0')
+        for name in ['a1', 'a2', 'a3', 'b1', 'b2', 'c1']:
+            self._submit(cs, name[0], name)
+
+        self._drain(['x0', 'a1', 'a2', 'a3', 'b1', 'b2', 'c1'])
+
+    def test_result_and_failure_of_queued_calls(self):
+        cs = CallScheduler(maxrunning=1)
+        self._submit(cs, 'a', 'a1')
+        d1 = cs.submit('b', lambda: 'b1')
+        d2 = cs.submit('c', lambda: 1 / 0)
+
+        self.pending['a1'].callback(None)
+
+        self.assertEqual('b1', self._result(d1))
+        self.assertRaises(ZeroDivisionError, self._result, d2)
+        self.assertEqual((0, 0), (cs.running, cs.queued))
+
+    def test_synchronous_calls_do_not_recurse(self):
+        cs = CallScheduler(maxrunning=1)
+        self._submit(cs, 'a', 'a1')
+        ds = [cs.submit('b', lambda i=i: i) for i in range(5000)]
+
+        self.pending['a1'].callback(None)
+
+        self.assertEqual(range(5000), map(self._result, ds))
+
+    def test_max_queued(self):
+        cs = CallScheduler(maxrunning=1, maxqueued=1)
+        for name in ['a1', 'a2']:
+            self._submit(cs, 'a', name)
+
+        d = cs.submit('b', lambda: None)
+        self.assertRaises(error.SchedulerFull, self._result, d)
+
+    def test_discard(self):
+        cs = CallScheduler(maxrunning=1)
+        for name in ['a1', 'a2', 'b1']:
+            self._submit(cs, name[0], name)
+
+        cs.discard('a')
+        self.assertEqual(1, cs.queued)
+
+        self._drain(['a1', 'b1'])
+
+    def test_report_metrics(self):
+        cs = CallScheduler(maxrunning=1)
+        for name in ['a1', 'a2', 'a3']:
+            self._submit(cs, 'a', name)
+
+        scheduler._report_metrics([cs])
+
+        self.assertEqual(
+            [1, 2],
+            [scheduler.RunningCalls.value(), scheduler.QueuedCalls.value()])
+
+    # Helper code:
+    def _submit(self, cs, key, name):
+        def run():
+            self.started.append(name)
+            d = self.pending[name] = defer.Deferred()
+            return d
+
+        return cs.submit(key, run)
+
+    def _drain(self, expected):
+        '''Finish each call in turn, checking the order they start in.'''
+        for (i, name) in enumerate(expected):
+            self.assertEqual(expected[:i + 1], self.started)
+            self.pending[name].callback(None)
+        self.assertEqual(expected, self.started)
+
+    def _result(self, d):
+        results = []
+        d.addBoth(results.append)
+        [r] = results
+        if hasattr(r, 'raiseException'):
+            r.raiseException()
+        return r
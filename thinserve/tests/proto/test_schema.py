@@ -0,0 +1,114 @@
+from unittest import TestCase
+from thinserve.proto import error
+from thinserve.proto.lazyparser import LazyParser
+from thinserve.proto.schema import compile_method
+
+
+def is_even(x):
+    '''it is an even value'''
+    return x % 2 == 0
+
+
+class C (object):
+    def m(self, name, count, tags=None):
+        pass
+
+    def kw(self, name, **extra):
+        pass
+
+
+Spec = {
+    'name': basestring,
+    'count': (int, long),
+    'tags': [{'tag': basestring, 'weight': is_even}],
+}
+
+
+class CompileMethodTests (TestCase):
+    def setUp(self):
+        self.validate = compile_method(C.__dict__['m'], Spec)
+
+    def test_pos(self):
+        params = {
+            'name': u'banana',
+            'count': 3,
+            'tags': ['@LIST', {'tag': 'yellow', 'weight': 2}],
+        }
+
+        self.assertEqual(
+            {'name': u'banana',
+             'count': 3,
+             'tags': [{'tag': 'yellow', 'weight': 2}]},
+            self.validate(LazyParser(params)))
+
+    def test_pos_optional_param_omitted(self):
+        params = {'name': 'banana', 'count': 3}
+        self.assertEqual(params, self.validate(LazyParser(params)))
+
+    def test_neg_cases(self):
+        cases = [
+            (3,
+             error.UnexpectedType, ''),
+            ({'count': 3},
+             error.MissingStructKeys, ''),
+            ({'name': 'x', 'count': 3, 'color': 'red'},
+             error.UnexpectedStructKeys, ''),
+            ({'name': 7, 'count': 3},
+             error.UnexpectedType, '.name'),
+            ({'name': 'x', 'count': True},
+             error.UnexpectedType, '.count'),
+            ({'name': 'x', 'count': 3, 'tags': {}},
+             error.UnexpectedType, '.tags'),
+            ({'name': 'x', 'count': 3, 'tags': ['yellow', {}]},
+             error.UnexpectedType, '.tags'),
+            ({'name': 'x', 'count': 3,
+              'tags': ['@LIST', {'tag': 'a', 'weight': 2},
+                       {'tag': 'b', 'weight': 3}]},
+             error.FailedPredicate, '.tags[1].weight'),
+        ]
+
+        for (params, errcls, path) in cases:
+            try:
+                self.validate(LazyParser(params, '/call.method/m'))
+            except errcls as e:
+                self.assertEqual('/call.method/m' + path, e.path)
+            else:
+                self.fail('Expected {!r} for {!r}'.format(errcls, params))
+
+    def test_malformed_encoding_is_reported_by_the_parser(self):
+        self.assertRaises(
+            error.MalformedList,
+            self.validate,
+            LazyParser({'name': 'x', 'count': 3, 'tags': ['x', 1, 2]}))
+
+    def test_bool_is_allowed_where_listed(self):
+        validate = compile_method(
+            C.__dict__['kw'],
+            {'name': (int, bool)})
+
+        self.assertEqual(
+            {'name': True},
+            validate(LazyParser({'name': True})))
+
+    def test_schema_must_match_signature(self):
+        self.assertRaises(
+            AssertionError,
+            compile_method, C.__dict__['m'], {'name': str})
+
+        self.assertRaises(
+            AssertionError,
+            compile_method, C.__dict__['m'], dict(Spec, color=str))
+
+    def test_keywords_method_allows_only_schema_keys(self):
+        validate = compile_method(
+            C.__dict__['kw'],
+            {'name': str, 'size': int})
+
+        self.assertEqual(
+            {'name': 'x', 'size': 1},
+            validate(LazyParser({'name': 'x', 'size': 1})))
+
+        self.assertRaises(
+            error.UnexpectedStructKeys,
+            validate,
+            LazyParser({'name': 'x', 'color': 'red'}))
@@ -1,9 +1,13 @@
-from twisted.internet import defer
+import gc
+import weakref
+from twisted.internet import defer, task
 from twisted.trial.unittest import TestCase
 from thinserve.api.referenceable import Referenceable
 from thinserve.api.remerr import RemoteError
-from thinserve.proto import session
+from thinserve.proto import session, error
+from thinserve.proto.callhooks import CallHook
 from thinserve.proto.lazyparser import LazyParser
+from thinserve.proto.scheduler import CallScheduler
 from thinserve.tests.testutil import check_lists_equal
 
 
@@ -30,6 +34,14 @@ class SessionTests (TestCase):
             def throw_a_fruit(s, fruit):
                 fruit.parse_type(int)
 
+            @Referenceable.Method(schema={'fruits': [basestring]})
+            def count_fruits(s, fruits):
+                return len(fruits)
+
+            @Referenceable.Method
+            def ripen(s):
+                return self._ripening
+
         self.root = C()
         self.s = session.Session(self.root)
 
@@ -51,6 +63,200 @@ class SessionTests (TestCase):
 
         # Do not return d, which will never fire.
 
+    def test_close_fails_blocked_gather_and_pending_calls(self):
+        cd = self.s._send_call(target=None, method='eat_a_fruit', params={})
+        self.s.gather_outgoing_messages()
+
+        # Now that the call is delivered, the next gather blocks:
+        gd = self.s.gather_outgoing_messages()
+
+        self.s.close(error.SessionClosed(reason='expired'))
+
+        self.assertEqual({}, self.s._pendingcalls)
+        return defer.gatherResults([
+            self.assertFailure(gd, error.SessionClosed),
+            self.assertFailure(cd, error.SessionClosed),
+        ])
+
+    def test_snapshot_restore(self):
+        self.s._send_call(target=None, method='eat_a_fruit', params={})
+        self.s._send_call(target=None, method='eat_a_fruit', params={})
+        snapshot = self.s.snapshot()
+
+        self.assertEqual(
+            {'nextcallid': 2,
+             'pendingcalls': [0, 1],
+             'queued': [
+                 ['call', {'id': i,
+                           'target': None,
+                           'method': ['eat_a_fruit', {}]}]
+                 for i in range(2)]},
+            snapshot)
+
+        s = session.Session(self.root)
+        s.restore(snapshot)
+        self.assertEqual(snapshot, s.snapshot())
+
+        # Replies to calls from the previous life are discarded:
+        s.receive_message(
+            LazyParser(['reply', {'id': 1, 'result': ['data', 'ok']}]))
+        self.assertEqual([0], s.snapshot()['pendingcalls'])
+
+        # New calls continue the id sequence:
+        s._send_call(target=None, method='eat_a_fruit', params={})
+        self.assertEqual(3, s.snapshot()['nextcallid'])
+
+    def test_observer(self):
+        changes = []
+        self.s.set_observer(lambda: changes.append(self.s.snapshot()))
+
+        self.s._send_call(target=None, method='eat_a_fruit', params={})
+        self.assertEqual(1, len(changes[-1]['queued']))
+
+        self.s.gather_outgoing_messages()
+        self.assertEqual([], changes[-1]['queued'])
+
+        count = len(changes)
+        self.s.set_observer(None)
+        self.s._send_call(target=None, method='eat_a_fruit', params={})
+        self.assertEqual(count, len(changes))
+
+    def test_receive_schema_calls(self):
+        for (callid, fruits) in enumerate([['@LIST', 'apple', 'fig'],
+                                           ['@LIST', 'apple', 7]]):
+            self.s.receive_message(
+                LazyParser(
+                    ['call',
+                     {'id': callid,
+                      'target': None,
+                      'method': ['count_fruits', {'fruits': fruits}]}]))
+
+        d = self.s.gather_outgoing_messages()
+        d.addCallback(
+            lambda msgs: check_lists_equal(
+                self,
+                [['reply', {'id': 0, 'result': ['data', 2]}],
+                 ['reply',
+                  {'id': 1,
+                   'result': ['error',
+                              {'template': error.UnexpectedType.Template,
+                               'params': {'expected': 'basestring',
+                                          'actual': 'int'},
+                               'path': '/call.method/count_fruits.fruits[1]',
+                               'message': 7}]}]],
+                msgs))
+        return d
+
+    def test_call_metrics(self):
+        def observations():
+            return (
+                sum(session.CallSeconds.value('count_fruits')[0]),
+                sum(session.CallSeconds.value('(unknown)')[0]),
+                error.ProtocolErrors.value('UnexpectedType'),
+                error.ProtocolErrors.value('UnknownVariantTag'))
+
+        before = observations()
+
+        for (callid, method) in enumerate(
+                [['count_fruits', {'fruits': ['@LIST', 'fig']}],
+                 ['count_fruits', {'fruits': ['@LIST', 7]}],
+                 ['bogus', {}],
+                 [['unhashable'], {}]]):
+            self.s.receive_message(
+                LazyParser(
+                    ['call',
+                     {'id': callid, 'target': None, 'method': method}]))
+
+        self.assertEqual(
+            (2, 2, 1, 1),
+            tuple(b - a for (a, b) in zip(before, observations())))
+
+    def test_call_hooks(self):
+        hook = _RecordingHook()
+        s = session.Session(self.root, sid='SID', callhooks=[hook])
+        self._eaf_info = (self.params[0], self.replies[0])
+
+        for (callid, method) in enumerate(
+                [['eat_a_fruit', {'fruit': self.params[0]}],
+                 ['throw_a_fruit', {'fruit': 'banana'}],
+                 ['count_fruits', {'fruits': ['@LIST', 7]}],
+                 ['bogus', {}]]):
+            s.receive_message(
+                LazyParser(
+                    ['call',
+                     {'id': callid, 'target': None, 'method': method}]))
+
+        self.assertEqual(
+            [('call_started', 'eat_a_fruit'),
+             ('call_returned', 'eat_a_fruit'),
+             ('call_finished', 'eat_a_fruit'),
+             ('call_started', 'throw_a_fruit'),
+             ('call_returned', 'throw_a_fruit'),
+             ('call_finished', 'throw_a_fruit')],
+            [(event, info.method) for (event, info) in hook.events])
+
+        [eaten, thrown] = [info for (event, info) in hook.events[2::3]]
+        self.assertEqual(
+            [('SID', None, False, len('"{}"'.format(self.replies[0]))),
+             ('SID', None, True)],
+            [(eaten.sid, eaten.target, eaten.failed, eaten.result_size),
+             (thrown.sid, thrown.target, thrown.failed)])
+        for info in [eaten, thrown]:
+            self.failUnless(info.parse_seconds >= 0)
+            self.failUnless(info.exec_seconds >= 0)
+
+    def test_call_hooks_see_deferred_completion(self):
+        hook = _RecordingHook()
+        s = session.Session(self.root, callhooks=[hook])
+        self._ripening = defer.Deferred()
+
+        s.receive_message(
+            LazyParser(
+                ['call',
+                 {'id': 0, 'target': None, 'method': ['ripen', {}]}]))
+        self.assertEqual(
+            ['call_started', 'call_returned'],
+            [event for (event, _) in hook.events])
+
+        self._ripening.callback('yum')
+        self.assertEqual(
+            ['call_started', 'call_returned', 'call_finished'],
+            [event for (event, _) in hook.events])
+        self.assertEqual(len('"yum"'), hook.events[-1][1].result_size)
+
+    def test_receive_batch(self):
+        self._eaf_info = (self.params[0], self.replies[0])
+
+        errors = self.s.receive_messages(
+            LazyParser(
+                ['@LIST',
+                 ['call',
+                  {'id': 0,
+                   'target': None,
+                   'method': ['eat_a_fruit', {'fruit': self.params[0]}]}],
+                 ['bogus', {}],
+                 ['call',
+                  {'id': 1,
+                   'target': None,
+                   'method': ['count_fruits',
+                              {'fruits': ['@LIST', 'fig']}]}]]))
+
+        self.assertEqual(
+            [[1, error.UnknownVariantTag(
+                '[1]', ['bogus', {}],
+                tag='bogus',
+                knowntags=['call', 'release', 'reply']).as_proto_object()]],
+            errors)
+
+        d = self.s.gather_outgoing_messages()
+        d.addCallback(
+            lambda msgs: check_lists_equal(
+                self,
+                [['reply', {'id': 0, 'result': ['data', self.replies[0]]}],
+                 ['reply', {'id': 1, 'result': ['data', 1]}]],
+                msgs))
+        return d
+
     def test_receive_n_immediate_calls_then_gather_n_data_replies(self):
         return self._receive_n_calls_check_replies(
             'eat_a_fruit',
@@ -167,3 +373,320 @@ class SessionTests (TestCase):
 
         d.addCallback(lambda _: defer.DeferredList(repdefs))
         return d
+
+    def test_call_exported_reference(self):
+        self._ripening = [Fruit('fig'), {'best': Fruit('kiwi')}]
+        self._call(0, None, 'ripen')
+        d = self.s.gather_outgoing_messages()
+
+        @d.addCallback
+        def call_through_handles(msgs):
+            [[_, reply]] = msgs
+            [[_, fig], best] = reply['result'][1]
+            (_, kiwi) = best['best']
+
+            self._call(1, fig, 'name')
+            self._call(2, kiwi, 'name')
+            return self.s.gather_outgoing_messages()
+
+        d.addCallback(
+            self.assertEqual,
+            [['reply', {'id': 1, 'result': ['data', 'fig']}],
+             ['reply', {'id': 2, 'result': ['data', 'kiwi']}]])
+        return d
+
+    def test_released_reference(self):
+        self._ripening = Fruit('fig')
+        self._call(0, None, 'ripen')
+        self.assertEqual(1, len(self.s._objects))
+
+        self.s.receive_message(LazyParser(['release', {'target': 1}]))
+        self.assertEqual(0, len(self.s._objects))
+
+        self._call(1, 1, 'name')
+        d = self.s.gather_outgoing_messages()
+        d.addCallback(
+            self.assertEqual,
+            [['reply', {'id': 0, 'result': ['data', ['@SREF', 1]]}],
+             ['reply',
+              {'id': 1,
+               'result': ['error',
+                          error.UnknownReference(
+                              sref=1).as_proto_object()]}]])
+        return d
+
+    def test_reference_limit(self):
+        self.s = session.Session(self.root, maxrefs=1)
+        self._ripening = [Fruit('fig'), Fruit('kiwi')]
+        self._call(0, None, 'ripen')
+
+        d = self.s.gather_outgoing_messages()
+        d.addCallback(
+            self.assertEqual,
+            [['reply',
+              {'id': 0,
+               'result': ['error',
+                          error.TooManyReferences(
+                              limit=1).as_proto_object()]}]])
+        return d
+
+    def test_close_releases_references(self):
+        self._ripening = Fruit('fig')
+        self._call(0, None, 'ripen')
+
+        self.s.close(error.SessionClosed(reason='expired'))
+        self.assertEqual(0, len(self.s._objects))
+
+    def test_released_and_closed_references_are_collected(self):
+        refs = []
+        for end in ['release', 'close']:
+            s = session.Session(self.root)
+            self._ripening = Fruit('fig')
+            refs.append(weakref.ref(self._ripening))
+            for msg in [
+                    ['call', {'id': 0, 'target': None,
+                              'method': ['ripen', {}]}],
+                    ['call', {'id': 1, 'target': 1,
+                              'method': ['name', {}]}]]:
+                s.receive_message(LazyParser(msg))
+
+            if end == 'release':
+                s.receive_message(LazyParser(['release', {'target': 1}]))
+            else:
+                s.close(error.SessionClosed(reason='expired'))
+
+        self._ripening = None
+        gc.collect()
+        self.assertEqual([None, None], [ref() for ref in refs])
+
+    def test_closed_session_root_is_collected(self):
+        root = Fruit('apple')
+        s = session.Session(root)
+        s.receive_message(LazyParser(
+            ['call', {'id': 0, 'target': None, 'method': ['name', {}]}]))
+        s.close(error.SessionClosed(reason='expired'))
+
+        ref = weakref.ref(root)
+        del s, root
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_cancel_call(self):
+        d = self.s._send_call(target=None, method='eat_a_fruit', params={})
+        d.cancel()
+
+        self.assertEqual(0, self.s.pending_calls)
+        self.assertEqual(
+            [['cancel', {'id': 0}]],
+            self.s.snapshot()['queued'][1:])
+
+        # A late reply is discarded:
+        self._reply(0)
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_cancel_call_with_full_queue(self):
+        s = session.Session(self.root, maxqueued=1, overflow='reject')
+        d = s._send_call(target=None, method='eat_a_fruit', params={})
+        before = error.ProtocolErrors.value('OutgoingQueueFull')
+        d.cancel()
+
+        self.assertEqual(0, s.pending_calls)
+        self.assertEqual(
+            before + 1,
+            error.ProtocolErrors.value('OutgoingQueueFull'))
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_call_timeout(self):
+        clock = task.Clock()
+        s = session.Session(self.root, clock=clock, calltimeout=10)
+        d1 = s._send_call(target=None, method='eat_a_fruit', params={})
+        d2 = s._send_call(
+            target=None, method='eat_a_fruit', params={}, timeout=5)
+
+        clock.advance(5)
+        self.assertEqual([0], s.snapshot()['pendingcalls'])
+
+        s.receive_message(
+            LazyParser(['reply', {'id': 0, 'result': ['data', 'ok']}]))
+        self.assertEqual([], clock.getDelayedCalls())
+
+        self.assertEqual(
+            [['cancel', {'id': 1}]],
+            s.snapshot()['queued'][2:])
+        d1.addCallback(lambda lp: self.assertEqual('ok', lp.unwrap()))
+        return defer.gatherResults([
+            d1, self.assertFailure(d2, error.CallTimedOut)])
+
+    def test_close_cancels_call_timers(self):
+        clock = task.Clock()
+        s = session.Session(self.root, clock=clock, calltimeout=10)
+        d = s._send_call(target=None, method='eat_a_fruit', params={})
+
+        s.close(error.SessionClosed(reason='expired'))
+
+        self.assertEqual([], clock.getDelayedCalls())
+        return self.assertFailure(d, error.SessionClosed)
+
+    def test_max_pending_calls(self):
+        s = session.Session(self.root, maxpendingcalls=1)
+        s._send_call(target=None, method='eat_a_fruit', params={})
+        d = s._send_call(target=None, method='eat_a_fruit', params={})
+
+        self.assertEqual(1, s.pending_calls)
+        self.assertEqual(1, len(s.snapshot()['queued']))
+        return self.assertFailure(d, error.TooManyPendingCalls)
+
+    def test_reply_to_unknown_call(self):
+        self.assertRaises(error.InvalidParameter, self._reply, 0)
+
+    def test_scheduled_calls(self):
+        cs = CallScheduler(maxpersession=1)
+        self.s = session.Session(self.root, scheduler=cs)
+        self._ripening = defer.Deferred()
+        self._call(0, None, 'ripen')
+        self._call(1, None, 'ripen')
+        self._call(2, None, 'ripen')
+
+        self.assertEqual((1, 2), (cs.running, cs.queued))
+
+        (d, self._ripening) = (self._ripening, 'kiwi')
+        d.callback('fig')
+        self.assertEqual((0, 0), (cs.running, cs.queued))
+
+        d = self.s.gather_outgoing_messages()
+        d.addCallback(
+            self.assertEqual,
+            [['reply', {'id': 0, 'result': ['data', 'fig']}],
+             ['reply', {'id': 1, 'result': ['data', 'kiwi']}],
+             ['reply', {'id': 2, 'result': ['data', 'kiwi']}]])
+        return d
+
+    def test_full_scheduler_replies_with_error(self):
+        cs = CallScheduler(maxrunning=1, maxqueued=1)
+        self.s = session.Session(self.root, scheduler=cs)
+        self._ripening = defer.Deferred()
+        before = error.ProtocolErrors.value('SchedulerFull')
+        for callid in range(3):
+            self._call(callid, None, 'ripen')
+
+        self.assertEqual(
+            before + 1,
+            error.ProtocolErrors.value('SchedulerFull'))
+        d = self.s.gather_outgoing_messages()
+        d.addCallback(
+            self.assertEqual,
+            [['reply',
+              {'id': 2,
+               'result': ['error', error.SchedulerFull().as_proto_object()]}]])
+        return d
+
+    def test_close_discards_scheduled_calls(self):
+        cs = CallScheduler(maxpersession=1)
+        self.s = session.Session(self.root, scheduler=cs)
+        self._ripening = defer.Deferred()
+        self._call(0, None, 'ripen')
+        self._call(1, None, 'ripen')
+
+        self.s.close(error.SessionClosed(reason='expired'))
+        self.assertEqual((1, 0), (cs.running, cs.queued))
+
+    def test_full_queue_drops_oldest_reply(self):
+        self.s = session.Session(self.root, maxqueued=1)
+        self._ripening = 'fig'
+        self._call(0, None, 'ripen')
+        self._call(1, None, 'ripen')
+
+        d = self.s.gather_outgoing_messages()
+        d.addCallback(
+            self.assertEqual,
+            [['reply', {'id': 1, 'result': ['data', 'fig']}]])
+        return d
+
+    def test_full_queue_rejects_reply(self):
+        self.s = session.Session(self.root, maxqueued=1, overflow='reject')
+        self._ripening = 'fig'
+        before = error.ProtocolErrors.value('OutgoingQueueFull')
+        self._call(0, None, 'ripen')
+        self._call(1, None, 'ripen')
+
+        self.assertEqual(
+            before + 1,
+            error.ProtocolErrors.value('OutgoingQueueFull'))
+        d = self.s.gather_outgoing_messages()
+        d.addCallback(
+            self.assertEqual,
+            [['reply', {'id': 0, 'result': ['data', 'fig']}]])
+        return d
+
+    def test_full_queue_rejects_call(self):
+        s = session.Session(self.root, maxqueued=1, overflow='reject')
+        s._send_call(target=None, method='eat_a_fruit', params={})
+        d = s._send_call(target=None, method='eat_a_fruit', params={})
+
+        self.assertEqual(1, s.pending_calls)
+        return self.assertFailure(d, error.OutgoingQueueFull)
+
+    def test_full_queue_waits_for_reply(self):
+        cs = CallScheduler(maxpersession=1)
+        self.s = session.Session(
+            self.root, scheduler=cs, maxqueued=1, overflow='wait')
+        self._ripening = 'fig'
+        self._call(0, None, 'ripen')
+        self._call(1, None, 'ripen')
+        self._call(2, None, 'ripen')
+
+        # The second reply holds its place until the queue drains:
+        self.assertEqual((1, 1), (cs.running, cs.queued))
+        self.assertFalse(self.s.drained().called)
+
+        d = self.s.gather_outgoing_messages()
+        d.addCallback(
+            self.assertEqual,
+            [['reply', {'id': 0, 'result': ['data', 'fig']}],
+             ['reply', {'id': 1, 'result': ['data', 'fig']}]])
+        self.assertEqual((0, 0), (cs.running, cs.queued))
+        self.assertTrue(self.s.drained().called)
+        return d
+
+    def test_cancel_blocked_gather(self):
+        d = self.s.gather_outgoing_messages()
+        d.cancel()
+
+        self.failUnlessFailure(d, defer.CancelledError)
+        self.assertEqual(self.s._shuttle._state, ('empty', None))
+        return d
+
+    # Helper code:
+    def _reply(self, callid):
+        self.s.receive_message(
+            LazyParser(['reply', {'id': callid, 'result': ['data', 'ok']}]))
+
+    def _call(self, callid, target, method):
+        self.s.receive_message(
+            LazyParser(
+                ['call',
+                 {'id': callid, 'target': target, 'method': [method, {}]}]))
+
+
+@Referenceable
+class Fruit (object):
+    def __init__(self, name):
+        self._name = name
+
+    @Referenceable.Method
+    def name(self):
+        return self._name
+
+
+class _RecordingHook (CallHook):
+    def __init__(self):
+        self.events = []
+
+    def call_started(self, info):
+        self.events.append(('call_started', info))
+
+    def call_returned(self, info):
+        self.events.append(('call_returned', info))
+
+    def call_finished(self, info):
+        self.events.append(('call_finished', info))
@@ -0,0 +1,149 @@
+import os
+import json
+import sqlite3
+import shutil
+import tempfile
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+from thinserve.api.referenceable import Referenceable
+from thinserve.proto import error, session
+from thinserve.proto.lazyparser import LazyParser
+from thinserve.proto.sessiondb import SQLiteSessionTable
+
+
+@Referenceable
+class App (object):
+    def __init__(self, name):
+        self.name = name
+
+    @Referenceable.Method
+    def greet(self):
+        return 'hello from {}'.format(self.name)
+
+
+class SQLiteSessionTableTests (TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'sessions.db')
+        self.clock = task.Clock()
+        self.restored = []
+        self.st = self._make_table()
+
+    def test_restore_queued_messages(self):
+        s = self._add('a', name='alice')
+        self._call_greet(s, 0)
+        self.clock.advance(0)
+
+        # A new process:
+        st = self._make_table()
+        s2 = st['a']
+
+        self.assertIsNot(s, s2)
+        self.assertEqual([{'name': 'alice'}], self.restored)
+        d = s2.gather_outgoing_messages()
+        d.addCallback(
+            self.assertEqual,
+            [['reply', {'id': 0, 'result': ['data', 'hello from alice']}]])
+        return d
+
+    def test_changes_are_written_once_per_turn(self):
+        s = self._add('a', name='alice')
+        for i in range(3):
+            self._call_greet(s, i)
+
+        self.assertEqual([], self._stored_snapshot('a')['queued'])
+
+        self.clock.advance(0)
+        self.assertEqual(3, len(self._stored_snapshot('a')['queued']))
+
+    def test_unknown_session(self):
+        self.assertRaises(KeyError, lambda: self.st['nope'])
+
+    def test_expired_sessions_are_deleted(self):
+        self._add('a', name='alice')
+        self.clock.advance(10)
+
+        self.assertRaises(KeyError, lambda: self.st['a'])
+        self.assertRaises(KeyError, lambda: self._make_table()['a'])
+
+    def test_stored_session_expires_while_process_is_down(self):
+        self._add('a', name='alice')
+        self.clock.advance(5)
+        self.st.close_all()
+
+        self.clock.advance(5)
+        self.assertRaises(KeyError, lambda: self._make_table()['a'])
+
+    def test_evicted_sessions_are_deleted(self):
+        for sid in ['a', 'b', 'c']:
+            self._add(sid, name=sid)
+
+        self.assertRaises(KeyError, lambda: self._make_table()['a'])
+        self.assertEqual([], self.restored)
+
+    def test_shutdown_keeps_sessions(self):
+        s = self._add('a', name='alice')
+        self._call_greet(s, 0)
+        s.gather_outgoing_messages()
+        d = s.gather_outgoing_messages()
+
+        self.st.close_all()
+
+        st = self._make_table()
+        self.assertEqual([], st['a'].snapshot()['queued'])
+        return self.assertFailure(d, error.SessionClosed)
+
+    def test_restore_refused(self):
+        self._add('a', name='alice')
+        st = self._make_table(restore=lambda sid, params: None)
+
+        self.assertRaises(KeyError, lambda: st['a'])
+        self.assertRaises(KeyError, lambda: self._make_table()['a'])
+
+    def test_failed_restore_is_unknown_session(self):
+        self._add('a', name='alice')
+
+        def restore(sid, params):
+            raise ValueError(params)
+
+        st = self._make_table(restore=restore)
+        self.assertRaises(KeyError, lambda: st['a'])
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+
+        # The stored session is kept for a later attempt:
+        self._make_table()['a']
+        self.assertEqual([{'name': 'alice'}], self.restored)
+
+    # Helper code:
+    def _make_table(self, restore=None):
+        return SQLiteSessionTable(
+            self.path,
+            self.clock,
+            restore or self._restore,
+            timeout=10,
+            maxsessions=2)
+
+    def _restore(self, sid, params):
+        self.restored.append(params)
+        return session.Session(App(**params), clock=self.clock)
+
+    def _add(self, sid, **params):
+        s = session.Session(App(**params), clock=self.clock)
+        self.st.add(sid, s, params)
+        return s
+
+    def _stored_snapshot(self, sid):
+        db = sqlite3.connect(self.path)
+        try:
+            [(snapshot,)] = db.execute(
+                'SELECT snapshot FROM sessions WHERE sid = ?', (sid,))
+            return json.loads(snapshot)
+        finally:
+            db.close()
+
+    def _call_greet(self, s, callid):
+        s.receive_message(
+            LazyParser(
+                ['call',
+                 {'id': callid, 'target': None, 'method': ['greet', {}]}]))
@@ -0,0 +1,153 @@
+import gc
+import weakref
+from unittest import TestCase
+from mock import MagicMock, call
+from twisted.internet import task
+from thinserve.api.referenceable import Referenceable
+from thinserve.proto import error
+from thinserve.proto import session, sessiontable
+from thinserve.proto.lazyparser import LazyParser
+from thinserve.proto.sessiontable import SessionTable
+from thinserve.tests.testutil import check_mock, EqCb
+
+
+def closed_with(reason):
+    return call.close(
+        EqCb(lambda e: (isinstance(e, error.SessionClosed)
+                        and e.params == {'reason': reason})))
+
+
+class SessionTableTests (TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.st = SessionTable(self.clock, timeout=10, maxsessions=3)
+
+    def test_lookup(self):
+        s = MagicMock(name='session')
+        self.st['a'] = s
+
+        self.assertIs(s, self.st['a'])
+        self.assertIn('a', self.st)
+        self.assertEqual(1, len(self.st))
+        self.assertRaises(KeyError, lambda: self.st['b'])
+
+    def test_add(self):
+        s = MagicMock(name='session')
+        self.st.add('a', s, {'createparam': 42})
+
+        self.assertIs(s, self.st['a'])
+        check_mock(self, s, [])
+
+    def test_idle_expiry(self):
+        s = MagicMock(name='session')
+        self.st['a'] = s
+
+        self.clock.advance(9)
+        check_mock(self, s, [])
+
+        self.clock.advance(1)
+        check_mock(self, s, [closed_with('expired')])
+        self.assertNotIn('a', self.st)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_access_postpones_expiry(self):
+        s = MagicMock(name='session')
+        self.st['a'] = s
+
+        for _ in range(5):
+            self.clock.advance(6)
+            self.assertIs(s, self.st['a'])
+
+        check_mock(self, s, [])
+
+        self.clock.advance(10)
+        check_mock(self, s, [closed_with('expired')])
+
+    def test_reaps_only_expired_sessions(self):
+        old = MagicMock(name='old')
+        new = MagicMock(name='new')
+
+        self.st['old'] = old
+        self.clock.advance(5)
+        self.st['new'] = new
+        self.clock.advance(5)
+
+        check_mock(self, old, [closed_with('expired')])
+        check_mock(self, new, [])
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+        self.clock.advance(5)
+        check_mock(self, new, [closed_with('expired')])
+
+    def test_lru_eviction(self):
+        sessions = dict(
+            (name, MagicMock(name=name))
+            for name in 'abcd')
+
+        for name in 'abc':
+            self.st[name] = sessions[name]
+
+        # Touch 'a' so 'b' becomes least recently used:
+        self.st['a']
+        self.st['d'] = sessions['d']
+
+        check_mock(self, sessions['b'], [closed_with('evicted')])
+        self.assertEqual(['a', 'c', 'd'], sorted(
+            name for name in 'abcd' if name in self.st))
+
+    def test_expired_sessions_are_collected(self):
+        root = _Root()
+        s = session.Session(root, clock=self.clock)
+        s.receive_message(LazyParser(
+            ['call', {'id': 0, 'target': None, 'method': ['ping', {}]}]))
+        self.st['a'] = s
+
+        refs = [weakref.ref(s), weakref.ref(root)]
+        del s, root
+        self.clock.advance(10)
+        gc.collect()
+
+        self.assertEqual([None, None], [ref() for ref in refs])
+
+    def test_close_all(self):
+        sessions = [MagicMock(name=str(i)) for i in range(3)]
+        for i, s in enumerate(sessions):
+            self.st[i] = s
+
+        self.st.close_all()
+
+        for s in sessions:
+            check_mock(self, s, [closed_with('shutdown')])
+
+        self.assertEqual(0, len(self.st))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_no_timeout(self):
+        st = SessionTable(self.clock)
+        st['a'] = MagicMock(name='session')
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_report_metrics(self):
+        for (sid, queued, gathering, pending) in [('a', 2, False, 1),
+                                                  ('b', 0, True, 3)]:
+            s = MagicMock(name='session')
+            s.queued_messages = queued
+            s.gathering = gathering
+            s.pending_calls = pending
+            self.st[sid] = s
+
+        sessiontable._report_metrics([self.st])
+
+        self.assertEqual(
+            [2, 2, 1, 4],
+            [g.value() for g in [sessiontable.Sessions,
+                                 sessiontable.QueuedMessages,
+                                 sessiontable.BlockedGathers,
+                                 sessiontable.PendingCalls]])
+
+
+@Referenceable
+class _Root (object):
+    @Referenceable.Method
+    def ping(self):
+        return 'pong'
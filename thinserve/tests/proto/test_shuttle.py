@@ -1,5 +1,8 @@
+from collections import deque
 from unittest import TestCase
 from mock import MagicMock, call
+from twisted.internet import task
+from thinserve.proto import error
 from thinserve.proto.shuttle import Shuttle, _Empty
 from thinserve.tests.testutil import check_mock
 
@@ -14,7 +17,7 @@ class ShuttleTests (TestCase):
     def test_send(self):
         msg = MagicMock()
         self.sh.send_message(msg)
-        self.assertEqual(self.sh._state, ('queued', [msg]))
+        self.assertEqual(self.sh._state, ('queued', deque([msg])))
 
     def test_gather(self):
         d = MagicMock()
@@ -43,7 +46,7 @@ class ShuttleTests (TestCase):
         for msg in msgs:
             self.sh.send_message(msg)
 
-        self.assertEqual(self.sh._state, ('queued', msgs))
+        self.assertEqual(self.sh._state, ('queued', deque(msgs)))
 
     def test_many_gathers(self):
         c = [0]  # A closure.
@@ -64,3 +67,254 @@ class ShuttleTests (TestCase):
             self.sh.gather_messages(d)
             check_mock(self, oldd, [call.callback([])])
             oldd = d
+
+    def test_close_blocked(self):
+        d = MagicMock()
+        self.sh.gather_messages(d)
+        reason = MagicMock(name='reason')
+        self.sh.close(reason)
+        self.assertEqual(self.sh._state, _Empty)
+        check_mock(self, d, [call.errback(reason)])
+
+    def test_close_queued(self):
+        self.sh.send_message(MagicMock())
+        self.sh.close(MagicMock(name='reason'))
+        self.assertEqual(self.sh._state, _Empty)
+
+    def test_pending_messages_and_requeue(self):
+        msgs = ['a', 'b']
+        for msg in msgs:
+            self.sh.send_message(msg)
+        self.assertEqual(msgs, self.sh.pending_messages())
+
+        sh = Shuttle()
+        self.assertEqual([], sh.pending_messages())
+        sh.requeue(self.sh.pending_messages())
+        self.assertEqual(('queued', deque(msgs)), sh._state)
+
+    def test_requeue_nothing(self):
+        self.sh.requeue([])
+        self.assertEqual(_Empty, self.sh._state)
+
+
+class ShuttlePollTimeoutTests (TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sh = Shuttle(self.clock, polltimeout=30)
+
+    def test_blocked_gather_times_out(self):
+        d = MagicMock()
+        self.sh.gather_messages(d)
+
+        self.clock.advance(29)
+        check_mock(self, d, [])
+
+        self.clock.advance(1)
+        check_mock(self, d, [call.callback([])])
+        self.assertEqual(self.sh._state, _Empty)
+
+    def test_send_cancels_timeout(self):
+        d = MagicMock()
+        self.sh.gather_messages(d)
+        msg = MagicMock()
+        self.sh.send_message(msg)
+
+        check_mock(self, d, [call.callback([msg])])
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_new_gather_restarts_timeout(self):
+        oldd = MagicMock(name='old')
+        self.sh.gather_messages(oldd)
+        self.clock.advance(20)
+
+        newd = MagicMock(name='new')
+        self.sh.gather_messages(newd)
+        check_mock(self, oldd, [call.callback([])])
+
+        self.clock.advance(20)
+        check_mock(self, newd, [])
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+    def test_released_gather_may_gather_again(self):
+        oldd = MagicMock(name='old')
+        newd = MagicMock(name='new')
+        againd = MagicMock(name='again')
+        oldd.callback.side_effect = lambda _: self.sh.gather_messages(againd)
+        self.sh.gather_messages(oldd)
+        self.sh.gather_messages(newd)
+
+        # The regather is newest, so it releases newd in turn:
+        check_mock(self, newd, [call.callback([])])
+        self.assertEqual(self.sh._state, ('blocked', againd))
+        self.assertEqual(3, self.sh.gathers)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+    def test_cancel_gather(self):
+        d = MagicMock()
+        self.sh.gather_messages(d)
+        self.sh.cancel_gather(d)
+
+        self.assertEqual(self.sh._state, _Empty)
+        self.assertEqual([], self.clock.getDelayedCalls())
+        check_mock(self, d, [])
+
+    def test_cancel_stale_gather_is_ignored(self):
+        oldd = MagicMock(name='old')
+        newd = MagicMock(name='new')
+        self.sh.gather_messages(oldd)
+        self.sh.gather_messages(newd)
+        self.sh.cancel_gather(oldd)
+
+        self.assertEqual(self.sh._state, ('blocked', newd))
+
+
+class ShuttleBatchTests (TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sh = Shuttle(
+            self.clock,
+            polltimeout=30,
+            batchdelay=0.05,
+            batchsize=4,
+            batchbytes=64)
+        self.d = MagicMock(name='Deferred')
+        self.sh.gather_messages(self.d)
+
+    def test_flush_after_delay(self):
+        msgs = ['a', 'b', 'c']
+        for msg in msgs:
+            self.sh.send_message(msg)
+
+        check_mock(self, self.d, [])
+
+        self.clock.advance(0.05)
+        check_mock(self, self.d, [call.callback(msgs)])
+        self.assertEqual(self.sh._state, _Empty)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_flush_at_batchsize(self):
+        msgs = ['a', 'b', 'c', 'd']
+        for msg in msgs:
+            self.sh.send_message(msg)
+
+        check_mock(self, self.d, [call.callback(msgs)])
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_flush_at_batchbytes(self):
+        msgs = ['x' * 40, 'y' * 40]
+        for msg in msgs:
+            self.sh.send_message(msg)
+
+        check_mock(self, self.d, [call.callback(msgs)])
+
+    def test_newer_gather_takes_batch(self):
+        self.sh.send_message('a')
+        newd = MagicMock(name='newer')
+        self.sh.gather_messages(newd)
+
+        check_mock(self, self.d, [call.callback([])])
+        check_mock(self, newd, [call.callback(['a'])])
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_cancel_keeps_batch_queued(self):
+        self.sh.send_message('a')
+        self.sh.cancel_gather(self.d)
+
+        self.assertEqual(self.sh._state, ('queued', deque(['a'])))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_batch_limits_require_delay(self):
+        for kw in [{'batchsize': 4}, {'batchbytes': 64}]:
+            self.assertRaises(AssertionError, Shuttle, self.clock, **kw)
+
+    def test_close_while_filling(self):
+        self.sh.send_message('a')
+        reason = MagicMock(name='reason')
+        self.sh.close(reason)
+
+        check_mock(self, self.d, [call.errback(reason)])
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+class ShuttleQueueLimitTests (TestCase):
+    def test_counters(self):
+        sh = Shuttle(maxqueuedbytes=1000)
+        for msg in ['a', 'bb', 'ccc']:
+            sh.send_message(msg)
+
+        self.assertEqual(3, sh.queued_messages)
+        self.assertEqual(len('"a""bb""ccc"'), sh.queued_bytes)
+
+        sh.gather_messages(MagicMock())
+        self.assertEqual(0, sh.queued_messages)
+        self.assertEqual(0, sh.queued_bytes)
+
+    def test_drop_oldest_by_count(self):
+        sh = Shuttle(maxqueued=3)
+        for msg in range(5):
+            self.assertIsNone(sh.send_message(msg))
+
+        self.assertEqual(sh._state, ('queued', deque([2, 3, 4])))
+        self.assertEqual(2, sh.dropped_messages)
+
+    def test_drop_oldest_by_bytes(self):
+        sh = Shuttle(maxqueuedbytes=10)
+        for msg in ['aaa', 'bbb', 'ccc']:
+            sh.send_message(msg)
+
+        self.assertEqual(sh._state, ('queued', deque(['bbb', 'ccc'])))
+        self.assertEqual(10, sh.queued_bytes)
+        self.assertEqual(1, sh.dropped_messages)
+
+    def test_reject(self):
+        sh = Shuttle(maxqueued=2, overflow='reject')
+        sh.send_message('a')
+        sh.send_message('b')
+
+        self.assertRaises(error.OutgoingQueueFull, sh.send_message, 'c')
+        self.assertEqual(sh._state, ('queued', deque(['a', 'b'])))
+        self.assertEqual(1, sh.dropped_messages)
+
+    def test_reject_when_empty(self):
+        sh = Shuttle(maxqueuedbytes=2, overflow='reject')
+
+        self.assertRaises(error.OutgoingQueueFull, sh.send_message, 'abc')
+        self.assertEqual(sh._state, _Empty)
+
+    def test_cancelled_batch_counts_toward_limits(self):
+        clock = task.Clock()
+        sh = Shuttle(clock, batchdelay=0.05, maxqueuedbytes=20,
+                     overflow='reject')
+        d = MagicMock()
+        sh.gather_messages(d)
+        sh.send_message('x' * 13)
+        sh.cancel_gather(d)
+
+        self.assertEqual(15, sh.queued_bytes)
+        self.assertRaises(error.OutgoingQueueFull, sh.send_message, 'y' * 13)
+        self.assertEqual(sh._state, ('queued', deque(['x' * 13])))
+
+    def test_wait_until_drained(self):
+        sh = Shuttle(maxqueued=1, overflow='wait')
+        self.assertIsNone(sh.send_message('a'))
+
+        waiters = [sh.send_message(msg) for msg in ['b', 'c']]
+        for d in waiters:
+            self.failIf(d.called)
+
+        gd = MagicMock()
+        sh.gather_messages(gd)
+        check_mock(self, gd, [call.callback(['a', 'b', 'c'])])
+
+        for d in waiters:
+            self.failUnless(d.called)
+
+    def test_close_fails_waiters(self):
+        sh = Shuttle(maxqueued=0, overflow='wait')
+        d = sh.send_message('a')
+        reason = error.SessionClosed(reason='expired')
+        sh.close(reason)
+
+        failures = []
+        d.addErrback(failures.append)
+        self.assertEqual([reason], [f.value for f in failures])
@@ -0,0 +1,66 @@
+from unittest import TestCase
+from thinserve.api.referenceable import Referenceable
+from thinserve.proto import signature
+
+
+class SignatureTests (TestCase):
+    def test_function(self):
+        def f(a, b, c=None):
+            pass
+
+        sig = signature.of(f)
+        self.assertEqual(frozenset(['a', 'b']), sig.required)
+        self.assertEqual(frozenset(['a', 'b', 'c']), sig.allowed)
+
+    def test_keywords_allow_anything(self):
+        def f(a, **kw):
+            pass
+
+        sig = signature.of(f)
+        self.assertEqual(frozenset(['a']), sig.required)
+        self.assertIsNone(sig.allowed)
+
+    def test_cached_by_identity(self):
+        def f(a):
+            pass
+
+        self.assertIs(signature.of(f), signature.of(f))
+
+    def test_bound_methods_share_analysis(self):
+        class C (object):
+            def m(self, x):
+                pass
+
+        sig = signature.of(C().m)
+        self.assertIs(sig, signature.of(C().m))
+        self.assertIs(sig, signature.of_method(C.__dict__['m']))
+        self.assertEqual(frozenset(['x']), sig.allowed)
+
+    def test_plain_and_method_use_differ(self):
+        def m(self, x):
+            pass
+
+        self.assertEqual(frozenset(['self', 'x']), signature.of(m).allowed)
+        self.assertEqual(frozenset(['x']), signature.of_method(m).allowed)
+
+    def test_class_and_instance(self):
+        class C (object):
+            def __init__(self, x):
+                pass
+
+            def __call__(self, y):
+                pass
+
+        self.assertEqual(frozenset(['x']), signature.of(C).allowed)
+        self.assertEqual(frozenset(['y']), signature.of(C(1)).allowed)
+        self.assertIs(signature.of(C(1)), signature.of(C(2)))
+
+    def test_referenceable_precomputes_methods(self):
+        class C (object):
+            @Referenceable.Method
+            def foo(self, x):
+                pass
+
+        self.assertNotIn(C.__dict__['foo'], signature._methods)
+        Referenceable(C)
+        self.assertIn(C.__dict__['foo'], signature._methods)
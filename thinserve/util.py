@@ -1,4 +1,8 @@
+import sys
+from collections import Mapping
 from functools import wraps
+from types import MethodType
+from functable import FunctionTable
 
 
 def not_implemented(f):
@@ -13,3 +17,44 @@ def not_implemented(f):
 def Singleton(C):
     """A class decorator for singleton classes."""
     return C()
+
+
+def import_object(spec):
+    """Return the object named by spec, as 'module:name'."""
+    (modname, _, name) = spec.partition(':')
+    __import__(modname)
+    return getattr(sys.modules[modname], name)
+
+
+class FunctionTableProperty (FunctionTable):
+    """A functable.FunctionTableProperty which keeps no instance alive.
+
+    functable caches each instance's bound table in a WeakKeyDictionary,
+    but the bound methods refer back to their key, so no instance is
+    ever collected. I bind methods as they are looked up instead.
+    """
+    def __get__(self, instance, cls):
+        if instance is None:
+            return self
+        else:
+            return _BoundFunctionTable(self, instance)
+
+
+class _BoundFunctionTable (Mapping):
+    __slots__ = ['_table', '_instance']
+
+    def __init__(self, table, instance):
+        self._table = table
+        self._instance = instance
+
+    def __getitem__(self, name):
+        return MethodType(
+            self._table[name],
+            self._instance,
+            type(self._instance))
+
+    def __iter__(self):
+        return iter(self._table)
+
+    def __len__(self):
+        return len(self._table)